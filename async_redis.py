@@ -0,0 +1,236 @@
+import logging
+import socket
+from collections import deque
+from functools import partial
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnectionError(RedisError):
+    pass
+
+
+class RedisResponseError(RedisError):
+    pass
+
+
+def encode_command(args):
+    """
+        Кодирует команду в RESP: *<argc>\\r\\n$<len>\\r\\n<arg>\\r\\n...
+    """
+    parts = [b'*', str(len(args)).encode(), b'\r\n']
+    for arg in args:
+        if isinstance(arg, bytes):
+            value = arg
+        elif isinstance(arg, str):
+            value = arg.encode()
+        else:
+            value = str(arg).encode()
+        parts += [b'$', str(len(value)).encode(), b'\r\n', value, b'\r\n']
+    return b''.join(parts)
+
+
+class RedisConnection:
+    """
+        Неблокирующий клиент redis поверх tornado IOStream
+
+        Команды пишутся в сокет сразу, а ответы разбирает один
+        _read_loop и раздает их в порядке очереди self._pending,
+        поэтому конкурентные корутины автоматически пайплайнятся
+        в одном соединении.
+
+        Любая сетевая ошибка закрывает соединение и превращается
+        в RedisConnectionError для всех ожидающих ответа.
+
+        socket_timeout  - сколько секунд ждать ответа на команду,
+        connect_timeout - сколько ждать установки соединения;
+        None - без ограничения
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 socket_timeout=None, connect_timeout=None, **kwargs):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+
+        self._stream = None
+        self._pending = deque()
+        self._on_message = None
+
+    @property
+    def is_connected(self):
+        return self._stream is not None and not self._stream.closed()
+
+    @gen.coroutine
+    def connect(self):
+        if self.is_connected:
+            return
+        connecting = TCPClient().connect(self.host, self.port)
+        try:
+            if self.connect_timeout:
+                stream = yield gen.with_timeout(
+                    IOLoop.current().time() + self.connect_timeout,
+                    connecting,
+                    quiet_exceptions=(StreamClosedError, socket.error),
+                )
+            else:
+                stream = yield connecting
+        except gen.TimeoutError:
+            # если соединение все-таки установится, оно уже не нужно
+            connecting.add_done_callback(
+                lambda f: f.exception() is None and f.result().close()
+            )
+            raise RedisConnectionError('connect timeout')
+        except (StreamClosedError, socket.error) as e:
+            raise RedisConnectionError(e)
+
+        self._stream = stream
+        stream.set_close_callback(partial(self._on_close, stream))
+        stream.set_nodelay(True)
+        self._read_loop(stream)
+
+        if self.password:
+            yield self.execute('AUTH', self.password)
+        if self.db:
+            yield self.execute('SELECT', self.db)
+
+    def disconnect(self):
+        stream = self._stream
+        if stream is not None:
+            stream.close()
+            self._on_close(stream)
+
+    def _on_close(self, stream):
+        if stream is not self._stream:
+            return
+        self._stream = None
+        self._on_message = None
+        pending, self._pending = self._pending, deque()
+        for future in pending:
+            if not future.done():
+                future.set_exception(RedisConnectionError('connection closed'))
+
+    def _send(self, commands):
+        if not self.is_connected:
+            raise RedisConnectionError('not connected')
+
+        futures = []
+        for args in commands:
+            future = Future()
+            self._pending.append(future)
+            futures.append(future)
+        try:
+            self._stream.write(b''.join(encode_command(args) for args in commands))
+        except StreamClosedError as e:
+            self.disconnect()
+            raise RedisConnectionError(e)
+        return futures
+
+    @gen.coroutine
+    def _wait(self, futures):
+        try:
+            if self.socket_timeout:
+                results = yield gen.with_timeout(
+                    IOLoop.current().time() + self.socket_timeout,
+                    gen.multi(futures),
+                )
+            else:
+                results = yield gen.multi(futures)
+        except gen.TimeoutError:
+            # ответы придут не по порядку, соединение больше не годится
+            self.disconnect()
+            raise RedisConnectionError('timeout')
+        return results  # noqa
+
+    @gen.coroutine
+    def execute(self, *args):
+        results = yield self._wait(self._send([args]))
+        return results[0]  # noqa
+
+    @gen.coroutine
+    def pipeline(self, commands):
+        """
+            Отправляет пачку команд одной записью в сокет
+            и возвращает список ответов в том же порядке
+        """
+        if not commands:
+            return []
+        results = yield self._wait(self._send(commands))
+        return results  # noqa
+
+    @gen.coroutine
+    def subscribe(self, channels, callback):
+        """
+            Переводит соединение в режим pub/sub, callback(channel, data)
+            вызывается на каждое сообщение. Другие команды после этого
+            в соединение слать нельзя.
+        """
+        self._on_message = callback
+        results = yield self.pipeline([('SUBSCRIBE', channel) for channel in channels])
+        return results  # noqa
+
+    @gen.coroutine
+    def _read_loop(self, stream):
+        try:
+            while True:
+                reply = yield self._read_reply(stream)
+                if (self._on_message is not None and isinstance(reply, list) and
+                        reply and reply[0] == b'message'):
+                    try:
+                        self._on_message(reply[1], reply[2])
+                    except Exception:
+                        logging.exception('redis message callback failed')
+                    continue
+                if not self._pending:
+                    continue
+                future = self._pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(reply, RedisResponseError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (StreamClosedError, ValueError):
+            stream.close()
+            self._on_close(stream)
+
+    @gen.coroutine
+    def _read_reply(self, stream):
+        line = yield stream.read_until(b'\r\n')
+        kind, payload = line[:1], line[1:-2]
+
+        if kind == b'+':
+            return payload  # noqa
+        if kind == b'-':
+            return RedisResponseError(payload.decode())  # noqa
+        if kind == b':':
+            return int(payload)  # noqa
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None  # noqa
+            data = yield stream.read_bytes(length + 2)
+            return data[:-2]  # noqa
+        if kind == b'*':
+            length = int(payload)
+            if length < 0:
+                return None  # noqa
+            items = []
+            for _ in range(length):
+                item = yield self._read_reply(stream)
+                items.append(item)
+            return items  # noqa
+
+        stream.close()
+        raise StreamClosedError()
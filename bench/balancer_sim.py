@@ -0,0 +1,79 @@
+"""
+    Симуляция пула адресов DB API: несколько заглушек базы с разной
+    задержкой, одна из них медленная. Сравнивает задержку запросов
+    через DBApiDirect при случайном выборе адреса (как было раньше)
+    и при выборе BackendPool по запросам в полете и по EWMA.
+
+    python -m bench.balancer_sim --fast 3 --slow 1 --workers 10 --requests 1000
+"""
+import argparse
+import json
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+from db_api import BackendPool, DBApiDirect
+from bench import fake_db_api
+from bench.redis_loop_latency import percentile
+
+
+@gen.coroutine
+def measure(backends, strategy, workers, requests):
+    pool = BackendPool(backends, strategy=strategy)
+    db_api = DBApiDirect(
+        'db', 0,
+        pool=pool,
+        http_client=SimpleAsyncHTTPClient(force_instance=True, max_clients=workers),
+    )
+    latencies = []
+    left = [requests]
+
+    @gen.coroutine
+    def worker():
+        while left[0] > 0:
+            left[0] -= 1
+            started = IOLoop.current().time()
+            yield db_api.request('GET', path='/api/events/')
+            latencies.append(IOLoop.current().time() - started)
+
+    started = IOLoop.current().time()
+    yield [worker() for _ in range(workers)]
+    duration = IOLoop.current().time() - started
+
+    return {
+        'rps': requests / duration,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'requests_per_backend': [
+            pool.backends[backend].stats['requests'] for backend in backends
+        ],
+    }  # noqa
+
+
+@gen.coroutine
+def main(args):
+    backends = [fake_db_api.start(args.latency, args.latency / 5) for _ in range(args.fast)]
+    backends += [
+        fake_db_api.start(args.slow_latency, args.slow_latency / 5) for _ in range(args.slow)
+    ]
+
+    results = {}
+    for strategy in BackendPool.STRATEGIES:
+        results[strategy] = yield measure(backends, strategy, args.workers, args.requests)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fast', type=int, default=3, help='number of fast backends')
+    parser.add_argument('--slow', type=int, default=1, help='number of slow backends')
+    parser.add_argument('--latency', type=float, default=0.02, help='fast backend latency, sec')
+    parser.add_argument('--slow-latency', type=float, default=0.2, help='slow backend latency, sec')
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    IOLoop.current().run_sync(lambda: main(args))
@@ -0,0 +1,104 @@
+"""
+    Заглушка DB API для бенчмарков
+
+    На любой GET отвечает JSON вида {"count": n, "results": [...]}
+    размером около body_size байт через latency +- jitter секунд.
+    Сколько запросов и байт отдано - GET /_stats.
+
+    python -m bench.fake_db_api --port 8000 --latency 0.01 --body-size 10000
+"""
+import argparse
+import json
+import multiprocessing
+import random
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+
+def make_body(path, size):
+    item = {'id': 0, 'name': 'event %s' % path, 'slug': 'event', 'place': 'moscow'}
+    per_item = len(json.dumps(item)) + 2
+    results = [dict(item, id=i) for i in range(max(1, size // per_item))]
+    return json.dumps({'count': len(results), 'results': results}).encode()
+
+
+class FakeDBApiHandler(RequestHandler):
+    def initialize(self, latency, jitter, body_size, stats):
+        self.latency = latency
+        self.jitter = jitter
+        self.body_size = body_size
+        self.stats = stats
+
+    @gen.coroutine
+    def get(self, path):
+        if path == '_stats':
+            self.write(self.stats)
+            return
+
+        delay = random.gauss(self.latency, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            yield gen.sleep(delay)
+
+        body = make_body(path, self.body_size)
+        self.stats['requests'] += 1
+        self.stats['bytes'] += len(body)
+        self.set_header('Content-Type', 'application/json')
+        self.write(body)
+
+
+def make_app(latency=0.0, jitter=0.0, body_size=1024):
+    stats = {'requests': 0, 'bytes': 0}
+    return Application([
+        (r'/(.*)', FakeDBApiHandler, dict(
+            latency=latency, jitter=jitter, body_size=body_size, stats=stats,
+        )),
+    ])
+
+
+def start(latency=0.0, jitter=0.0, body_size=1024, port=None):
+    """
+        Запускает заглушку в текущем IOLoop, возвращает (host, port)
+    """
+    server = HTTPServer(make_app(latency, jitter, body_size))
+    if port is None:
+        sock, port = bind_unused_port()
+        server.add_sockets([sock])
+    else:
+        server.listen(port)
+    return ('127.0.0.1', port)
+
+
+def _serve(queue, latency, jitter, body_size):
+    IOLoop.clear_current()
+    loop = IOLoop()
+    loop.make_current()
+    queue.put(start(latency, jitter, body_size)[1])
+    loop.start()
+
+
+def run_in_process(latency=0.0, jitter=0.0, body_size=1024):
+    """
+        Заглушка в отдельном процессе, чтобы не делить CPU
+        с тем, что меряем. Возвращает (process, port)
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_serve, args=(queue, latency, jitter, body_size), daemon=True)
+    process.start()
+    return process, queue.get()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.01, help='reply delay, sec')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--body-size', type=int, default=10000, help='approximate body size, bytes')
+    args = parser.parse_args()
+
+    start(args.latency, args.jitter, args.body_size, port=args.port)
+    IOLoop.current().start()
@@ -0,0 +1,293 @@
+"""
+    Заглушка redis для тестов и бенчмарков
+
+    Понимает RESP и небольшое подмножество команд, хранит все в dict.
+    delay - искусственная задержка ответа (имитация сети до redis),
+    порядок ответов внутри соединения сохраняется.
+"""
+import multiprocessing
+import threading
+from collections import deque
+from time import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Event
+from tornado.netutil import bind_sockets
+from tornado.tcpserver import TCPServer
+
+
+def encode_reply(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b':' + str(value).encode() + b'\r\n'
+    if isinstance(value, Status):
+        return b'+' + value.text.encode() + b'\r\n'
+    if isinstance(value, Exception):
+        return b'-ERR ' + str(value).encode() + b'\r\n'
+    if isinstance(value, (list, tuple)):
+        return b'*' + str(len(value)).encode() + b'\r\n' + b''.join(map(encode_reply, value))
+    if isinstance(value, str):
+        value = value.encode()
+    return b'$' + str(len(value)).encode() + b'\r\n' + value + b'\r\n'
+
+
+class Status:
+    def __init__(self, text):
+        self.text = text
+
+
+OK = Status('OK')
+
+
+class Client:
+    def __init__(self, stream):
+        self.stream = stream
+        self.replies = deque()
+        self.has_replies = Event()
+
+
+class FakeRedisServer(TCPServer):
+
+    def __init__(self, delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.data = {}
+        self.expires = {}
+        self.commands_processed = 0
+        self.streams = set()
+        self.channels = {}
+        self.current_client = None
+
+    def listen_random_port(self):
+        sockets = bind_sockets(0, '127.0.0.1')
+        self.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+    def disconnect_clients(self):
+        for stream in list(self.streams):
+            stream.close()
+
+    def _alive(self, key):
+        expire_at = self.expires.get(key)
+        if expire_at is not None and expire_at <= time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        # как настоящий redis: ответы пачки не ждут ACK (Nagle)
+        stream.set_nodelay(True)
+        client = Client(stream)
+        self._writer(client)
+        try:
+            while True:
+                args = yield self._read_command(stream)
+                self.commands_processed += 1
+                self.current_client = client
+                try:
+                    handler = getattr(self, 'cmd_' + args[0].decode().lower())
+                    reply = handler(*args[1:])
+                except AttributeError:
+                    reply = Exception('unknown command %s' % args[0])
+                except Exception as e:
+                    reply = e
+                self._reply(client, reply)
+        except StreamClosedError:
+            self.streams.discard(stream)
+            for subscribers in self.channels.values():
+                subscribers.discard(client)
+            client.has_replies.set()
+
+    def _reply(self, client, reply):
+        client.replies.append((IOLoop.current().time() + self.delay, encode_reply(reply)))
+        client.has_replies.set()
+
+    @gen.coroutine
+    def _writer(self, client):
+        stream = client.stream
+        try:
+            while not stream.closed():
+                yield client.has_replies.wait()
+                client.has_replies.clear()
+                while client.replies:
+                    due, reply = client.replies[0]
+                    wait = due - IOLoop.current().time()
+                    if wait > 0:
+                        yield gen.sleep(wait)
+                    client.replies.popleft()
+                    stream.write(reply)
+        except StreamClosedError:
+            pass
+
+    @gen.coroutine
+    def _read_command(self, stream):
+        line = yield stream.read_until(b'\r\n')
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            line = yield stream.read_until(b'\r\n')
+            value = yield stream.read_bytes(int(line[1:-2]) + 2)
+            args.append(value[:-2])
+        return args  # noqa
+
+    def cmd_ping(self):
+        return Status('PONG')
+
+    def cmd_select(self, db):
+        return OK
+
+    def cmd_auth(self, password):
+        return OK
+
+    def cmd_flushdb(self):
+        self.data.clear()
+        self.expires.clear()
+        return OK
+
+    def cmd_get(self, key):
+        if self._alive(key):
+            return self.data[key]
+        return None
+
+    def cmd_set(self, key, value, *options):
+        self.data[key] = value
+        self.expires.pop(key, None)
+        options = [o.decode().upper() for o in options]
+        if 'EX' in options:
+            self.expires[key] = time() + int(options[options.index('EX') + 1])
+        return OK
+
+    def cmd_setex(self, key, ttl, value):
+        return self.cmd_set(key, value, b'EX', ttl)
+
+    def cmd_expire(self, key, ttl):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time() + int(ttl)
+        return 1
+
+    def cmd_ttl(self, key):
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(self.expires[key] - time())
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def cmd_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                deleted += 1
+        return deleted
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) for key in keys]
+
+    def cmd_zadd(self, key, *pairs):
+        if not self._alive(key):
+            self.data[key] = {}
+        zset = self.data[key]
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in zset
+            zset[member] = float(score)
+        return added
+
+    def cmd_zrange(self, key, start, stop, *options):
+        if not self._alive(key):
+            return []
+        items = sorted(self.data[key].items(), key=lambda item: (item[1], item[0]))
+        stop = int(stop)
+        items = items[int(start):None if stop == -1 else stop + 1]
+        if options and options[0].upper() == b'WITHSCORES':
+            return [v for member, score in items for v in (member, repr(score))]
+        return [member for member, score in items]
+
+    def cmd_zrangebyscore(self, key, low, high):
+        if not self._alive(key):
+            return []
+        low, high = float(low), float(high)
+        items = sorted(self.data[key].items(), key=lambda item: (item[1], item[0]))
+        return [member for member, score in items if low <= score <= high]
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        members = self.cmd_zrangebyscore(key, low, high)
+        for member in members:
+            del self.data[key][member]
+        return len(members)
+
+    def cmd_zrem(self, key, *members):
+        if not self._alive(key):
+            return 0
+        removed = 0
+        for member in members:
+            removed += self.data[key].pop(member, None) is not None
+        return removed
+
+    def cmd_publish(self, channel, message):
+        subscribers = self.channels.get(channel, set())
+        for client in subscribers:
+            self._reply(client, [b'message', channel, message])
+        return len(subscribers)
+
+    def cmd_subscribe(self, channel):
+        self.channels.setdefault(channel, set()).add(self.current_client)
+        return [b'subscribe', channel, 1]
+
+
+def run_in_thread(delay=0):
+    """
+        Поднимает FakeRedisServer в отдельном потоке со своим IOLoop,
+        чтобы к нему мог ходить и блокирующий клиент.
+        Возвращает (server, port)
+    """
+    started = threading.Event()
+    result = {}
+
+    def target():
+        loop = IOLoop()
+
+        def start():
+            server = FakeRedisServer(delay=delay)
+            result['server'] = server
+            result['port'] = server.listen_random_port()
+            started.set()
+
+        loop.add_callback(start)
+        loop.start()
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    started.wait()
+    return result['server'], result['port']
+
+
+def _serve(queue, delay):
+    IOLoop.clear_current()
+    loop = IOLoop()
+    loop.make_current()
+    queue.put(FakeRedisServer(delay=delay).listen_random_port())
+    loop.start()
+
+
+def run_in_process(delay=0):
+    """
+        FakeRedisServer в отдельном процессе. Возвращает (process, port)
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_serve, args=(queue, delay), daemon=True)
+    process.start()
+    return process, queue.get()
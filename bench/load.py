@@ -0,0 +1,264 @@
+"""
+    Нагрузочный бенчмарк приложения целиком
+
+    Поднимает в отдельных процессах заглушку DB API (bench.fake_db_api),
+    заглушку redis (bench.fake_redis, или --redis-port для настоящего
+    redis-server) и само приложение в режиме direct и/или cached, потом
+    гоняет по нему запросы /db/api/events/<id>/ и страницы /test/
+    (CacheMixin) с --concurrency одновременных клиентов.
+
+    Для каждого режима: req/s, p50/p99, CPU процесса приложения на
+    запрос (по /proc, только Linux), доля /db запросов, которые отдал
+    кэш DB API без похода в базу (по db_api_events_total из /metrics,
+    страницы CacheMixin не в счет), и размеры ответов. Результат - JSON, --output сохраняет его
+    в файл, чтобы сравнивать прогоны.
+
+    python -m bench.load --modes direct cached --duration 10 --output before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import sys
+from time import time
+
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.testing import bind_unused_port
+
+from bench import fake_db_api, fake_redis
+from bench.redis_loop_latency import percentile
+
+EVENT_RE = re.compile(r'^db_api_events_total\{event="([^"]+)"\} (\S+)$')
+
+
+def cpu_seconds(pid):
+    """
+        user + system время процесса или None, если нет /proc
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _serve_app(queue, cached, db_port, redis_port):
+    import main
+    from handlers import TestView
+
+    IOLoop.clear_current()
+    loop = IOLoop()
+    loop.make_current()
+
+    main.DEBUG = False
+    main.REDIS['CLIENT'].update(host='127.0.0.1', port=redis_port)
+    main.DB_API.update(
+        HOST='127.0.0.1',
+        PORT=db_port,
+        CACHED=cached,
+        SLOW_REQUEST_MS=None,
+        SERVER_TIMING=False,
+    )
+    application = main.make_app([(r'/test/', TestView)])
+    sock, port = bind_unused_port()
+    server = main.tornado.httpserver.HTTPServer(application)
+    server.add_sockets([sock])
+    queue.put(port)
+    loop.start()
+
+
+def run_app(cached, db_port, redis_port):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(
+        target=_serve_app, args=(queue, cached, db_port, redis_port), daemon=True,
+    )
+    process.start()
+    return process, queue.get()
+
+
+@gen.coroutine
+def get_json(client, url):
+    response = yield client.fetch(url)
+    return json.loads(response.body.decode())  # noqa
+
+
+@gen.coroutine
+def get_events(client, url):
+    """
+        db_api_events_total из /metrics: {event: value}, без кэша пусто
+    """
+    response = yield client.fetch(url)
+    events = {}
+    for line in response.body.decode().splitlines():
+        match = EVENT_RE.match(line)
+        if match:
+            events[match.group(1)] = float(match.group(2))
+    return events  # noqa
+
+
+@gen.coroutine
+def wait_ready(client, url, timeout=10):
+    deadline = time() + timeout
+    while True:
+        try:
+            yield client.fetch(url)
+            return
+        except Exception:
+            if time() > deadline:
+                raise
+            yield gen.sleep(0.1)
+
+
+@gen.coroutine
+def run_load(client, base_url, args, duration, rnd):
+    latencies = {'db': [], 'page': []}
+    sizes = {'db': [], 'page': []}
+    errors = [0]
+    deadline = time() + duration
+
+    def next_url():
+        key = rnd.randrange(args.keys)
+        if rnd.random() < args.pages:
+            return 'page', '%s/test/?page=%d' % (base_url, key)
+        return 'db', '%s/db/api/events/%d/' % (base_url, key)
+
+    @gen.coroutine
+    def worker():
+        while time() < deadline:
+            kind, url = next_url()
+            started = IOLoop.current().time()
+            try:
+                response = yield client.fetch(HTTPRequest(url, request_timeout=30))
+            except Exception:
+                errors[0] += 1
+                continue
+            latencies[kind].append(IOLoop.current().time() - started)
+            sizes[kind].append(len(response.body))
+
+    yield [worker() for _ in range(args.concurrency)]
+    return latencies, sizes, errors[0]  # noqa
+
+
+def summary(latencies, sizes, duration):
+    if not latencies:
+        return {'requests': 0}
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'avg_response_bytes': sum(sizes) / len(sizes),
+    }
+
+
+@gen.coroutine
+def measure(mode, args, db_port, redis_port):
+    app, port = run_app(mode == 'cached', db_port, redis_port)
+    base_url = 'http://127.0.0.1:%d' % port
+    db_stats_url = 'http://127.0.0.1:%d/_stats' % db_port
+    client = SimpleAsyncHTTPClient(force_instance=True, max_clients=args.concurrency)
+    rnd = random.Random(args.seed)
+
+    try:
+        yield wait_ready(client, base_url + '/metrics')
+        yield run_load(client, base_url, args, args.warmup, rnd)
+
+        db_before = yield get_json(client, db_stats_url)
+        events_before = yield get_events(client, base_url + '/metrics')
+        cpu_before = cpu_seconds(app.pid)
+        started = time()
+        latencies, sizes, errors = yield run_load(client, base_url, args, args.duration, rnd)
+        duration = time() - started
+        cpu_after = cpu_seconds(app.pid)
+        db_after = yield get_json(client, db_stats_url)
+        events_after = yield get_events(client, base_url + '/metrics')
+    finally:
+        client.close()
+        app.terminate()
+        app.join()
+
+    total = sum(len(values) for values in latencies.values())
+    upstream = db_after['requests'] - db_before['requests']
+    db_requests = len(latencies['db'])
+    fetches = events_after.get('upstream_fetches', 0) - events_before.get('upstream_fetches', 0)
+    result = {
+        'requests': total,
+        'errors': errors,
+        'rps': total / duration,
+        'p50_ms': percentile(latencies['db'] + latencies['page'], 0.5) * 1000,
+        'p99_ms': percentile(latencies['db'] + latencies['page'], 0.99) * 1000,
+        'upstream_requests': upstream,
+        # доля /db запросов, отданных кэшем DB API; у direct кэша нет
+        'hit_ratio': 1 - fetches / db_requests if events_after and db_requests else 0.0,
+        'upstream_avg_bytes': (
+            (db_after['bytes'] - db_before['bytes']) / upstream if upstream else 0
+        ),
+        'db': summary(latencies['db'], sizes['db'], duration),
+        'page': summary(latencies['page'], sizes['page'], duration),
+    }
+    if cpu_before is not None and total:
+        result['cpu_ms_per_request'] = (cpu_after - cpu_before) / total * 1000
+    return result  # noqa
+
+
+@gen.coroutine
+def main(args):
+    db, db_port = fake_db_api.run_in_process(args.db_latency, args.db_latency / 5, args.body_size)
+    redis = None
+    redis_port = args.redis_port
+    if redis_port is None:
+        redis, redis_port = fake_redis.run_in_process(args.redis_delay)
+
+    results = {
+        'started': time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'args': vars(args),
+        'modes': {},
+    }
+    try:
+        for mode in args.modes:
+            results['modes'][mode] = yield measure(mode, args, db_port, redis_port)
+    finally:
+        db.terminate()
+        if redis is not None:
+            redis.terminate()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--modes', nargs='+', choices=['direct', 'cached'], default=['direct', 'cached'],
+    )
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--keys', type=int, default=200, help='distinct ids and pages')
+    parser.add_argument('--pages', type=float, default=0.2, help='share of /test/ page requests')
+    parser.add_argument('--db-latency', type=float, default=0.01, help='fake DB API delay, sec')
+    parser.add_argument('--body-size', type=int, default=10000, help='fake DB API body size, bytes')
+    parser.add_argument(
+        '--redis-delay', type=float, default=0.0, help='fake redis reply delay, sec',
+    )
+    parser.add_argument(
+        '--redis-port', type=int, default=None, help='use a real redis-server on this port',
+    )
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='save JSON results to this file')
+    args = parser.parse_args()
+
+    IOLoop.current().run_sync(lambda: main(args))
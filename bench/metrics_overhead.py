@@ -0,0 +1,48 @@
+"""
+    Сколько стоит запись метрик на один запрос: counter.inc
+    и histogram.observe, как в DBApiCached/DBApiRequestHandler,
+    и один span() этапа с разбивкой (Timing) и без нее (None)
+
+    python -m bench.metrics_overhead --requests 100000
+"""
+import argparse
+import json
+from time import perf_counter
+
+from metrics import Registry
+from timing import Timing, span
+
+
+def recording(n):
+    registry = Registry()
+    requests = registry.counter('requests_total', 'Requests', ['route', 'outcome'])
+    latency = registry.histogram('request_seconds', 'Latency', ['route'])
+
+    started = perf_counter()
+    for i in range(n):
+        requests.inc('/api/events/{id}/', 'hit')
+        latency.observe(0.003, '/api/events/{id}/')
+    return (perf_counter() - started) / n
+
+
+def spans(timing, n):
+    started = perf_counter()
+    for i in range(n):
+        with span(timing, 'redis'):
+            pass
+    return (perf_counter() - started) / n
+
+
+def main(args):
+    results = {
+        'recording_us_per_request': recording(args.requests) * 1e6,
+        'span_us': spans(Timing(), args.requests) * 1e6,
+        'null_span_us': spans(None, args.requests) * 1e6,
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=100000)
+    main(parser.parse_args())
@@ -0,0 +1,109 @@
+"""
+    Сравнивает задержку IOLoop при работе с кэшем через
+    блокирующий redis.Redis (как было раньше) и через RedisCache
+    на неблокирующем RedisConnection.
+
+    Пока воркеры гоняют exists/get/set, отдельная корутина каждую
+    миллисекунду засыпает и меряет насколько позже просыпается.
+
+    python -m bench.redis_loop_latency --delay 0.002 --workers 50
+"""
+import argparse
+import json
+from time import time
+
+import redis
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from cache import RedisCache
+from bench.fake_redis import run_in_thread
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class BlockingCache:
+    """ старый путь: синхронный клиент прямо в корутине """
+    def __init__(self, port):
+        self.redis = redis.Redis(port=port)
+
+    @gen.coroutine
+    def get(self, key):
+        if self.redis.exists(key):
+            return self.redis.get(key)  # noqa
+        return None
+
+    @gen.coroutine
+    def set(self, key, value, key_ttl):
+        self.redis.set(key, value)
+        self.redis.expire(key, key_ttl)
+
+
+@gen.coroutine
+def make_async_cache(port):
+    cache = RedisCache(port=port)
+    yield cache.redis_connection.connect()
+    cache.state = cache.state_map[cache.CONNECTED]
+    return cache  # noqa
+
+
+@gen.coroutine
+def measure(cache, workers, duration, tick=0.001):
+    lags = []
+    ops = [0]
+    deadline = time() + duration
+
+    @gen.coroutine
+    def ticker():
+        while time() < deadline:
+            started = IOLoop.current().time()
+            yield gen.sleep(tick)
+            lags.append(IOLoop.current().time() - started - tick)
+
+    @gen.coroutine
+    def worker(n):
+        key = 'bench:%d' % (n % 10)
+        while time() < deadline:
+            value = yield cache.get(key)
+            if value is None:
+                yield cache.set(key, b'x' * 512, 10)
+            ops[0] += 1
+            # граница запроса: даем циклу обработать остальное
+            yield gen.moment
+
+    yield [ticker()] + [worker(n) for n in range(workers)]
+
+    return {
+        'ops_per_sec': ops[0] / duration,
+        'loop_lag_p50_ms': percentile(lags, 0.5) * 1000,
+        'loop_lag_p99_ms': percentile(lags, 0.99) * 1000,
+        'loop_lag_max_ms': max(lags or [0]) * 1000,
+    }  # noqa
+
+
+@gen.coroutine
+def main(args):
+    server, port = run_in_thread(delay=args.delay)
+
+    results = {}
+    results['blocking'] = yield measure(BlockingCache(port), args.workers, args.duration)
+    cache = yield make_async_cache(port)
+    results['async'] = yield measure(cache, args.workers, args.duration)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delay', type=float, default=0.002, help='redis reply delay, sec')
+    parser.add_argument('--workers', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=3)
+    args = parser.parse_args()
+
+    IOLoop.current().run_sync(lambda: main(args))
@@ -0,0 +1,170 @@
+"""
+    Сколько походов в redis стоит один запрос, до и после
+    get_many/set_many и однокомандных get/set
+
+    before - как было: get = EXISTS + GET, set = SET + EXPIRE,
+             DBApiCached перед get еще раз звал exists, ключи страницы
+             читались по одному
+    after  - get = GET, set = SET EX, страница - один MGET,
+             запись нескольких ключей - одна пачка SET EX
+
+    Сценарии на один запрос:
+        hit   - запись есть в кэше
+        miss  - записи нет: чтение и запись
+        page  - страница из --keys ресурсов, все в кэше
+        fill  - запись --keys ресурсов страницы
+
+    С --delay видно, во что походы обходятся по времени.
+
+    python -m bench.redis_roundtrips --delay 0.001 --keys 5 --requests 200
+"""
+import argparse
+import json
+from time import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from async_redis import RedisConnection
+from cache import RedisCache
+from bench.fake_redis import run_in_thread
+
+
+class CountingConnection(RedisConnection):
+    """ каждая запись в сокет с ожиданием ответа - один поход """
+    round_trips = 0
+
+    def _send(self, commands):
+        self.round_trips += 1
+        return super()._send(commands)
+
+
+class CountingCache(RedisCache):
+    def create_connection(self):
+        args, kwargs = self._connection_args
+        return CountingConnection(*args, **kwargs)
+
+
+class Before:
+    def __init__(self, connection):
+        self.redis = connection
+
+    @gen.coroutine
+    def get(self, key):
+        exists = yield self.redis.execute('EXISTS', key)
+        if exists:
+            value = yield self.redis.execute('GET', key)
+            return value  # noqa
+        return None
+
+    @gen.coroutine
+    def lookup(self, key):
+        # DBApiCached._load_cache_response: exists, потом get
+        exists = yield self.redis.execute('EXISTS', key)
+        if exists:
+            value = yield self.get(key)
+            return value  # noqa
+        return None
+
+    @gen.coroutine
+    def set(self, key, value, key_ttl):
+        yield self.redis.execute('SET', key, value)
+        yield self.redis.execute('EXPIRE', key, key_ttl)
+
+    @gen.coroutine
+    def lookup_many(self, keys):
+        values = []
+        for key in keys:
+            value = yield self.lookup(key)
+            values.append(value)
+        return values  # noqa
+
+    @gen.coroutine
+    def set_many(self, mapping, key_ttl):
+        for key, value in mapping.items():
+            yield self.set(key, value, key_ttl)
+
+
+class After:
+    def __init__(self, cache):
+        self.cache = cache
+
+    def lookup(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, key_ttl):
+        return self.cache.set(key, value, key_ttl)
+
+    def lookup_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_many(self, mapping, key_ttl):
+        return self.cache.set_many(mapping, key_ttl)
+
+
+@gen.coroutine
+def run_scenario(cache, connection, name, scenario, n, keys):
+    value = b'x' * 512
+
+    @gen.coroutine
+    def one(i):
+        key = 'bench:%s:%s:%d' % (name, scenario, i)
+        page = ['%s:%d' % (key, k) for k in range(keys)]
+        if scenario == 'hit':
+            yield cache.lookup('bench:hot')
+        elif scenario == 'miss':
+            found = yield cache.lookup(key)
+            if found is None:
+                yield cache.set(key, value, 10)
+        elif scenario == 'page':
+            yield cache.lookup_many(['bench:hot:%d' % k for k in range(keys)])
+        elif scenario == 'fill':
+            yield cache.set_many({k: value for k in page}, 10)
+
+    yield cache.set('bench:hot', value, 60)
+    yield cache.set_many({'bench:hot:%d' % k: value for k in range(keys)}, 60)
+
+    before = connection.round_trips
+    started = time()
+    for i in range(n):
+        yield one(i)
+    duration = time() - started
+    return {
+        'round_trips_per_request': (connection.round_trips - before) / n,
+        'ms_per_request': duration / n * 1000,
+    }  # noqa
+
+
+@gen.coroutine
+def main(args):
+    server, port = run_in_thread(delay=args.delay)
+
+    connection = CountingConnection(host='127.0.0.1', port=port)
+    yield connection.connect()
+    cache = CountingCache(host='127.0.0.1', port=port)
+    yield cache.redis_connection.connect()
+    cache.state = cache.state_map[cache.CONNECTED]
+
+    variants = {
+        'before': (Before(connection), connection),
+        'after': (After(cache), cache.redis_connection),
+    }
+    results = {}
+    for scenario in ['hit', 'miss', 'page', 'fill']:
+        results[scenario] = {}
+        for name, (variant, counter) in variants.items():
+            results[scenario][name] = yield run_scenario(
+                variant, counter, name, scenario, args.requests, args.keys,
+            )
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delay', type=float, default=0.001, help='redis reply delay, sec')
+    parser.add_argument('--keys', type=int, default=5, help='resources per page')
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    IOLoop.current().run_sync(lambda: main(args))
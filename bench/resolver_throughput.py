@@ -0,0 +1,83 @@
+"""
+    Пропускная способность Resolver.resolve на кэшированных
+    именах: старая реализация (пересборка всего кэша на каждый
+    вызов) против кучи сроков. Ответ c-ares подменен готовым
+    future, меряется только работа кэша.
+
+    python -m bench.resolver_throughput --hosts 1 100 1000 --calls 10000
+"""
+import argparse
+import json
+import socket
+from time import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.platform.caresresolver import CaresResolver
+
+from resolver import Resolver
+
+
+class OldResolver(CaresResolver):
+    """ resolver.Resolver до переписывания """
+    def initialize(self, *args, **kwargs):
+        self._dns_record_ttl = kwargs.pop('ttl', 3600)
+        self._dns_cache = {}
+        super().initialize(*args, **kwargs)
+
+    @gen.coroutine
+    def resolve(self, host, port, family=socket.AF_INET):
+        now = time()
+        self._dns_cache = {k: v for k, v in self._dns_cache.items() if v['ttl'] > now}
+        if ((host, port) not in self._dns_cache):
+            addresses = yield super().resolve(host, port, family=family)
+            self._dns_cache[(host, port)] = dict(
+                addresses=addresses,
+                ttl=now + self._dns_record_ttl,
+            )
+        else:
+            addresses = self._dns_cache[(host, port)]['addresses']
+
+        return addresses  # noqa
+
+
+def instant_resolve(self, host, port, family=socket.AF_INET):
+    future = Future()
+    future.set_result([(family, ('10.0.0.1', port))])
+    return future
+
+
+@gen.coroutine
+def measure(resolver, hosts, calls):
+    names = ['host-%d.example.com' % i for i in range(hosts)]
+    for name in names:
+        yield resolver.resolve(name, 80)
+
+    started = time()
+    for i in range(calls):
+        yield resolver.resolve(names[i % hosts], 80)
+    return calls / (time() - started)  # noqa
+
+
+@gen.coroutine
+def main(args):
+    CaresResolver.resolve = instant_resolve
+
+    results = {}
+    for hosts in args.hosts:
+        results[hosts] = {
+            'old_per_sec': (yield measure(OldResolver(ttl=600), hosts, args.calls)),
+            'new_per_sec': (yield measure(Resolver(ttl=600), hosts, args.calls)),
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, nargs='+', default=[1, 100, 1000])
+    parser.add_argument('--calls', type=int, default=10000)
+    args = parser.parse_args()
+
+    IOLoop.current().run_sync(lambda: main(args))
@@ -1,29 +1,129 @@
 import logging
+import zlib
+from collections import OrderedDict
 from functools import partial
-
-import redis
+from time import time, perf_counter
 
 from tornado import gen
 
+from metrics import REGISTRY
+from async_redis import (
+    RedisConnection,
+    RedisConnectionError,
+    RedisError,
+)
+
+
+class ValueCodec:
+    """
+        Сжатие значений кэша zlib
+
+        Значения от min_size байт сжимаются и пишутся с маркером
+        b'\x00Z'. Несжатое значение, которое само начинается с \x00,
+        помечается b'\x00\x00', остальные пишутся как есть - так
+        читаются и старые записи, и записи с выключенным сжатием.
+
+        min_size=None - не сжимать
+    """
+    MARKER = b'\x00'
+    (IDENTITY, ZLIB) = (b'\x00', b'Z')
+
+    def __init__(self, min_size=None, level=6):
+        self.min_size = min_size
+        self.level = level
+        self.stats = {
+            'compressed': 0,
+            'raw_bytes': 0,
+            'compressed_bytes': 0,
+            'compress_seconds': 0.0,
+            'decompressed': 0,
+            'decompress_seconds': 0.0,
+        }
+
+    @property
+    def compression_ratio(self):
+        if not self.stats['raw_bytes']:
+            return 1.0
+        return self.stats['compressed_bytes'] / self.stats['raw_bytes']
+
+    def encode(self, value):
+        if isinstance(value, str):
+            value = value.encode()
+
+        if self.min_size is not None and len(value) >= self.min_size:
+            started = perf_counter()
+            compressed = zlib.compress(value, self.level)
+            self.stats['compress_seconds'] += perf_counter() - started
+            if len(compressed) + 2 < len(value):
+                self.stats['compressed'] += 1
+                self.stats['raw_bytes'] += len(value)
+                self.stats['compressed_bytes'] += len(compressed) + 2
+                return self.MARKER + self.ZLIB + compressed
+
+        if value[:1] == self.MARKER:
+            return self.MARKER + self.IDENTITY + value
+        return value
+
+    def decode(self, value):
+        if value is None or value[:1] != self.MARKER:
+            return value
+
+        codec = value[1:2]
+        if codec == self.ZLIB:
+            started = perf_counter()
+            value = zlib.decompress(value[2:])
+            self.stats['decompressed'] += 1
+            self.stats['decompress_seconds'] += perf_counter() - started
+            return value
+        if codec == self.IDENTITY:
+            return value[2:]
+
+        logging.error('unknown cache value codec %r', codec)
+        return None
+
 
 class RedisState:
+    """
+        Все операции - корутины, их надо ждать через yield
+    """
     def __init__(self, app):
         self.app = app
         self.redis = self.app.redis_connection
         self.options = self.app.options
+        self.codec = self.app.codec
 
+    @gen.coroutine
     def get(self, key):
         return None
 
-    def set(self, key, value, key_ttl):
+    @gen.coroutine
+    def set(self, key, value, key_ttl=None):
         pass
 
+    @gen.coroutine
     def delete(self, key):
         pass
 
+    @gen.coroutine
     def exists(self, key):
         return False
 
+    @gen.coroutine
+    def pipeline(self, commands):
+        return None
+
+    @gen.coroutine
+    def get_many(self, keys):
+        return [None] * len(keys)  # noqa
+
+    @gen.coroutine
+    def set_many(self, mapping, key_ttl=None):
+        pass
+
+    @gen.coroutine
+    def delete_many(self, keys):
+        pass
+
 
 class RedisStateDisconnected(RedisState):
 
@@ -33,31 +133,94 @@ class RedisStateDisconnected(RedisState):
 
 class RedisStateConnected(RedisState):
 
+    def _set_command(self, key, value, key_ttl):
+        command = ['SET', key, self.codec.encode(value)]
+        key_ttl = key_ttl or self.options.get('key_ttl')
+        if key_ttl:
+            command += ['EX', int(key_ttl)]
+        return command
+
+    @gen.coroutine
     def get(self, key):
-        if self.exists(key):
-            return self.redis.get(key)
-        return None
+        # GET несуществующего ключа - nil, EXISTS перед ним не нужен
+        value = yield self.redis.execute('GET', key)
+        return self.codec.decode(value)  # noqa
 
+    @gen.coroutine
     def set(self, key, value, key_ttl=None):
-        self.redis.set(key, value)
-        self.redis.expire(key, key_ttl or self.options.get('key_ttl'))
+        yield self.redis.execute(*self._set_command(key, value, key_ttl))
 
+    @gen.coroutine
     def delete(self, key):
-        self.redis.delete(key)
+        yield self.redis.execute('DEL', key)
 
+    @gen.coroutine
     def exists(self, key):
-        return bool(self.redis.exists(key))
+        res = yield self.redis.execute('EXISTS', key)
+        return bool(res)  # noqa
+
+    @gen.coroutine
+    def pipeline(self, commands):
+        res = yield self.redis.pipeline(commands)
+        return res  # noqa
+
+    @gen.coroutine
+    def get_many(self, keys):
+        """
+            Значения ключей одним MGET, None для отсутствующих
+        """
+        if not keys:
+            return []
+        values = yield self.redis.execute('MGET', *keys)
+        return [self.codec.decode(value) for value in values]  # noqa
+
+    @gen.coroutine
+    def set_many(self, mapping, key_ttl=None):
+        """
+            mapping - dict или список пар (key, value),
+            все SET EX уходят одной пачкой
+        """
+        items = mapping.items() if isinstance(mapping, dict) else mapping
+        yield self.redis.pipeline([
+            self._set_command(key, value, key_ttl) for key, value in items
+        ])
+
+    @gen.coroutine
+    def delete_many(self, keys):
+        if keys:
+            yield self.redis.execute('DEL', *keys)
 
     def __str__(self):
         return "RedisState(CONNECTED)"
 
 
+REDIS_SECONDS = REGISTRY.histogram(
+    'redis_command_seconds', 'Redis command latency (connected state only)', ['command'],
+)
+REDIS_DISCONNECTS = REGISTRY.counter(
+    'redis_disconnects_total', 'Redis connection losses', ['reason'],
+)
+
+
 class RedisCache:
+    """
+        Кэш в redis; пока redis недоступен, get - промах, set - ничего.
+
+        Без socket_timeout/connect_timeout в параметрах соединения
+        берутся SOCKET_TIMEOUT/CONNECT_TIMEOUT: зависший redis не должен
+        держать запрос дольше, чем поход в базу мимо кэша
+    """
     (CONNECTED, DISCONNECTED) = ('connected', 'disconnected')
+    SOCKET_TIMEOUT = 0.5
+    CONNECT_TIMEOUT = 1.0
 
     def __init__(self, *args, **kwargs):
-        self.redis_connection = redis.Redis(*args, **kwargs)
+        kwargs.setdefault('socket_timeout', self.SOCKET_TIMEOUT)
+        kwargs.setdefault('connect_timeout', self.CONNECT_TIMEOUT)
+        self._connection_args = (args, kwargs)
+        self.redis_connection = self.create_connection()
         self.options = {}
+        self.codec = ValueCodec()
 
         self.is_running = True
 
@@ -68,21 +231,38 @@ class RedisCache:
 
         self.state = self.state_map[self.DISCONNECTED]
 
-    def initialize(self, key_ttl=None):
+    def create_connection(self):
+        """
+            Новое соединение с теми же параметрами, например под pub/sub
+        """
+        args, kwargs = self._connection_args
+        return RedisConnection(*args, **kwargs)
+
+    def initialize(self, key_ttl=None, compress_min_size=None, compress_level=6):
         if key_ttl:
             self.options['key_ttl'] = key_ttl
+        self.codec.min_size = compress_min_size
+        self.codec.level = compress_level
 
+    @gen.coroutine
     def send(self, func_name, *args, **kwargs):
         res = None
+        connected = self.state is self.state_map[self.CONNECTED]
+        started = perf_counter()
         try:
-            res = getattr(self.state, func_name)(*args, **kwargs)
-        except redis.ConnectionError:
+            res = yield getattr(self.state, func_name)(*args, **kwargs)
+        except RedisConnectionError:
+            REDIS_DISCONNECTS.inc('command')
+            self.redis_connection.disconnect()
             self.state = self.state_map[self.DISCONNECTED]
 
-        return res
+        if connected:
+            REDIS_SECONDS.observe(perf_counter() - started, func_name)
+        return res  # noqa
 
     def __getattr__(self, name):
-        if name in ['get', 'set', 'delete', 'exists']:
+        if name in ['get', 'set', 'delete', 'exists', 'pipeline',
+                    'get_many', 'set_many', 'delete_many']:
             return partial(self.send, name)
         raise AttributeError(name)
 
@@ -97,20 +277,98 @@ class RedisCache:
             if self.state == self.state_map[self.DISCONNECTED]:
                 try:
                     reconnect_attempt += 1
-                    if self.redis_connection.ping():
+                    yield self.redis_connection.connect()
+                    pong = yield self.redis_connection.execute('PING')
+                    if pong:
                         logging.info('redis connected')
                         self.state = self.state_map[self.CONNECTED]
                         reconnect_attempt = 0
-                except redis.ConnectionError:
+                except RedisError:
+                    self.redis_connection.disconnect()
                     logging.info('can"t connect')
                 finally:
                     sleep_interval = 2 ** reconnect_attempt
                     if sleep_interval > 17:
                         sleep_interval = 17
             else:
+                if not self.redis_connection.is_connected:
+                    REDIS_DISCONNECTS.inc('closed')
+                    self.state = self.state_map[self.DISCONNECTED]
                 sleep_interval = 4
 
             # logging.debug('%s sleep(%d)', self.state, sleep_interval)
             yield gen.sleep(sleep_interval)
 
         logging.info('redis client stopped')
+
+
+class LocalCache:
+    """
+        L1 кэш в памяти процесса перед redis
+
+        LRU с ограничением по суммарному размеру записей в байтах,
+        у каждой записи свой TTL. Размер записи считает вызывающий,
+        хранить можно что угодно, например уже разобранный HTTPResponse.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, key_ttl=5):
+        self.max_bytes = max_bytes
+        self.key_ttl = key_ttl
+        self.size = 0
+        # key -> (expires_at, size, value), в конце самые свежие
+        self._entries = OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expired': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        expires_at, size, value = entry
+        if expires_at <= time():
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            self.delete(key)
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return value
+
+    def set(self, key, value, size, key_ttl=None):
+        """
+            key_ttl ограничивается сверху self.key_ttl
+        """
+        self.delete(key)
+        if size > self.max_bytes:
+            return
+
+        ttl = self.key_ttl if key_ttl is None else min(key_ttl, self.key_ttl)
+        if ttl <= 0:
+            return
+
+        self._entries[key] = (time() + ttl, size, value)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self.stats['evictions'] += 1
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
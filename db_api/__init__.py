@@ -1,8 +1,18 @@
 from .exceptions import (  # noqa
     DBApiError,
+    CacheFormatError,
+    StreamAborted,
 )
+from .balancer import Backend, BackendPool, CircuitBreaker  # noqa
 from .direct_api import DBApiDirect  # noqa
-from .cached_api import DBApiCached  # noqa
+from .tag_rules import TagRules  # noqa
+from .refresh_ahead import CountMinSketch, RefreshAhead  # noqa
+from .warmup import CacheWarmer, urls_from_access_log  # noqa
+from .cached_api import (  # noqa
+    DBApiCached,
+    CacheMetaDataValidator,
+    SharedCacheMetaDataValidator,
+)
 
 
 def get_db_api(is_cached=True):
@@ -0,0 +1,321 @@
+import logging
+import socket
+from collections import deque
+from math import exp
+from random import choice, random
+from urllib.parse import urlsplit, urlunsplit
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .exceptions import DBApiError
+
+
+class CircuitBreaker:
+    """
+        Автомат closed -> open -> half_open -> closed для одного адреса
+
+        closed    - запросы идут, считаем результаты последних window
+                    запросов и подряд идущие timeout (599: база не
+                    ответила - таймаут или отказ соединения)
+        open      - max_failures timeout подряд или доля ошибок от
+                    error_rate среди последних window (не меньше
+                    min_requests); запросы на адрес не идут open_timeout
+                    секунд
+        half_open - пропускаем один пробный запрос: успех закрывает
+                    автомат, ошибка снова открывает
+    """
+    (CLOSED, OPEN, HALF_OPEN) = ('closed', 'open', 'half_open')
+
+    def __init__(self, max_failures=3, error_rate=0.5, window=20,
+                 min_requests=10, open_timeout=5.0, name=''):
+        self.max_failures = max_failures
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.open_timeout = open_timeout
+        self.name = name
+
+        self.state = self.CLOSED
+        self._results = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at = None
+        self._probe = False
+
+        # сколько раз автомат переходил в каждое состояние
+        self.transitions = {
+            self.CLOSED: 0,
+            self.OPEN: 0,
+            self.HALF_OPEN: 0,
+        }
+
+    def _switch(self, state):
+        logging.warning('circuit %s: %s -> %s', self.name, self.state, state)
+        self.state = state
+        self.transitions[state] += 1
+
+        if state == self.OPEN:
+            self._opened_at = IOLoop.current().time()
+        elif state == self.HALF_OPEN:
+            self._probe = False
+        else:
+            self._results.clear()
+            self._failures = 0
+
+    def _open_expired(self):
+        return IOLoop.current().time() - self._opened_at >= self.open_timeout
+
+    @property
+    def available(self):
+        """
+            Можно ли выбрать адрес, не занимая пробный запрос
+        """
+        if self.state == self.OPEN:
+            return self._open_expired()
+        if self.state == self.HALF_OPEN:
+            return not self._probe
+        return True
+
+    def allow(self):
+        """
+            Пропустить ли запрос прямо сейчас
+        """
+        if self.state == self.OPEN:
+            if not self._open_expired():
+                return False
+            self._switch(self.HALF_OPEN)
+
+        if self.state == self.HALF_OPEN:
+            if self._probe:
+                return False
+            self._probe = True
+
+        return True
+
+    def record(self, error=False, timeout=False):
+        if self.state == self.HALF_OPEN:
+            self._switch(self.OPEN if error else self.CLOSED)
+            return
+        if self.state == self.OPEN:
+            # ответы на запросы, ушедшие до открытия
+            return
+
+        self._results.append(error)
+        self._failures = self._failures + 1 if timeout else 0
+
+        if self._failures >= self.max_failures:
+            self._switch(self.OPEN)
+        elif len(self._results) >= self.min_requests and \
+                sum(self._results) >= self.error_rate * len(self._results):
+            self._switch(self.OPEN)
+
+
+class Backend:
+    """
+        Один адрес DB API и его статистика
+
+        inflight - запросов в полете прямо сейчас
+        ewma     - задержка, сглаженная по времени (peak EWMA: рост
+                   задержки учитывается сразу, спад - постепенно),
+                   до первого ответа не измерена (measured=False)
+        breaker  - CircuitBreaker или None
+    """
+
+    def __init__(self, host, port, decay=10.0, breaker=None):
+        self.host = host
+        self.port = port
+        self.decay = decay
+        self.breaker = breaker
+
+        self.inflight = 0
+        self.ewma = 0.0
+        self._updated = None
+
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'fail_fast': 0,
+        }
+
+    @property
+    def available(self):
+        return self.breaker is None or self.breaker.available
+
+    def allow(self):
+        if self.breaker is None or self.breaker.allow():
+            return True
+        self.stats['fail_fast'] += 1
+        return False
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    @property
+    def measured(self):
+        return self._updated is not None
+
+    def url(self, url):
+        """
+            url запроса с адресом этого backend
+        """
+        return urlunsplit(urlsplit(url)._replace(netloc='%s:%s' % self.address))
+
+    def start(self):
+        self.inflight += 1
+        self.stats['requests'] += 1
+
+    def finish(self, latency, error=False, timeout=False):
+        self.inflight -= 1
+        if error:
+            self.stats['errors'] += 1
+        if self.breaker is not None:
+            self.breaker.record(error=error, timeout=timeout)
+
+        now = IOLoop.current().time()
+        if self._updated is None or latency > self.ewma:
+            self.ewma = latency
+        else:
+            w = exp(-(now - self._updated) / self.decay)
+            self.ewma = self.ewma * w + latency * (1 - w)
+        self._updated = now
+
+    def __repr__(self):
+        return '<Backend %s:%s inflight=%d ewma=%.4f>' % (
+            self.host, self.port, self.inflight, self.ewma,
+        )
+
+
+class BackendPool:
+    """
+        Набор адресов DB API и выбор адреса под запрос
+
+        backends - статический список (host, port),
+        dns      - (host, port), адреса которого берутся из resolver
+                   (кэширует ответы сам, см. resolver.Resolver).
+
+        strategy:
+            least_outstanding - меньше всего запросов в полете
+            ewma              - меньше ewma * (inflight + 1); у адреса без
+                                ответов ewma считаем равной худшей из
+                                известных, иначе новый или зависший адрес
+                                с нулевой ewma забирает все запросы
+            random            - как раньше, случайный адрес
+        Среди равных - меньше запросов в полете, дальше случайно, чтобы
+        не грузить первый адрес при холодном старте.
+
+        breaker - параметры CircuitBreaker для каждого адреса; адреса
+        с открытым автоматом не выбираются, а если открыты все, запрос
+        сразу завершается ошибкой (см. DBApiDirect._http_fetch)
+    """
+    STRATEGIES = ('least_outstanding', 'ewma', 'random')
+    # ewma адресов без ответов, пока ни один адрес не ответил
+    UNKNOWN_LATENCY = 1.0
+
+    def __init__(self, backends=None, dns=None, resolver=None,
+                 strategy='ewma', decay=10.0, breaker=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('unknown balancer strategy %r' % strategy)
+        if not backends and dns is None:
+            raise ValueError('no backends for BackendPool')
+        if dns is not None and resolver is None:
+            raise ValueError('resolver is required for dns backends')
+
+        self.strategy = strategy
+        self.decay = decay
+        self.breaker = breaker
+        self.dns = dns
+        self._resolver = resolver
+
+        self.backends = {}
+        self._static = [self._backend(host, port) for host, port in backends or []]
+        self._active = list(self._static)
+
+    def _backend(self, host, port):
+        address = (host, int(port))
+        backend = self.backends.get(address)
+        if backend is None:
+            breaker = None
+            if self.breaker is not None:
+                breaker = CircuitBreaker(name='%s:%s' % address, **self.breaker)
+            backend = self.backends[address] = Backend(
+                host, int(port), decay=self.decay, breaker=breaker,
+            )
+        return backend
+
+    @gen.coroutine
+    def refresh(self):
+        """
+            Обновляет адреса из DNS (для статического списка - ничего)
+        """
+        if self.dns is None:
+            return
+        try:
+            addresses = yield self._resolver.resolve(*self.dns, family=socket.AF_INET)
+        except Exception as e:
+            if self._active:
+                logging.warning(
+                    'resolve %s:%s failed, keep old backends: %s', self.dns[0], self.dns[1], e,
+                )
+                return
+            raise DBApiError(e)
+
+        active = list(self._static)
+        for _, (host, port) in addresses:
+            backend = self._backend(host, port)
+            if backend not in active:
+                active.append(backend)
+        self._active = active
+
+        # адреса, пропавшие из DNS, забываем, когда на них ничего не летит
+        for address, backend in list(self.backends.items()):
+            if backend not in active and not backend.inflight:
+                del self.backends[address]
+
+    def _score(self, backend, unknown_latency):
+        if self.strategy == 'least_outstanding':
+            return backend.inflight
+        latency = backend.ewma if backend.measured else unknown_latency
+        return latency * (backend.inflight + 1)
+
+    @gen.coroutine
+    def choose(self):
+        yield self.refresh()
+        return self.pick()  # noqa
+
+    def pick(self):
+        """
+            Выбор из уже известных адресов, без ожидания DNS: вызвавший
+            занимает слот (backend.start()) без переключений, и пачка
+            одновременных запросов не уходит на один адрес
+        """
+        if not self._active:
+            raise DBApiError('no backends for %s:%s' % self.dns)
+
+        candidates = [backend for backend in self._active if backend.available]
+        if not candidates:
+            # все выброшены: любой адрес, запрос к нему сразу вернет ошибку
+            candidates = self._active
+
+        if self.strategy == 'random':
+            return choice(candidates)
+
+        known = [backend.ewma for backend in candidates if backend.measured]
+        unknown_latency = max(known) if known else self.UNKNOWN_LATENCY
+        return min(candidates, key=lambda backend: (
+            self._score(backend, unknown_latency), backend.inflight, random(),
+        ))
+
+    def stats(self):
+        stats = {}
+        for backend in self.backends.values():
+            stats['%s:%s' % backend.address] = dict(
+                backend.stats,
+                inflight=backend.inflight,
+                ewma=backend.ewma,
+            )
+            if backend.breaker is not None:
+                stats['%s:%s' % backend.address].update(
+                    state=backend.breaker.state,
+                    transitions=dict(backend.breaker.transitions),
+                )
+        return stats
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import re
+import struct
+
+from .exceptions import CacheFormatError
+
+
+MAGIC = b'\xcbE'
+VERSION = 1
+
+# magic, version, code, длина заголовка
+_PREFIX = struct.Struct('>2sBHI')
+
+_ETAG_RE = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+
+def content_etag(body):
+    """
+        Сильный ETag по содержимому тела
+    """
+    return '"%s"' % hashlib.sha1(body or b'').hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """
+        Совпадает ли etag с одним из тэгов If-None-Match
+        (слабое сравнение, как в tornado)
+    """
+    if not if_none_match or not etag:
+        return False
+    for tag in _ETAG_RE.findall(if_none_match):
+        if tag == '*' or tag[2:] == etag or tag == etag:
+            return True
+    return False
+
+
+def pack_entry(meta, url, code, headers, body):
+    """
+        Бинарная запись кэша:
+
+        +-------+---------+------+------------+--------------+-------------+
+        | magic | version | code | header_len | header(json) | body        |
+        | 2     | 1       | 2    | 4          | header_len   | до конца    |
+        +-------+---------+------+------------+--------------+-------------+
+
+        header - {'__meta__': meta, 'url': url, 'headers': headers},
+        тело лежит как есть, без декодирования и экранирования
+    """
+    header = json.dumps({
+        '__meta__': meta,
+        'url': url,
+        'headers': headers,
+    }).encode()
+    return b''.join([
+        _PREFIX.pack(MAGIC, VERSION, code, len(header)),
+        header,
+        body or b'',
+    ])
+
+
+def _unpack_header(value):
+    if value[:1] == b'{':
+        return None, None
+
+    if len(value) < _PREFIX.size:
+        raise CacheFormatError('cache entry is too short')
+
+    magic, version, code, header_len = _PREFIX.unpack_from(value)
+    if magic != MAGIC or version != VERSION:
+        raise CacheFormatError('unknown cache entry format %r v%d' % (magic, version))
+
+    offset = _PREFIX.size + header_len
+    header = json.loads(bytes(value[_PREFIX.size:offset]).decode())
+    header['code'] = code
+    header['version'] = version
+    return header, offset
+
+
+def unpack_entry(value, accept=None):
+    """
+        Возвращает dict с __meta__, url, code, headers, body и version.
+        body - memoryview на исходный буфер, без копирования.
+
+        accept(meta) проверяет метаданные раньше, чем трогаем тело:
+        если False - запись не нужна, вернется None.
+
+        Старые записи (json с телом-строкой) тоже читаются, у них version 0.
+    """
+    header, offset = _unpack_header(value)
+    if header is None:
+        data = json.loads(bytes(value).decode())
+        if accept is not None and not accept(data['__meta__']):
+            return None
+        data['body'] = memoryview(data['body'].encode())
+        data['version'] = 0
+        return data
+
+    if accept is not None and not accept(header['__meta__']):
+        return None
+    header['body'] = memoryview(value)[offset:]
+    return header
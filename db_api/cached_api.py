@@ -1,8 +1,11 @@
 import logging
 from pprint import pprint as pp  # noqa
-from io import BytesIO
+from math import log
+from random import random
 from time import time
 from collections import OrderedDict
+from copy import copy
+from functools import partial
 from urllib.parse import (
     urlparse,
     parse_qsl,
@@ -11,11 +14,40 @@ from urllib.parse import (
 
 import json
 
+from tornado.concurrent import Future, chain_future
 from tornado.httpclient import HTTPRequest, HTTPResponse
 from tornado.httputil import HTTPHeaders
+from tornado.ioloop import IOLoop
 from tornado import gen
 
+from async_redis import RedisError
+from metrics import REGISTRY
+from timing import span
 from . import DBApiDirect
+from .cache_format import content_etag, etag_matches, pack_entry, unpack_entry
+from .tag_rules import TagRules
+
+
+CACHE_REQUESTS = REGISTRY.counter(
+    'db_api_cache_requests_total', 'DB API requests by cache outcome', ['route', 'outcome'],
+)
+
+# _get_response еще не читал кэш (None - прочитал, записи нет)
+NOT_LOADED = object()
+
+
+class _BodyBuffer:
+    """
+        buffer для HTTPResponse: body - memoryview на значение из
+        redis, как есть, без копии в BytesIO
+    """
+    __slots__ = ('body', )
+
+    def __init__(self, body):
+        self.body = body
+
+    def getvalue(self):
+        return self.body
 
 
 class CacheMetaDataValidator:
@@ -101,6 +133,11 @@ class CacheMetaDataValidator:
         create: "12:00" => считаем запись не валидной
 
         перезапрашиваем базу
+
+        Какие тэги у какого url задается правилами TagRules
+        (DB_API.TAG_RULES в config.yaml). Без правил работает
+        как раньше: тэг - сегмент пути из URL_TAGS; main.py так же
+        размечает пути, к которым не подошло ни одно правило.
     """
 
     URL_TAGS = [
@@ -109,22 +146,31 @@ class CacheMetaDataValidator:
         'tag',
     ]
 
-    def __init__(self):
+    def __init__(self, tag_rules=None):
         self.forget_everything_before = {
         }
+        if tag_rules is None:
+            tag_rules = self.url_tag_rules()
+        self.tag_rules = tag_rules
+
+    @classmethod
+    def url_tag_rules(cls):
+        """
+            Правила без настройки: тэг - сегмент пути из URL_TAGS
+        """
+        return TagRules([
+            {'pattern': '/**/%s/**' % tag, 'tags': [tag]}
+            for tag in cls.URL_TAGS
+        ])
 
     def _get_tags_from_request(self, request):
-        tags = []
-
-        url_path = urlparse(request.url).path
-        url_path_list = url_path.split('/')
-
-        for tag in self.URL_TAGS:
-            if tag in url_path_list:
-                tags.append(tag)
-
+        tags, _ = self.tag_rules.match(urlparse(request.url).path)
         return tags
 
+    def _get_invalidation_tags_from_request(self, request):
+        tags, invalidates = self.tag_rules.match(urlparse(request.url).path)
+        return tags + [tag for tag in invalidates if tag not in tags]
+
     def create(self, data, response):
         tags = self._get_tags_from_request(response.request)
 
@@ -135,8 +181,14 @@ class CacheMetaDataValidator:
 
     def is_valid(self, data):
         try:
-            cache_value_created = float(data['__meta__']['created'])
-            tags = data['__meta__']['tags']
+            return self.is_valid_meta(data['__meta__'])
+        except KeyError:
+            return False
+
+    def is_valid_meta(self, meta):
+        try:
+            cache_value_created = float(meta['created'])
+            tags = meta['tags']
         except KeyError:
             return False
 
@@ -151,15 +203,190 @@ class CacheMetaDataValidator:
             self.forget_everything_before[tag] = time()
 
     def process_request(self, request):
+        """
+            Возвращает список забытых тэгов
+        """
         if request.method in ['POST', 'PUT', 'PATCH', 'DELETE']:
-            tags = self._get_tags_from_request(request)
+            tags = self._get_invalidation_tags_from_request(request)
             self.forget_it(tags)
+            return tags
+        return []
+
+
+class SharedCacheMetaDataValidator(CacheMetaDataValidator):
+    """
+        forget_everything_before, общий для всех процессов и хостов
+
+        forget_it пишет метку в sorted set redis (member - тэг,
+        score - время) и публикует ее в канал. Каждый процесс подписан
+        на канал и обновляет свою копию словаря, поэтому is_valid
+        по-прежнему проверяется в памяти без похода в redis.
+
+        При (пере)подключении подписки копия перечитывается из sorted
+        set целиком. Метки старше max_age выбрасываются: записей
+        старше этого в кэше уже нет.
+
+        cache - cache.RedisCache, run() надо запустить в IOLoop
+    """
+    KEY = 'cache:forget_everything_before'
+    CHANNEL = 'cache:forget'
+
+    def __init__(self, cache, max_age=3600, poll_interval=1, tag_rules=None):
+        super().__init__(tag_rules=tag_rules)
+        self.cache = cache
+        self.max_age = max_age
+        self.poll_interval = poll_interval
+        self.is_running = True
+
+        self._pubsub = None
+        self._synced = False
+        # метки, которые еще не удалось отправить в redis
+        self._unpublished = {}
+
+    def forget_it(self, tags):
+        super().forget_it(tags)
+        for tag in tags:
+            self._unpublished[tag] = self.forget_everything_before[tag]
+        IOLoop.current().add_future(self._publish(), lambda f: f.result())
+
+    def _update(self, mapping):
+        for tag, created in mapping.items():
+            if created > self.forget_everything_before.get(tag, 0):
+                self.forget_everything_before[tag] = created
+
+    def _prune(self):
+        oldest = time() - self.max_age
+        self.forget_everything_before = {
+            tag: created for tag, created in self.forget_everything_before.items()
+            if created > oldest
+        }
+
+    def _on_message(self, channel, data):
+        try:
+            self._update(json.loads(data.decode()))
+        except ValueError:
+            logging.error('bad invalidation message %r', data)
+
+    @gen.coroutine
+    def _publish(self):
+        if not self._unpublished:
+            return
+
+        mapping, self._unpublished = self._unpublished, {}
+        zadd = ['ZADD', self.KEY]
+        for tag, created in mapping.items():
+            zadd += [created, tag]
+
+        res = yield self.cache.pipeline([
+            zadd,
+            ('ZREMRANGEBYSCORE', self.KEY, '-inf', time() - self.max_age),
+            ('PUBLISH', self.CHANNEL, json.dumps(mapping)),
+        ])
+        if res is None:
+            # redis недоступен, отправим из run() после переподключения
+            for tag, created in mapping.items():
+                self._unpublished[tag] = max(created, self._unpublished.get(tag, 0))
+
+    @gen.coroutine
+    def _sync(self):
+        res = yield self.cache.pipeline([
+            ('ZRANGE', self.KEY, 0, -1, 'WITHSCORES'),
+        ])
+        if res is None:
+            return False  # noqa
+
+        values = res[0]
+        self._update({
+            tag.decode(): float(created)
+            for tag, created in zip(values[::2], values[1::2])
+        })
+        return True  # noqa
+
+    def stop(self):
+        self.is_running = False
+        if self._pubsub is not None:
+            self._pubsub.disconnect()
+
+    @gen.coroutine
+    def run(self):
+        logging.info('cache invalidation listener start')
+        while self.is_running:
+            if self._pubsub is None or not self._pubsub.is_connected:
+                self._synced = False
+                self._pubsub = self.cache.create_connection()
+                try:
+                    yield self._pubsub.connect()
+                    yield self._pubsub.subscribe([self.CHANNEL], self._on_message)
+                except RedisError:
+                    self._pubsub.disconnect()
+                    logging.info('cache invalidation listener can"t connect')
+
+            if self._pubsub.is_connected:
+                if not self._synced:
+                    self._synced = yield self._sync()
+                yield self._publish()
+
+            self._prune()
+            yield gen.sleep(self.poll_interval)
+
+        logging.info('cache invalidation listener stopped')
 
 
 class DBApiCached(DBApiDirect):
     """
         Добавляет кэширование к DBApiDirect
+
+        Возраст записи считается от __meta__['created']:
+
+        age < cache_key_ttl                      FRESH - отдаем из кэша,
+                                                 кроме раннего истечения
+        age < cache_key_ttl + cache_stale_ttl    STALE - отдаем из кэша и
+                                                 обновляем запись в фоне
+        age < cache_key_ttl + cache_stale_if_error
+                                                 отдаем из кэша только если
+                                                 база не ответила (599, 5xx)
+
+        Раннее истечение (XFetch): в __meta__['delta'] лежит, сколько
+        секунд база отвечала на этот запрос. Свежая запись считается
+        истекшей (EARLY: отдаем из кэша и обновляем в фоне), если
+
+            age - delta * cache_xfetch_beta * log(random()) >= cache_key_ttl
+
+        Вероятность растет к концу cache_key_ttl и тем раньше, чем
+        дороже запрос, поэтому из всех воркеров, читающих ключ, обычно
+        только один обновляет его заранее, а не все в момент истечения.
+        cache_xfetch_beta=0 выключает, больше 1 - обновлять раньше.
+
+        Запись, отвергнутая CacheMetaDataValidator (был POST/PUT/...),
+        считается устаревшей и годится только на случай ошибки базы.
+        В redis запись живет cache_key_ttl + max(stale_ttl, stale_if_error).
+
+        local_cache (cache.LocalCache) - необязательный L1 в памяти
+        процесса, хранит уже разобранные HTTPResponse.
+
+        cache_meta_data - CacheMetaDataValidator, по умолчанию свой
+        на процесс, для нескольких воркеров SharedCacheMetaDataValidator
+
+        cache_active_invalidation - кроме ленивой проверки по тэгам
+        сразу удалять из redis записи с забытыми тэгами. Для этого
+        каждый ключ при записи регистрируется в индексах тэгов
+        (sorted set TAG_INDEX_PREFIX + tag, score - когда ключ истечет).
+        Истекшие ключи вычищаются из индекса при каждой записи в него,
+        а сам индекс живет не дольше самого свежего ключа в нем.
+
+        ETag: при записи в кэш от тела считается хеш (__meta__['etag']),
+        с ним request(..., if_none_match=...) отвечает 304 без тела.
+        Если у записи есть ETag/Last-Modified от базы, устаревшую
+        запись обновляем условным запросом: на 304 база не шлет тело,
+        а мы только продлеваем запись.
+
+        refresh_ahead - необязательный RefreshAhead: популярные ключи
+        обновляются в фоне незадолго до конца cache_key_ttl, пока
+        запись еще свежая, и никто не ждет базу.
     """
+    TAG_INDEX_PREFIX = 'cache:tag:'
+    DELETE_BATCH_SIZE = 256
+    (FRESH, EARLY, STALE, EXPIRED) = ('fresh', 'early', 'stale', 'expired')
 
     def __init__(self, *args, **kwargs):
         self.cache = kwargs.pop('cache', None)
@@ -167,8 +394,35 @@ class DBApiCached(DBApiDirect):
             raise TypeError('cache is required parameter for %s' % self.__class__)
 
         self.cache_key_ttl = kwargs.pop('cache_key_ttl', 3)
-
-        self.cache_meta_data = CacheMetaDataValidator()
+        self.cache_stale_ttl = kwargs.pop('cache_stale_ttl', 0)
+        self.cache_stale_if_error = kwargs.pop('cache_stale_if_error', 0)
+        self.cache_xfetch_beta = kwargs.pop('cache_xfetch_beta', 1.0)
+        self.local_cache = kwargs.pop('local_cache', None)
+        self.cache_active_invalidation = kwargs.pop('cache_active_invalidation', False)
+        self.refresh_ahead = kwargs.pop('refresh_ahead', None)
+
+        self.cache_meta_data = kwargs.pop('cache_meta_data', None)
+        tag_rules = kwargs.pop('tag_rules', None)
+        if self.cache_meta_data is None:
+            self.cache_meta_data = CacheMetaDataValidator(tag_rules=tag_rules)
+
+        # cache key -> future запроса в базу, который уже в полете
+        self._inflight = {}
+        # cache key -> устаревшая запись, с которой ушел запрос из
+        # _inflight: ждущие его отдадут ее, если база не ответит
+        self._inflight_cached = {}
+        # ключи, которые обновляются в фоне (stale-while-revalidate)
+        self._refreshing = set()
+        self.stats = {
+            'upstream_fetches': 0,
+            'coalesced': 0,
+            'stale_served': 0,
+            'stale_on_error': 0,
+            'early_refreshes': 0,
+            'revalidated': 0,
+            'background_refreshes': 0,
+            'purged_keys': 0,
+        }
 
         super().__init__(*args, **kwargs)
 
@@ -189,22 +443,46 @@ class DBApiCached(DBApiDirect):
     def _serialize_to_cache(self, response):
         data = {}
         self.cache_meta_data.create(data, response)
+        # время ответа базы для раннего истечения
+        data['__meta__']['delta'] = round(getattr(response, 'request_time', None) or 0, 4)
+        # тело не менялось (304 от базы) - хеш уже есть
+        old_meta = getattr(response, 'cache_meta', None) or {}
+        data['__meta__']['etag'] = old_meta.get('etag') or content_etag(response.body)
+        response.cache_meta = data['__meta__']
+
+        return pack_entry(
+            data['__meta__'],
+            response.request.url,
+            response.code,
+            list(response.headers.get_all()),
+            response.body,
+        )
 
-        data['url'] = response.request.url
-        data['code'] = response.code
-        data['headers'] = list(response.headers.get_all())
-        data['body'] = response.body.decode()
-
-        return json.dumps(data)
+    @property
+    def _redis_key_ttl(self):
+        return self.cache_key_ttl + max(self.cache_stale_ttl, self.cache_stale_if_error)
+
+    def _is_usable(self, meta):
+        """
+            Нужна ли запись хоть на что-то: отдать из кэша, обновить
+            условным запросом или отдать, если база не ответит
+        """
+        age = time() - float(meta['created'])
+        if age >= self._redis_key_ttl:
+            return False
+        return self.cache_meta_data.is_valid_meta(meta) or self._can_serve_on_error(age)
 
     def _deserialize_from_cache(self, value):
-        data = json.loads(value.decode())
-
-        if not self.cache_meta_data.is_valid(data):
-            logging.debug('cache is expired!')
-            return None
-
+        """
+            Метаданные записи кладем в response.cache_meta. Их проверяем
+            до тела: ненужную запись не собираем в HTTPResponse.
+            body ответа - memoryview на value
+        """
         try:
+            data = unpack_entry(value, accept=self._is_usable)
+            if data is None:
+                return None
+
             headers = HTTPHeaders()
             for k, v in data['headers']:
                 headers.add(k, v)
@@ -213,32 +491,430 @@ class DBApiCached(DBApiDirect):
                 HTTPRequest(url=data['url']),
                 int(data['code']),
                 headers,
-                buffer=BytesIO(data['body'].encode()),
+                buffer=_BodyBuffer(data['body']),
             )
-        except KeyError:
+            # в бинарном формате лежат только проверенные JSON ответы
+            response.json_checked = data['version'] > 0
+            response.cache_meta = {
+                'created': float(data['__meta__']['created']),
+                'tags': data['__meta__']['tags'],
+                'delta': float(data['__meta__'].get('delta', 0)),
+                'etag': data['__meta__'].get('etag'),
+            }
+        except (KeyError, ValueError):
+            # CacheFormatError тоже ValueError
             return None
 
         return response
 
+    def _cache_state(self, meta):
+        """
+            Возвращает (FRESH/STALE/EXPIRED, возраст записи)
+        """
+        age = time() - float(meta['created'])
+
+        if not self.cache_meta_data.is_valid_meta(meta):
+            logging.debug('cache is expired!')
+            return self.EXPIRED, age
+        if age < self.cache_key_ttl:
+            delta = float(meta.get('delta', 0)) * self.cache_xfetch_beta
+            # 1 - random() в (0, 1], log от нуля не бывает
+            if delta and age - delta * log(1 - random()) >= self.cache_key_ttl:
+                return self.EARLY, age
+            return self.FRESH, age
+        if age < self.cache_key_ttl + self.cache_stale_ttl:
+            return self.STALE, age
+        return self.EXPIRED, age
+
+    def _save_local_cache_response(self, key, response):
+        if self.local_cache is None:
+            return
+        # в L1 запись не должна пережить себя в redis
+        ttl = float(response.cache_meta['created']) + self._redis_key_ttl - time()
+        size = len(response.body or b'') + sum(
+            len(k) + len(v) for k, v in response.headers.get_all()
+        )
+        # без запроса клиента: его колбэки стрима и timing держали бы
+        # в памяти давно завершенный обработчик
+        entry = HTTPResponse(
+            HTTPRequest(url=response.request.url, method=response.request.method),
+            response.code,
+            response.headers,
+            buffer=_BodyBuffer(response.body),
+            reason=response.reason,
+        )
+        entry.json_checked = getattr(response, 'json_checked', False)
+        entry.cache_meta = response.cache_meta
+        self.local_cache.set(key, entry, size, ttl)
+
+    @gen.coroutine
     def _load_cache_response(self, request):
         if request.method == 'GET':
             key = self._generate_cache_key(request)
-            if self.cache.exists(key):
-                value = self.cache.get(key)
-                return self._deserialize_from_cache(value)
+            if self.local_cache is not None:
+                with span(request.timing, 'l1'):
+                    response = self.local_cache.get(key)
+                if response is not None:
+                    return response  # noqa
+
+            with span(request.timing, 'redis'):
+                value = yield self.cache.get(key)
+            if value is not None:
+                with span(request.timing, 'deserialize'):
+                    response = self._deserialize_from_cache(value)
+                if response is not None:
+                    self._save_local_cache_response(key, response)
+                return response  # noqa
         return None
 
+    @gen.coroutine
+    def _load_batch(self, items, timing=None):
+        """
+            Записи кэша для всех GET батча: сначала L1, остальное
+            одним MGET
+        """
+        keys = [
+            self._generate_cache_key(
+                self._create_http_request('GET', self.host, self.port, path, params=params),
+            )
+            for path, params in items
+        ]
+        responses = [None] * len(keys)
+        if self.local_cache is not None:
+            with span(timing, 'l1'):
+                responses = [self.local_cache.get(key) for key in keys]
+
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            with span(timing, 'redis'):
+                values = yield self.cache.get_many([keys[i] for i in missing])
+            with span(timing, 'deserialize'):
+                # None - redis отвалился посреди запроса
+                for i, value in zip(missing, values or []):
+                    if value is not None:
+                        responses[i] = self._deserialize_from_cache(value)
+                        if responses[i] is not None:
+                            self._save_local_cache_response(keys[i], responses[i])
+
+        return [{'cached': response} for response in responses]  # noqa
+
+    @staticmethod
+    def _check_json(response):
+        if not getattr(response, 'json_checked', False):
+            try:
+                if response.body:
+                    json.loads(str(response.body, 'utf-8'))
+            except ValueError:
+                return False
+            response.json_checked = True
+        return True
+
+    @gen.coroutine
     def _save_cache_response(self, response):
-        if response.request.method == 'GET' and response.code == 200:
+        # запись всегда перезаписываем: устаревшая копия может
+        # еще лежать в redis ради stale-while-revalidate.
+        # JSON проверяем здесь один раз, дальше тело отдается как есть
+        if (response.request.method == 'GET' and response.code == 200 and
+                self._check_json(response)):
             key = self._generate_cache_key(response.request)
-            if not self.cache.exists(key):
-                value = self._serialize_to_cache(response)
-                self.cache.set(key, value, self.cache_key_ttl)
+            value = self._serialize_to_cache(response)
+            self._save_local_cache_response(key, response)
+            yield self.cache.set(key, value, self._redis_key_ttl)
+            if self.cache_active_invalidation:
+                # индекс тэгов не ждем, как и _purge_tags
+                IOLoop.current().add_future(
+                    self._index_cache_key(key, response.cache_meta['tags']), lambda f: f.result(),
+                )
         return None
 
+    @gen.coroutine
+    def _index_cache_key(self, key, tags):
+        if not tags:
+            return
+        now = time()
+        commands = []
+        for tag in tags:
+            index = self.TAG_INDEX_PREFIX + tag
+            commands += [
+                ('ZADD', index, now + self._redis_key_ttl, key),
+                ('ZREMRANGEBYSCORE', index, '-inf', now),
+                ('EXPIRE', index, self._redis_key_ttl),
+            ]
+        yield self.cache.pipeline(commands)
+
+    @gen.coroutine
+    def _purge_tags(self, tags):
+        """
+            Удаляет из redis (и L1) все ключи с тэгами tags
+        """
+        indexes = [self.TAG_INDEX_PREFIX + tag for tag in tags]
+        res = yield self.cache.pipeline([
+            ('ZRANGE', index, 0, -1) for index in indexes
+        ])
+        if res is None:
+            return
+
+        keys = list(set(key for members in res for key in members))
+        if self.local_cache is not None:
+            for key in keys:
+                self.local_cache.delete(key.decode())
+
+        commands = [
+            ['DEL'] + keys[i:i + self.DELETE_BATCH_SIZE]
+            for i in range(0, len(keys), self.DELETE_BATCH_SIZE)
+        ]
+        commands.append(['DEL'] + indexes)
+        yield self.cache.pipeline(commands)
+        self.stats['purged_keys'] += len(keys)
+
+    @staticmethod
+    def _add_validators(request, cached):
+        """
+            Условный запрос по ETag/Last-Modified, которые база
+            прислала вместе с закэшированной записью
+        """
+        etag = cached.headers.get('Etag')
+        if etag:
+            request.headers['If-None-Match'] = etag
+        last_modified = cached.headers.get('Last-Modified')
+        if last_modified:
+            request.headers['If-Modified-Since'] = last_modified
+        return bool(etag or last_modified)
+
+    @staticmethod
+    def _merge_headers(stored, fresh):
+        """
+            Заголовки записи, обновленные заголовками 304: что пришло
+            в 304, заменяет старое, кроме заголовков про длину тела
+            и соединение - тело у 304 не передается
+        """
+        names = set(fresh) - {'Content-Length', 'Transfer-Encoding', 'Connection'}
+        headers = HTTPHeaders()
+        for name, value in stored.get_all():
+            if name not in names:
+                headers.add(name, value)
+        for name, value in fresh.get_all():
+            if name in names:
+                headers.add(name, value)
+        return headers
+
+    def _revalidated(self, request, cached, response):
+        """
+            База ответила 304: старое тело с новыми created и delta
+            и заголовками из 304 (ETag, Last-Modified, Cache-Control),
+            JSON заново не проверяем, хеш не пересчитываем
+        """
+        self.stats['revalidated'] += 1
+        revalidated = HTTPResponse(
+            request,
+            cached.code,
+            self._merge_headers(cached.headers, response.headers),
+            buffer=_BodyBuffer(cached.body),
+            request_time=response.request_time,
+        )
+        revalidated.json_checked = True
+        revalidated.cache_meta = cached.cache_meta
+        return revalidated
+
+    def _conditional(self, request, cached):
+        return (cached is not None and request.method == 'GET' and
+                self._add_validators(request, cached))
+
+    @gen.coroutine
+    def _fetch_and_save(self, request, cached=None):
+        self.stats['upstream_fetches'] += 1
+        conditional = self._conditional(request, cached)
+        response = yield self._http_fetch(request)
+        if conditional and response.code == 304:
+            response = self._revalidated(request, cached, response)
+        yield self._save_cache_response(response)
+        return response  # noqa
+
+    def _fetch(self, request, cached=None, stream=None):
+        """
+            Single-flight: одновременные GET с одинаковым ключом кэша
+            ждут один и тот же запрос в базу и делят его HTTPResponse
+
+            cached - устаревшая запись кэша для условного запроса,
+            stream - StreamProxy клиента, который ждет тело кусками:
+            если запрос ведущий и база ответила большим телом, оно
+            стримится только этому клиенту (см. _shared_stream)
+        """
+        if request.method != 'GET':
+            if stream is not None:
+                return self._fetch_stream(request, stream)
+            return self._fetch_and_save(request)
+
+        key = self._generate_cache_key(request)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return future
+
+        if stream is None:
+            future = shared = self._fetch_and_save(request, cached)
+        else:
+            future = self._fetch_stream(request, stream, cached)
+            shared = self._shared_stream(future, stream)
+        if not shared.done():
+            self._inflight[key] = shared
+            self._inflight_cached[key] = cached
+            shared.add_done_callback(lambda f: self._forget_inflight(key, f))
+        return future
+
+    @staticmethod
+    def _shared_stream(future, stream):
+        """
+            Future для ждущих запроса future, который стримит тело
+            клиенту: ответ с телом из stream.body или None, если тело
+            не влезло в tee_limit - тогда ждущие идут в базу сами,
+            не дожидаясь конца стрима
+        """
+        shared = Future()
+
+        def release():
+            if not shared.done():
+                shared.set_result(None)
+
+        def finish(f):
+            if shared.done():
+                return
+            if f.exception() is not None:
+                chain_future(f, shared)
+            elif stream.streaming and f.result().code == 200:
+                shared.set_result(stream.response(f.result()))
+            else:
+                shared.set_result(f.result())
+
+        stream.on_overflow = release
+        future.add_done_callback(finish)
+        return shared
+
+    def _forget_inflight(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+            self._inflight_cached.pop(key, None)
+        self._refreshing.discard(key)
+
+    @staticmethod
+    def _detached(request):
+        """
+            Копия запроса клиента для обновления в фоне: ответ клиенту
+            уже ушел из кэша, стримить тело базы в него нельзя
+        """
+        if request.header_callback is None and request.streaming_callback is None:
+            return request
+        detached = copy(request)
+        detached.headers = HTTPHeaders(request.headers)
+        detached.header_callback = None
+        detached.streaming_callback = None
+        return detached
+
+    def _refresh_in_background(self, request, cached=None):
+        key = self._generate_cache_key(request)
+        if key in self._inflight:
+            return
+        self.stats['background_refreshes'] += 1
+        future = self._fetch(self._detached(request), cached)
+        if key in self._inflight:
+            self._refreshing.add(key)
+        IOLoop.current().add_future(future, lambda f: f.result())
+        return future
+
+    def _refresh_ahead(self, request, key, hits, age, cached):
+        if key in self._inflight:
+            return
+        if not self.refresh_ahead.allow(hits, self.cache_key_ttl - age):
+            return
+        self.refresh_ahead.start()
+        future = self._refresh_in_background(request, cached)
+        future.add_done_callback(lambda f: self.refresh_ahead.finish())
+
+    @staticmethod
+    def _is_upstream_error(response):
+        return response.code == 599 or response.code >= 500
+
+    def _can_serve_on_error(self, age):
+        return age is not None and age < self.cache_key_ttl + self.cache_stale_if_error
+
+    @gen.coroutine
+    def _get_response(self, request, stream=None, cached=NOT_LOADED, limit=None):
+        """
+            Ответ из кэша или из базы через single-flight self._fetch
+
+            stream - StreamProxy, если клиент ждет тело кусками,
+            cached - запись кэша, если уже прочитана (батч),
+            limit - семафор на запросы в базу
+        """
+        tags = self.cache_meta_data.process_request(request)
+        if tags and self.cache_active_invalidation:
+            IOLoop.current().add_future(self._purge_tags(tags), lambda f: f.result())
+
+        response = None
+        age = None
+        key = self._generate_cache_key(request)
+        hits = None
+        if self.refresh_ahead is not None and request.method == 'GET':
+            hits = self.refresh_ahead.hit(key)
+        if cached is NOT_LOADED:
+            cached = None
+            if key not in self._inflight or key in self._refreshing:
+                cached = yield self._load_cache_response(request)
+            else:
+                # redis не читаем: на случай ошибки базы берем запись,
+                # с которой в базу пошел первый запрос
+                cached = self._inflight_cached.get(key)
+
+        outcome = 'miss'
+        if cached is not None:
+            state, age = self._cache_state(cached.cache_meta)
+            if state == self.FRESH:
+                outcome = 'hit'
+                response = cached
+                if hits is not None:
+                    self._refresh_ahead(request, key, hits, age, cached)
+            elif state == self.EARLY:
+                outcome = 'early'
+                self.stats['early_refreshes'] += 1
+                self._refresh_in_background(request, cached)
+                response = cached
+            elif state == self.STALE:
+                outcome = 'stale'
+                self.stats['stale_served'] += 1
+                self._refresh_in_background(request, cached)
+                response = cached
+
+        if not response:
+            if request.method != 'GET':
+                outcome = 'bypass'
+            elif key in self._inflight:
+                outcome = 'coalesced'
+            fetch = partial(self._fetch, cached=cached, stream=stream)
+            with span(request.timing, 'upstream'):
+                response = yield self._limited(limit, fetch, request)
+                while response is None:
+                    # тело ведущего запроса ушло только его клиенту
+                    response = yield self._limited(limit, fetch, request)
+            # часть тела уже у клиента: stale вместо него не отдать,
+            # обрыв увидит обработчик по stream.result
+            streamed = stream is not None and stream.streaming
+            if (self._is_upstream_error(response) and self._can_serve_on_error(age) and
+                    not streamed):
+                logging.warning('db api error %s, serve stale %s', response.code, key)
+                self.stats['stale_on_error'] += 1
+                outcome = 'stale_on_error'
+                response = cached
+
+        CACHE_REQUESTS.inc(self.route(urlparse(request.url).path), outcome)
+        return response  # noqa
+
+    def route(self, path):
+        return self.cache_meta_data.tag_rules.route(path)
+
     @gen.coroutine
     def _request(self, host, port, method, path,
-                 params=None, data=None, **kwargs):
+                 params=None, data=None, passthrough=False,
+                 cached=NOT_LOADED, limit=None, if_none_match=None, **kwargs):
 
         request = self._create_http_request(
             method,
@@ -252,16 +928,62 @@ class DBApiCached(DBApiDirect):
         )
         self._check_request(request)
 
-        self.cache_meta_data.process_request(request)
+        response = yield self._get_response(request, cached=cached, limit=limit)
+        return self._format_cached_output(request, response, passthrough, if_none_match)  # noqa
 
-        response = self._load_cache_response(request)
+    def _format_cached_output(self, request, response, passthrough, if_none_match):
+        etag = None
+        if response.code == 200:
+            etag = (getattr(response, 'cache_meta', None) or {}).get('etag')
+        if etag_matches(if_none_match, etag):
+            # у клиента та же версия, тело не разбираем и не собираем
+            return {'code': 304, 'headers': [], 'etag': etag}
 
-        if not response:
-            response = yield self._http_client.fetch(
-                request,
-                raise_error=False,
-            )
-            self._save_cache_response(response)
+        with span(request.timing, 'format'):
+            data = self._format_output(response, passthrough)
+        if etag:
+            data['etag'] = etag
+        return data
+
+    @gen.coroutine
+    def _fetch_stream(self, request, stream, cached=None):
+        """
+            Ответ, который не стримился, кэшируем как обычно,
+            стримленный - только если целиком влез в stream.tee_limit
+        """
+        self.stats['upstream_fetches'] += 1
+        conditional = self._conditional(request, cached)
+        response = yield super()._fetch_stream(request, stream)
+        if conditional and response.code == 304:
+            response = self._revalidated(request, cached, response)
+            yield self._save_cache_response(response)
+        elif not stream.streaming:
+            yield self._save_cache_response(response)
+        elif response.code == 200 and stream.body is not None:
+            yield self._save_cache_response(stream.response(response))
+        return response  # noqa
+
+    @gen.coroutine
+    def _stream_request(self, host, port, method, path,
+                        params=None, data=None, passthrough=False, stream=None,
+                        if_none_match=None, **kwargs):
+
+        request = self._create_http_request(
+            method,
+            host,
+            port,
+            path,
+            params=params,
+            data=data,
+            headers={'Content-Type': 'application/json; charset=UTF-8'},
+            header_callback=stream.header_callback,
+            streaming_callback=stream.streaming_callback,
+            **kwargs
+        )
+        self._check_request(request)
+
+        response = yield self._get_response(request, stream)
+        if stream.streaming:
+            return stream.result(response)  # noqa
 
-        data = self._format_output(response)
-        return data  # noqa
+        return self._format_cached_output(request, response, passthrough, if_none_match)  # noqa
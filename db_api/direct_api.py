@@ -6,11 +6,27 @@ import logging
 import json
 
 from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
 from tornado.platform.caresresolver import CaresResolver
-from tornado.httpclient import HTTPRequest
+from tornado.httpclient import HTTPError, HTTPRequest, HTTPResponse
 from tornado.httpclient import AsyncHTTPClient
 
+from metrics import REGISTRY
+from timing import span
 from . import DBApiError
+from .streaming import StreamProxy
+
+
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'db_api_upstream_seconds', 'DB API request latency', ['method', 'status'],
+)
+
+
+def status_class(code):
+    if code == 599:
+        return '599'
+    return '%dxx' % (code // 100)
 
 
 class DBApiDirect:
@@ -21,6 +37,7 @@ class DBApiDirect:
     def __init__(self, host, port,
                  resolver=None,
                  http_client=None,
+                 pool=None,
                  connect_timeout=0,
                  request_timeout=0,
                  **kwargs):
@@ -37,8 +54,16 @@ class DBApiDirect:
         if not self._resolver:
             self._resolver = CaresResolver()
 
+        # BackendPool: выбор адреса по задержке/запросам в полете
+        # вместо случайного адреса из DNS
+        self._pool = pool
+
     @gen.coroutine
     def _resolve(self, host, port):
+        if self._pool is not None:
+            # адрес выбирает _http_fetch, когда запрос и правда идет в базу
+            return host, port  # noqa
+
         try:
             addresses = yield self._resolver.resolve(host, port)
             if not addresses:
@@ -49,7 +74,7 @@ class DBApiDirect:
         return choice(addresses)[1]  # noqa
 
     def _create_http_request(self, method, host, port, path,
-                             params=None, data=None, **kwargs):
+                             params=None, data=None, timing=None, **kwargs):
 
         url = 'http://{host}:{port}{uri}'.format(host=host, port=port, uri=path)
 
@@ -64,6 +89,8 @@ class DBApiDirect:
             request_timeout=self._request_timeout,
             **kwargs
         )
+        # timing.Timing запроса клиента, этапы пишутся через span()
+        request.timing = timing
 
         if data and method in ['POST', 'PUT', 'PATCH']:
             try:
@@ -74,12 +101,89 @@ class DBApiDirect:
 
         return request
 
+    @gen.coroutine
+    def _fetch_599(self, request):
+        """
+            tornado >= 5 кидает 599 даже с raise_error=False,
+            а дальше везде ждут ответ с кодом 599, как в 4.x
+        """
+        try:
+            response = yield self._http_client.fetch(request, raise_error=False)
+        except HTTPError as e:
+            if e.code != 599:
+                raise
+            response = e.response or HTTPResponse(request, 599, error=e)
+        return response  # noqa
+
+    @gen.coroutine
+    def _http_fetch(self, request):
+        """
+            Запрос в базу; с пулом выбирает адрес, подставляет его
+            в url и считает запросы в полете, задержку и ошибки адреса
+        """
+        backend = None
+        if self._pool is not None:
+            yield self._pool.refresh()
+            backend = self._pool.pick()
+            request.url = backend.url(request.url)
+        if backend is None:
+            started = IOLoop.current().time()
+            response = yield self._fetch_599(request)
+            UPSTREAM_SECONDS.observe(
+                IOLoop.current().time() - started, request.method, status_class(response.code),
+            )
+            return response  # noqa
+
+        if not backend.allow():
+            # автомат адреса открыт: не ждем таймаутов и не занимаем
+            # слоты http клиента, DBApiCached может отдать stale
+            return HTTPResponse(
+                request, 599,
+                error=DBApiError('circuit is open for %s:%s' % backend.address),
+                request_time=0,
+            )  # noqa
+
+        started = IOLoop.current().time()
+        backend.start()
+        try:
+            response = yield self._fetch_599(request)
+        except Exception:
+            backend.finish(IOLoop.current().time() - started, error=True)
+            raise
+        latency = IOLoop.current().time() - started
+        backend.finish(
+            latency,
+            error=response.code >= 500,
+            timeout=response.code == 599,
+        )
+        UPSTREAM_SECONDS.observe(latency, request.method, status_class(response.code))
+        return response  # noqa
+
     def _check_request(self, request):
         if request.method not in ['GET', 'POST', 'PUT', 'PATCH', 'DELETE']:
             raise DBApiError('Disallowed method %s' % request.method)
 
     @staticmethod
-    def _format_output(response):
+    def _format_output(response, passthrough=False):
+        """
+            passthrough - для 200/201 не разбирать тело, а отдать
+            его байтами в result['body'] (JSON проверяется один раз,
+            проверенный ответ помечен response.json_checked)
+        """
+        if passthrough and response.code in [200, 201]:
+            try:
+                body = response.body or b'{}'
+                if not getattr(response, 'json_checked', False):
+                    json.loads(str(body, 'utf-8'))
+                    response.json_checked = True
+                return {
+                    'code': int(response.code),
+                    'headers': list(response.headers.get_all()),
+                    'body': body,
+                }
+            except ValueError:
+                pass
+
         result = {}
         try:
             result = {
@@ -88,7 +192,7 @@ class DBApiDirect:
                 'data': {},
             }
             if response.body:
-                result['data'] = json.loads(response.body.decode())
+                result['data'] = json.loads(str(response.body, 'utf-8'))
         except Exception as e:
             result = {
                 'code': 400,
@@ -99,9 +203,23 @@ class DBApiDirect:
             }
         return result
 
+    @gen.coroutine
+    def _limited(self, limit, fetch, request):
+        """
+            fetch(request), с limit (tornado.locks.Semaphore) - не
+            больше limit таких запросов в базу одновременно
+        """
+        if limit is None:
+            response = yield fetch(request)
+            return response  # noqa
+        with (yield limit.acquire()):
+            response = yield fetch(request)
+        return response  # noqa
+
     @gen.coroutine
     def _request(self, host, port, method, path,
-                 params=None, data=None, **kwargs):
+                 params=None, data=None, passthrough=False,
+                 limit=None, if_none_match=None, **kwargs):
 
         request = self._create_http_request(
             method,
@@ -115,20 +233,120 @@ class DBApiDirect:
         )
         self._check_request(request)
 
-        http_response = yield self._http_client.fetch(
-            request,
-            raise_error=False,
+        with span(request.timing, 'upstream'):
+            http_response = yield self._limited(limit, self._http_fetch, request)
+
+        with span(request.timing, 'format'):
+            data = self._format_output(http_response, passthrough)
+        return data  # noqa
+
+    @gen.coroutine
+    def _fetch_stream(self, request, stream):
+        response = yield self._http_fetch(request)
+        if not stream.streaming:
+            response = stream.response(response)
+        return response  # noqa
+
+    @gen.coroutine
+    def _stream_request(self, host, port, method, path,
+                        params=None, data=None, passthrough=False, stream=None,
+                        if_none_match=None, **kwargs):
+
+        request = self._create_http_request(
+            method,
+            host,
+            port,
+            path,
+            params=params,
+            data=data,
+            headers={'Content-Type': 'application/json; charset=UTF-8'},
+            header_callback=stream.header_callback,
+            streaming_callback=stream.streaming_callback,
+            **kwargs
         )
+        self._check_request(request)
 
-        data = self._format_output(http_response)
+        with span(request.timing, 'upstream'):
+            http_response = yield self._fetch_stream(request, stream)
+        if stream.streaming:
+            return stream.result(http_response)  # noqa
+
+        with span(request.timing, 'format'):
+            data = self._format_output(http_response, passthrough)
         return data  # noqa
 
+    def route(self, path):
+        """
+            Шаблон пути для меток метрик
+        """
+        return 'other'
+
     @gen.coroutine
     def request(self, method, *args, **kwargs):
+        """
+            timing=timing.Timing() - собрать разбивку времени по этапам,
+            if_none_match - If-None-Match клиента: если ETag ответа
+            совпал, вернется {'code': 304, 'etag': ...} без тела
+            (только DBApiCached, ETag есть у записей кэша)
+        """
+        res = yield self._call(self._request, method, *args, **kwargs)
+        return res  # noqa
+
+    @gen.coroutine
+    def stream(self, method, *args, on_start, on_chunk, min_size=0, tee_limit=0, **kwargs):
+        """
+            Как request, но 200 ответ базы (от min_size байт) сразу
+            отдается кусками в on_start(code, headers)/on_chunk(chunk),
+            тогда в результате вместо data будет streamed=True.
+            tee_limit - сколько байт тела можно собрать для кэша
+        """
+        stream = StreamProxy(on_start, on_chunk, min_size=min_size, tee_limit=tee_limit)
+        res = yield self._call(self._stream_request, method, *args, stream=stream, **kwargs)
+        return res  # noqa
+
+    @gen.coroutine
+    def _load_batch(self, items, timing=None):
+        """
+            Дополнительные параметры _request для каждого запроса
+            батча, без кэша - никаких
+        """
+        return [{} for _ in items]  # noqa
+
+    @gen.coroutine
+    def _batch_request(self, path, params, limit, extra, **kwargs):
+        try:
+            res = yield self.request(
+                'GET', path=path, params=params, limit=limit, **dict(extra, **kwargs)
+            )
+        except Exception as e:
+            logging.error('batch request %s failed: %s', path, e)
+            res = (False, str(e))
+        return res  # noqa
+
+    @gen.coroutine
+    def batch(self, items, concurrency=10, passthrough=False, timing=None):
+        """
+            Несколько GET одним вызовом: items - [(path, params), ...],
+            в базу одновременно идет не больше concurrency запросов.
+
+            Возвращает [(is_ok, res), ...] в порядке items, как у
+            request; ошибка одного запроса не роняет остальные
+        """
+        extras = yield self._load_batch(items, timing=timing)
+        limit = Semaphore(concurrency)
+        results = yield [
+            self._batch_request(path, params, limit, extra, passthrough=passthrough, timing=timing)
+            for (path, params), extra in zip(items, extras)
+        ]
+        return results  # noqa
+
+    @gen.coroutine
+    def _call(self, _request, method, *args, **kwargs):
         try:
-            host, port = yield self._resolve(self.host, self.port)
+            with span(kwargs.get('timing'), 'resolve'):
+                host, port = yield self._resolve(self.host, self.port)
 
-            result = yield self._request(host, port, method, *args, **kwargs)
+            result = yield _request(host, port, method, *args, **kwargs)
 
         except DBApiError as e:
             return False, str(e)  # noqa
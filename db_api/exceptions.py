@@ -1,2 +1,10 @@
 class DBApiError(Exception):
     pass
+
+
+class CacheFormatError(ValueError):
+    pass
+
+
+class StreamAborted(Exception):
+    pass
@@ -0,0 +1,121 @@
+from tornado.ioloop import IOLoop
+
+
+class CountMinSketch:
+    """
+        Приблизительные счетчики обращений к ключам в фиксированной
+        памяти: depth строк по width счетчиков, оценка - минимум по
+        строкам (может только завышать)
+
+        Каждые sample_size обращений все счетчики делятся пополам,
+        так что оценка - частота за последнее время, а не за всю
+        жизнь процесса.
+    """
+
+    def __init__(self, width=4096, depth=4, sample_size=None):
+        self.width = width
+        self.depth = depth
+        self.sample_size = sample_size or width * 10
+        self._rows = [[0] * width for _ in range(depth)]
+        self._added = 0
+
+    def _indexes(self, key):
+        # depth индексов из одного hash (двойное хеширование)
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key):
+        """
+            Учитывает обращение к key, возвращает новую оценку
+        """
+        estimate = None
+        for row, index in zip(self._rows, self._indexes(key)):
+            row[index] += 1
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+
+        self._added += 1
+        if self._added >= self.sample_size:
+            self._halve()
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def _halve(self):
+        self._added = 0
+        for row in self._rows:
+            for i, count in enumerate(row):
+                if count:
+                    row[i] = count >> 1
+
+
+class RefreshAhead:
+    """
+        Решает, какие свежие записи кэша обновить заранее
+
+        Запись обновляется в фоне, если до конца ее cache_key_ttl
+        осталось не больше window секунд и к ключу недавно обращались
+        не меньше min_hits раз (по CountMinSketch).
+
+        concurrency - сколько таких обновлений одновременно,
+        qps         - сколько в секунду в среднем (token bucket
+                      с запасом на секунду), чтобы обновления сами
+                      не перегрузили базу
+
+        Лимиты на процесс: при нескольких воркерах в базу идет до
+        workers * qps обновлений в секунду.
+    """
+
+    def __init__(self, window=1.0, min_hits=10, concurrency=2, qps=5.0, width=4096, depth=4):
+        self.window = window
+        self.min_hits = min_hits
+        self.concurrency = concurrency
+        self.qps = qps
+        self.sketch = CountMinSketch(width, depth)
+
+        self.inflight = 0
+        self._tokens = float(max(qps, 1))
+        self._updated = None
+        self.stats = {
+            'scheduled': 0,
+            'throttled_concurrency': 0,
+            'throttled_qps': 0,
+        }
+
+    def hit(self, key):
+        return self.sketch.add(key)
+
+    def _take_token(self):
+        now = IOLoop.current().time()
+        if self._updated is not None:
+            self._tokens = min(max(self.qps, 1), self._tokens + (now - self._updated) * self.qps)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def allow(self, hits, ttl_left):
+        """
+            hits - оценка от hit(), ttl_left - сколько записи
+            осталось быть свежей
+        """
+        if ttl_left > self.window or hits < self.min_hits:
+            return False
+        if self.inflight >= self.concurrency:
+            self.stats['throttled_concurrency'] += 1
+            return False
+        if not self._take_token():
+            self.stats['throttled_qps'] += 1
+            return False
+        self.stats['scheduled'] += 1
+        return True
+
+    def start(self):
+        self.inflight += 1
+
+    def finish(self):
+        self.inflight -= 1
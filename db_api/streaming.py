@@ -0,0 +1,145 @@
+from io import BytesIO
+
+from tornado.httpclient import HTTPResponse
+from tornado.httputil import (
+    HTTPHeaders,
+    HTTPInputError,
+    parse_response_start_line,
+)
+
+from .exceptions import StreamAborted
+
+
+class StreamProxy:
+    """
+        Принимает ответ базы кусками (header_callback/streaming_callback
+        у HTTPRequest) и решает, отдавать ли тело клиенту сразу
+
+        Стримим, если база ответила 200 и Content-Length не меньше
+        min_size (или длина неизвестна). Тогда on_start(code, headers)
+        вызывается после заголовков, on_chunk(chunk) - на каждый кусок,
+        а в памяти копится не больше tee_limit байт (для записи в кэш).
+        on_overflow(), если задан, вызывается один раз, когда тело
+        перестало влезать в tee_limit.
+
+        Если on_chunk кинул StreamAborted (клиент ушел или не успевает
+        читать), остаток тела отбрасывается и ответ не кэшируется.
+        Сам запрос в базу при этом не прерывается: у http клиентов
+        tornado 4 нет отмены, он дочитывается до конца или до
+        request_timeout, но в памяти уже не копится.
+
+        Иначе тело целиком собирается в память, как при обычном запросе.
+    """
+
+    def __init__(self, on_start, on_chunk, min_size=0, tee_limit=0):
+        self.on_start = on_start
+        self.on_chunk = on_chunk
+        self.min_size = min_size
+        self.tee_limit = tee_limit
+        self.on_overflow = None
+
+        self.code = None
+        self.reason = None
+        self.headers = HTTPHeaders()
+        self.streaming = False
+        self.streamed_bytes = 0
+        self.aborted = False
+
+        self._chunks = []
+        self._size = 0
+        self._overflow = False
+
+    def header_callback(self, line):
+        if line.startswith('HTTP/'):
+            # новый блок заголовков, например после 100 Continue
+            try:
+                start_line = parse_response_start_line(line.strip())
+            except HTTPInputError:
+                return
+            self.code = start_line.code
+            self.reason = start_line.reason
+            self.headers = HTTPHeaders()
+        elif line.strip():
+            self.headers.parse_line(line)
+        elif self.code != 100:
+            self._headers_received()
+
+    def _headers_received(self):
+        if self.code != 200:
+            return
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = None
+        if length is not None and length < self.min_size:
+            return
+
+        self.streaming = True
+        self.on_start(self.code, list(self.headers.get_all()))
+
+    def streaming_callback(self, chunk):
+        if self.aborted:
+            return
+        if self.streaming:
+            self.streamed_bytes += len(chunk)
+            try:
+                self.on_chunk(chunk)
+            except StreamAborted:
+                self.aborted = True
+                self._drop_body()
+                return
+            if self._overflow:
+                return
+            if self._size + len(chunk) > self.tee_limit:
+                self._drop_body()
+                return
+
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+
+    def _drop_body(self):
+        if self._overflow:
+            return
+        self._overflow = True
+        self._chunks = []
+        if self.on_overflow is not None:
+            self.on_overflow()
+
+    @property
+    def body(self):
+        """
+            Все тело, если оно поместилось в буфер, иначе None
+        """
+        if self._overflow:
+            return None
+        return b''.join(self._chunks)
+
+    def response(self, response):
+        """
+            HTTPResponse с собранным телом вместо пустого
+            ответа, который вернул клиент со streaming_callback
+        """
+        if self.code is None or response.code == 599:
+            return response
+        return HTTPResponse(
+            response.request,
+            self.code,
+            reason=self.reason,
+            headers=self.headers,
+            buffer=BytesIO(self.body or b''),
+            effective_url=response.effective_url,
+            request_time=response.request_time,
+        )
+
+    def result(self, response):
+        """
+            Результат запроса, тело которого уже ушло клиенту;
+            complete=False - база оборвала ответ на середине
+            или клиент перестал его принимать
+        """
+        return {
+            'code': self.code,
+            'headers': list(self.headers.get_all()),
+            'streamed': True,
+            'complete': response.code == self.code and not self.aborted,
+        }
@@ -0,0 +1,151 @@
+class _Node:
+    __slots__ = ('literals', 'params', 'star', 'glob', 'rules')
+
+    def __init__(self):
+        self.literals = {}
+        self.params = []
+        self.star = None
+        self.glob = None
+        self.rules = []
+
+
+class TagRule:
+    def __init__(self, index, pattern, tags, invalidates=None):
+        self.index = index
+        self.pattern = pattern
+        self.tags = list(tags)
+        self.invalidates = list(invalidates or [])
+
+
+class TagRules:
+    """
+        Правила получения тэгов кэша из пути запроса
+
+        rules = [
+            {
+                'pattern': '/api/events/{id}/',
+                'tags': ['events:{id}'],
+                'invalidates': ['events'],
+            },
+            ...
+        ]
+
+        сегменты шаблона:
+            events  - ровно такой сегмент
+            {id}    - любой сегмент, значение подставляется в тэги
+            *       - любой сегмент
+            **      - любое количество сегментов, в том числе ноль
+
+        tags - тэги записи в кэше для GET, их же забывает запись
+        в этот путь; invalidates - что еще забыть при POST/PUT/...
+        (например список events при изменении одного события).
+        Тэги всех подошедших правил объединяются. Пути, к которому
+        не подошло ни одно правило, тэги дает fallback (TagRules).
+
+        Правила один раз собираются в дерево по сегментам пути,
+        поиск - один проход по сегментам, от числа правил не зависит.
+    """
+
+    def __init__(self, rules, fallback=None):
+        self.rules = []
+        self.fallback = fallback
+        self._root = _Node()
+        for index, rule in enumerate(rules):
+            self._add(TagRule(index, **rule))
+
+    @staticmethod
+    def _split(path):
+        return [segment for segment in path.split('/') if segment]
+
+    def _add(self, rule):
+        node = self._root
+        names = set()
+        for segment in self._split(rule.pattern):
+            if segment == '**':
+                if node.glob is None:
+                    node.glob = _Node()
+                node = node.glob
+            elif segment == '*':
+                if node.star is None:
+                    node.star = _Node()
+                node = node.star
+            elif segment.startswith('{') and segment.endswith('}'):
+                name = segment[1:-1]
+                names.add(name)
+                for param_name, child in node.params:
+                    if param_name == name:
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.params.append((name, child))
+                    node = child
+            else:
+                node = node.literals.setdefault(segment, _Node())
+
+        # ошибки в шаблонах тэгов ловим на старте, а не на запросе
+        for tag in rule.tags + rule.invalidates:
+            try:
+                tag.format(**{name: '' for name in names})
+            except (KeyError, IndexError) as e:
+                raise ValueError('unknown placeholder %s in tag %r of %r' % (e, tag, rule.pattern))
+
+        node.rules.append(rule)
+        self.rules.append(rule)
+
+    def _walk(self, node, segments, i, captures, matched):
+        if i == len(segments):
+            for rule in node.rules:
+                matched.append((rule, dict(captures)))
+
+        if node.glob is not None:
+            for j in range(i, len(segments) + 1):
+                self._walk(node.glob, segments, j, captures, matched)
+
+        if i < len(segments):
+            segment = segments[i]
+            child = node.literals.get(segment)
+            if child is not None:
+                self._walk(child, segments, i + 1, captures, matched)
+            if node.star is not None:
+                self._walk(node.star, segments, i + 1, captures, matched)
+            for name, child in node.params:
+                captures[name] = segment
+                self._walk(child, segments, i + 1, captures, matched)
+                del captures[name]
+
+    def route(self, path):
+        """
+            Шаблон первого подошедшего правила без ** - метка
+            для метрик, чтобы не плодить значения по id
+        """
+        matched = []
+        self._walk(self._root, self._split(path), 0, {}, matched)
+        for rule, _ in sorted(matched, key=lambda item: item[0].index):
+            if '**' not in rule.pattern:
+                return rule.pattern
+        return 'other'
+
+    def match(self, path):
+        """
+            Возвращает (tags, invalidates) для пути
+        """
+        matched = []
+        self._walk(self._root, self._split(path), 0, {}, matched)
+        if not matched and self.fallback is not None:
+            return self.fallback.match(path)
+        matched.sort(key=lambda item: item[0].index)
+
+        tags = []
+        invalidates = []
+        for rule, captures in matched:
+            for tag in rule.tags:
+                tag = tag.format(**captures)
+                if tag not in tags:
+                    tags.append(tag)
+            for tag in rule.invalidates:
+                tag = tag.format(**captures)
+                if tag not in invalidates:
+                    invalidates.append(tag)
+
+        return tags, invalidates
@@ -0,0 +1,144 @@
+import logging
+import re
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+
+from metrics import REGISTRY
+
+
+WARMUP_URLS = REGISTRY.counter(
+    'cache_warmup_urls_total', 'Cache warm-up requests by outcome', ['outcome'],
+)
+WARMUP_PROGRESS = REGISTRY.gauge(
+    'cache_warmup_progress', 'Share of warm-up URLs done, 1 when finished',
+)
+WARMUP_SECONDS = REGISTRY.gauge(
+    'cache_warmup_seconds', 'Duration of the last cache warm-up',
+)
+
+# строка tornado.access: "200 GET /db/api/events/?city=moscow (127.0.0.1) 3.21ms"
+ACCESS_LOG_RE = re.compile(r'\b200 GET (?P<uri>\S+) \(')
+
+
+def parse_url(url):
+    """
+        '/api/events/?city=moscow' или {'path': ..., 'params': {...}}
+        -> (path, params)
+    """
+    if isinstance(url, dict):
+        return url['path'], dict(url.get('params') or {})
+    path, _, query = url.partition('?')
+    return path, dict(parse_qsl(query))
+
+
+def urls_from_access_log(path, top=100, prefix='/db'):
+    """
+        top самых частых удачных GET из access log tornado,
+        prefix (путь DBApiRequestHandler) отрезается
+    """
+    counts = Counter()
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = ACCESS_LOG_RE.search(line)
+            if match and match.group('uri').startswith(prefix + '/'):
+                counts[match.group('uri')[len(prefix):]] += 1
+    return [url for url, _ in counts.most_common(top)]
+
+
+class CacheWarmer:
+    """
+        Прогрев кэша списком GET запросов через обычный db_api.request,
+        то есть с записью в redis и L1 как у любого промаха
+
+        concurrency - сколько запросов в базу одновременно,
+        budget      - сколько секунд максимум ждем прогрева (включая
+                      ожидание подключения к redis), потом считаем его
+                      законченным, что бы ни осталось
+        shard       - (номер, всего): при нескольких воркерах каждый
+                      греет свою часть списка, redis у них общий
+    """
+
+    def __init__(self, db_api, urls, concurrency=5, budget=30, shard=(0, 1)):
+        index, count = shard
+        self.db_api = db_api
+        self.urls = [parse_url(url) for url in urls][index::count]
+        self.concurrency = concurrency
+        self.budget = budget
+
+        self.done = 0
+        self.finished = False
+        self.stats = {
+            'ok': 0,
+            'error': 0,
+        }
+
+    @gen.coroutine
+    def _wait_for_cache(self, deadline):
+        cache = self.db_api.cache
+        # у кэша без состояний (не RedisCache) ждать нечего
+        connected = getattr(cache, 'state_map', {}).get(getattr(cache, 'CONNECTED', None))
+        while connected is not None and cache.state is not connected:
+            if IOLoop.current().time() >= deadline:
+                return
+            yield gen.sleep(0.1)
+
+    @gen.coroutine
+    def _worker(self, queue):
+        while True:
+            item = yield queue.get()
+            if item is None:
+                return
+            path, params = item
+            try:
+                is_ok, res = yield self.db_api.request('GET', path=path, params=params)
+                outcome = 'ok' if is_ok and res['code'] == 200 else 'error'
+            except Exception as e:
+                logging.warning('cache warm-up %s failed: %s', path, e)
+                outcome = 'error'
+            finally:
+                queue.task_done()
+
+            self.stats[outcome] += 1
+            WARMUP_URLS.inc(outcome)
+            self.done += 1
+            if not self.finished:
+                WARMUP_PROGRESS.set(self.done / len(self.urls))
+
+    @gen.coroutine
+    def run(self):
+        loop = IOLoop.current()
+        started = loop.time()
+        deadline = started + self.budget
+        WARMUP_PROGRESS.set(0.0)
+        logging.info('cache warm-up: %d urls', len(self.urls))
+
+        yield self._wait_for_cache(deadline)
+
+        queue = Queue()
+        for url in self.urls:
+            queue.put_nowait(url)
+        workers = min(self.concurrency, len(self.urls))
+        for _ in range(workers):
+            loop.add_future(self._worker(queue), lambda f: f.result())
+
+        try:
+            yield gen.with_timeout(deadline, queue.join())
+        except gen.TimeoutError:
+            logging.warning('cache warm-up budget %ss is over, %d of %d urls done',
+                            self.budget, self.done, len(self.urls))
+            # не начатое выбрасываем, начатое пусть доделывается
+            while queue.qsize():
+                queue.get_nowait()
+                queue.task_done()
+        for _ in range(workers):
+            queue.put_nowait(None)
+
+        self.finished = True
+        WARMUP_PROGRESS.set(1.0)
+        WARMUP_SECONDS.set(loop.time() - started)
+        logging.info('cache warm-up finished in %.2fs: %s', loop.time() - started, self.stats)
+        return self.stats  # noqa
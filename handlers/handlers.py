@@ -2,6 +2,8 @@ import logging
 from pprint import pprint as pp  # noqa
 
 import json
+from collections import OrderedDict
+from functools import partial
 
 from tornado import gen
 from tornado.web import (
@@ -9,15 +11,121 @@ from tornado.web import (
     RequestHandler
 )
 
+from db_api import StreamAborted
+from metrics import REGISTRY
+from timing import Timing, span
 from .tools import (
     JinjaTemplateMixin,
     CacheMixin,
+    write_variant,
+)
+
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'Request latency by DB API route and status', ['route', 'code'],
 )
 
 
 class DBApiRequestHandler(RequestHandler):
+    """
+        С настройкой приложения db_api_passthrough тело ответа базы
+        не разбирается и не собирается заново, а вклеивается байтами
+        в {"status": "ok", "data": ...}
+
+        GET в пути из db_api_streaming_routes или с ответом от
+        db_api_streaming_min_size байт отдается клиенту кусками по мере
+        прихода от базы, без сборки тела в памяти. Если клиент ушел или
+        не успел забрать db_api_streaming_max_pending байт, стрим
+        обрывается, остаток тела от базы отбрасывается
+
+        У ответов из кэша есть ETag, If-None-Match с ним - 304 без тела,
+        клиентам с gzip они уходят заранее сжатыми (write_variant)
+
+        db_api_server_timing - разбивка времени по этапам в заголовке
+        Server-Timing, db_api_slow_request_ms - запросы дольше этого
+        пишутся в лог вместе с разбивкой
+    """
     SUPPORTED_METHODS = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE']
 
+    OK_PREFIX = b'{"status": "ok", "data": '
+    OK_SUFFIX = b'}'
+
+    # тело мы пишем свое, длину и кодировку считает tornado
+    SKIP_HEADERS = ['Content-Length', 'Transfer-Encoding', 'Content-Encoding', 'Connection']
+
+    # сколько байт стрима может ждать отправки клиенту по умолчанию
+    STREAM_MAX_PENDING = 8 * 1024 * 1024
+
+    def _ok_raw(self, body):
+        self.set_status(200)
+        self.write(b''.join([self.OK_PREFIX, body, self.OK_SUFFIX]))
+
+    def _stream_min_size(self, api_path):
+        """
+            None - стриминг выключен для запроса
+        """
+        if self.request.method != 'GET':
+            return None
+        for route in self.settings.get('db_api_streaming_routes', []):
+            if route.search(api_path):
+                return 0
+        return self.settings.get('db_api_streaming_min_size')
+
+    def _stream_start(self, code, headers):
+        self._streaming = True
+        self._stream_closed = False
+        self._stream_written = 0
+        self._stream_sent = 0
+        self.set_status(code)
+        for k, v in headers:
+            if k not in self.SKIP_HEADERS:
+                self.set_header(k, v)
+        self._set_server_timing()
+        self._stream_write(self.OK_PREFIX)
+
+    def _stream_chunk(self, chunk):
+        if self._stream_closed:
+            raise StreamAborted('client closed connection')
+        pending = self._stream_written - self._stream_sent
+        if pending > (self.settings.get('db_api_streaming_max_pending') or self.STREAM_MAX_PENDING):
+            logging.warning('client is too slow, %d bytes pending, abort stream', pending)
+            self._stream_closed = True
+            self.request.connection.close()
+            raise StreamAborted('client is too slow')
+        self._stream_write(chunk)
+
+    def _stream_write(self, chunk):
+        self.write(chunk)
+        self._stream_written += len(chunk)
+        self.flush().add_done_callback(partial(self._stream_flushed, self._stream_written))
+
+    def _stream_flushed(self, written, future):
+        # tornado 4 завершает только future последнего flush, когда
+        # уходит весь буфер, поэтому отправлено - максимум из дошедших
+        if future.exception() is not None:
+            self._stream_closed = True
+        else:
+            self._stream_sent = max(self._stream_sent, written)
+
+    def on_connection_close(self):
+        self._stream_closed = True
+        super().on_connection_close()
+
+    def _set_server_timing(self):
+        timing = getattr(self, '_timing', None)
+        if timing is not None and self.settings.get('db_api_server_timing'):
+            self.set_header('Server-Timing', timing.header(total=self.request.request_time()))
+
+    def finish(self, *args, **kwargs):
+        if not getattr(self, '_streaming', False):
+            self._set_server_timing()
+        return super().finish(*args, **kwargs)
+
+    def _ok_body(self, response):
+        if 'body' in response:
+            return b''.join([self.OK_PREFIX, response['body'], self.OK_SUFFIX])
+        return json.dumps({'status': 'ok', 'data': response['data']}).encode()
+
     def _ok(self, data):
         self.set_status(200)
         self.write(
@@ -44,6 +152,10 @@ class DBApiRequestHandler(RequestHandler):
 
     @gen.coroutine
     def prepare(self):
+        self._timing = None
+        if self.settings.get('db_api_server_timing') or self.settings.get('db_api_slow_request_ms'):
+            self._timing = Timing()
+
         try:
             # print(type(self.request))
             # print(self.request.query)
@@ -51,6 +163,7 @@ class DBApiRequestHandler(RequestHandler):
             api_path = self.path_kwargs.get('api_path', '')
             if not api_path.startswith('/'):
                 api_path = '/' + api_path
+            self._api_path = api_path
 
             params = {k: self.get_argument(k) for k in self.request.arguments}
 
@@ -63,18 +176,60 @@ class DBApiRequestHandler(RequestHandler):
             self.finish()
             return
 
-        is_ok, res = yield self.application.db_api.request(
-            self.request.method,
-            path=api_path,
-            params=params,
-            data=data,
-        )
+        passthrough = self.settings.get('db_api_passthrough', False)
+        if_none_match = None
+        if self.request.method == 'GET':
+            if_none_match = self.request.headers.get('If-None-Match')
+        min_size = self._stream_min_size(api_path)
+        if min_size is None:
+            is_ok, res = yield self.application.db_api.request(
+                self.request.method,
+                path=api_path,
+                params=params,
+                data=data,
+                passthrough=passthrough,
+                timing=self._timing,
+                if_none_match=if_none_match,
+            )
+        else:
+            is_ok, res = yield self.application.db_api.stream(
+                self.request.method,
+                path=api_path,
+                params=params,
+                data=data,
+                passthrough=passthrough,
+                on_start=self._stream_start,
+                on_chunk=self._stream_chunk,
+                min_size=min_size,
+                tee_limit=self.settings.get('db_api_streaming_tee_limit', 0),
+                timing=self._timing,
+                if_none_match=if_none_match,
+            )
+
+        if getattr(self, '_streaming', False):
+            if is_ok and res.get('complete'):
+                self.write(self.OK_SUFFIX)
+                self.finish()
+            else:
+                # заголовки и часть тела уже ушли, честно сообщить
+                # об ошибке можно только оборвав соединение
+                logging.error('db api stream for %s is broken', api_path)
+                self.request.connection.close()
+                self._finished = True
+            return
+
         if not is_ok:
             self._error(res)
             self.finish()
             return
 
         response = res
+        if response['code'] == 304:
+            # If-None-Match совпал, write_variant ответит 304 без тела
+            write_variant(self, response['etag'], None)
+            self.finish()
+            return
+
         if response['code'] not in [200, 201]:
             self._error(response['data'])
             self.finish()
@@ -82,10 +237,35 @@ class DBApiRequestHandler(RequestHandler):
 
         self.set_status(response['code'])
         for k, v in response['headers']:
-            self.set_header(k, v)
-        self._ok(response['data'])
+            if k not in self.SKIP_HEADERS:
+                self.set_header(k, v)
+        with span(self._timing, 'encode'):
+            if 'etag' in response:
+                # ETag тела базы, наш ответ - его однозначная обертка
+                self.set_status(200)
+                write_variant(self, response['etag'], lambda: self._ok_body(response))
+            elif 'body' in response:
+                self._ok_raw(response['body'])
+            else:
+                self._ok(response['data'])
         self.finish()
 
+    def on_finish(self):
+        total = self.request.request_time()
+        route = self.application.db_api.route(getattr(self, '_api_path', '/'))
+        REQUEST_SECONDS.observe(total, route, str(self.get_status()))
+
+        slow_ms = self.settings.get('db_api_slow_request_ms')
+        if slow_ms and total * 1000 >= slow_ms:
+            logging.warning('slow request %s', json.dumps(OrderedDict([
+                ('method', self.request.method),
+                ('uri', self.request.uri),
+                ('route', route),
+                ('code', self.get_status()),
+                ('total_ms', round(total * 1000, 2)),
+                ('spans_ms', self._timing.as_dict() if getattr(self, '_timing', None) else {}),
+            ])))
+
     def get(self, *args, **kwargs):
         pass
 
@@ -102,6 +282,110 @@ class DBApiRequestHandler(RequestHandler):
         pass
 
 
+class DBApiBatchHandler(DBApiRequestHandler):
+    """
+        Несколько GET к базе одним запросом клиента
+
+        POST /db/_batch
+        {"requests": [{"path": "/api/events/", "params": {"city": "moscow"}}, ...]}
+
+        {"status": "ok", "data": [
+            {"status": "ok", "code": 200, "data": ...},
+            {"status": "fail", "code": 404, "data": ...},
+        ]}
+
+        Ответы в порядке запросов, ошибка одного не роняет батч.
+        Ключи кэша читаются одним MGET, промахи идут в базу не больше
+        db_api_batch_concurrency одновременно; запросов в батче не
+        больше db_api_batch_max_items
+    """
+    SUPPORTED_METHODS = ['POST']
+
+    @gen.coroutine
+    def prepare(self):
+        self._timing = None
+        if self.settings.get('db_api_server_timing') or self.settings.get('db_api_slow_request_ms'):
+            self._timing = Timing()
+        self._api_path = '/_batch'
+
+    def _parse_items(self):
+        items = []
+        for item in json.loads(self.request.body.decode())['requests']:
+            path = item['path']
+            if not path.startswith('/'):
+                path = '/' + path
+            params = item.get('params') or {}
+            if not isinstance(params, dict):
+                raise ValueError('params must be an object')
+            items.append((path, {k: str(v) for k, v in params.items()}))
+        return items
+
+    @staticmethod
+    def _item(is_ok, res):
+        """
+            Один ответ батча байтами, тело passthrough вклеивается как есть
+        """
+        if not is_ok:
+            return json.dumps({'status': 'fail', 'code': 502, 'data': res}).encode()
+        if res['code'] not in [200, 201]:
+            return json.dumps({'status': 'fail', 'code': res['code'], 'data': res['data']}).encode()
+        if 'body' in res:
+            return b''.join([
+                b'{"status": "ok", "code": ', str(res['code']).encode(),
+                b', "data": ', res['body'], b'}',
+            ])
+        return json.dumps({'status': 'ok', 'code': res['code'], 'data': res['data']}).encode()
+
+    @gen.coroutine
+    def post(self):
+        try:
+            items = self._parse_items()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._error({
+                'message': 'invalid batch, expected {"requests": [{"path": ..., "params": {...}}]}',
+            })
+            return
+
+        max_items = self.settings.get('db_api_batch_max_items', 50)
+        if len(items) > max_items:
+            self._error({'message': 'too many requests in batch, max %d' % max_items})
+            return
+
+        results = yield self.application.db_api.batch(
+            items,
+            concurrency=self.settings.get('db_api_batch_concurrency', 10),
+            passthrough=self.settings.get('db_api_passthrough', False),
+            timing=self._timing,
+        )
+
+        with span(self._timing, 'encode'):
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            items = b', '.join(self._item(is_ok, res) for is_ok, res in results)
+            self._ok_raw(b''.join([b'[', items, b']']))
+
+
+class MetricsHandler(RequestHandler):
+    """
+        Метрики процесса для Prometheus; при нескольких воркерах
+        у каждого свои, отвечает тот, кому досталось соединение
+    """
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(REGISTRY.render())
+
+
+class ReadyHandler(RequestHandler):
+    """
+        200, когда процесс готов принимать трафик (кэш прогрет), иначе 503
+    """
+    def get(self):
+        if not getattr(self.application, 'ready', True):
+            self.set_status(503)
+            self.write('warming up')
+            return
+        self.write('ok')
+
+
 class TestView(
     CacheMixin,
     JinjaTemplateMixin,
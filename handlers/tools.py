@@ -1,10 +1,75 @@
 from pprint import pprint as pp  # noqa
 from collections import OrderedDict
 from urllib.parse import urlencode, urlparse, parse_qsl
+import gzip
 import json
+import re
 
+from tornado import gen
 from tornado.escape import utf8
 
+from db_api.cache_format import content_etag, etag_matches
+
+
+_ACCEPT_GZIP_RE = re.compile(r'(?:^|,)\s*(gzip|\*)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*(?=,|$)')
+
+
+def accepts_gzip(accept_encoding):
+    """
+        Есть ли gzip (или *) с q > 0 в Accept-Encoding
+    """
+    for _, q in _ACCEPT_GZIP_RE.findall((accept_encoding or '').lower()):
+        try:
+            if not q or float(q) > 0:
+                return True
+        except ValueError:
+            pass
+    return False
+
+
+def write_variant(handler, etag, build):
+    """
+        Пишет тело ответа с ETag etag: на совпавший If-None-Match - 304
+        без тела, клиенту с gzip в Accept-Encoding - сжатый вариант из
+        application.gzip_cache, остальным - build() как есть
+
+        Ключ варианта - (класс обработчика, ETag): у DBApiRequestHandler
+        и CacheMixin один и тот же ETag может быть у разных тел.
+
+        Вариант сжимается один раз, на первом запросе с gzip, и дальше
+        отдается без сжатия на каждый запрос. У сжатого ответа ETag
+        слабый (W/), как у nginx: тело другое, смысл тот же.
+        application.gzip_cache = None - сжатие выключено
+    """
+    gzip_cache = getattr(handler.application, 'gzip_cache', None)
+    if gzip_cache is not None:
+        handler.set_header('Vary', 'Accept-Encoding')
+
+    if etag_matches(handler.request.headers.get('If-None-Match'), etag):
+        handler.set_status(304)
+        handler.set_header('Etag', etag)
+        return
+
+    if gzip_cache is None or not accepts_gzip(handler.request.headers.get('Accept-Encoding')):
+        handler.set_header('Etag', etag)
+        handler.write(build())
+        return
+
+    key = (handler.__class__.__name__, etag)
+    compressed = gzip_cache.get(key)
+    if compressed is None:
+        body = build()
+        if len(body) < handler.settings.get('gzip_min_size', 0):
+            handler.set_header('Etag', etag)
+            handler.write(body)
+            return
+        compressed = gzip.compress(body, handler.settings.get('gzip_level', 6))
+        gzip_cache.set(key, compressed, len(compressed))
+
+    handler.set_header('Content-Encoding', 'gzip')
+    handler.set_header('Etag', 'W/' + etag)
+    handler.write(compressed)
+
 
 class JinjaTemplateMixin:
     """
@@ -33,19 +98,34 @@ class JinjaTemplateMixin:
 class CacheMixin:
     """
     Кэширует GET запрос
+
+    Вместе со страницей в кэше лежит ее ETag (тот же sha1, что
+    считает tornado), на совпавший If-None-Match отвечаем 304
+    без тела и без пересчета хеша, клиентам с gzip отдаем сжатый
+    вариант (write_variant)
+
+    Префикс записи с \xff: с него не начинается ни одна страница в
+    utf-8, и он не совпадает с маркером \x00 у cache.ValueCodec,
+    так что несжатую страницу кодеку не нужно экранировать
     """
+    ETAG_PREFIX = b'\xffetag:'
 
     def initialize(self, *args, **kwargs):
         self.__cache = self.application.cache
         self.__write_buffer = []
         super().initialize(*args, **kwargs)
 
+    @gen.coroutine
     def prepare(self):
         if self.request.method == 'GET':
             self.key = self.__generate_key()
-            if self.__cache.exists(self.key):
-                cached_value = self.__cache.get(self.key)
-                super().write(cached_value)
+            cached_value = yield self.__cache.get(self.key)
+            if cached_value is not None:
+                etag, body = self.__unpack(utf8(cached_value))
+                if etag is None:
+                    super().write(body)
+                else:
+                    write_variant(self, etag, lambda: body)
                 super().finish()
                 return
 
@@ -64,6 +144,18 @@ class CacheMixin:
         ])
         return key
 
+    def __pack(self, body):
+        return b''.join([self.ETAG_PREFIX, utf8(content_etag(body)), b'\n', body])
+
+    def __unpack(self, value):
+        """
+            (etag, тело); у записей без ETag etag - None
+        """
+        if not value.startswith(self.ETAG_PREFIX):
+            return None, value
+        etag, _, body = value[len(self.ETAG_PREFIX):].partition(b'\n')
+        return etag.decode(), body
+
     def write(self, chunk):
         chunk = utf8(chunk)
         self.__write_buffer.append(chunk)
@@ -72,8 +164,9 @@ class CacheMixin:
     def finish(self):
         chunk = b"".join(self.__write_buffer)
         key = self.__generate_key()
+        # не ждем записи в кэш, ответ клиенту важнее
         self.__cache.set(
-            key, chunk,
+            key, self.__pack(chunk),
             key_ttl=self.__cache.options.get('key_ttl', 5)
         )
         super().finish()
@@ -1,30 +1,51 @@
 import logging
+import os
+import re
 from pprint import pprint as pp  # noqa
 
 from jinja2 import Environment, FileSystemLoader
 
 import tornado.log
 import tornado.autoreload
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 import tornado.httputil
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 from tornado.httpclient import AsyncHTTPClient
 from tornado.options import options
 
-from db_api import get_db_api
+from db_api import (
+    get_db_api,
+    BackendPool,
+    CacheWarmer,
+    RefreshAhead,
+    urls_from_access_log,
+    CacheMetaDataValidator,
+    SharedCacheMetaDataValidator,
+    TagRules,
+)
 from resolver import Resolver
-from cache import RedisCache
+from cache import RedisCache, LocalCache
+from metrics import REGISTRY
 from handlers import (
+    DBApiBatchHandler,
     DBApiRequestHandler,
+    MetricsHandler,
+    ReadyHandler,
     TestView,
 )
 
 from settings import (
     PORT,
+    PROCESSES,
     DEBUG,
     CURL,
     DNS_RECORD_TTL,
     DB_API,
+    GZIP,
     JINJA,
     REDIS,
 )
@@ -48,19 +69,97 @@ class NightpartyApplication(tornado.web.Application):
             lambda future: future.result()
         )
 
-        Api = get_db_api(is_cached=True)
+        local_cache = None
+        if DB_API.get('LOCAL_CACHE'):
+            local_cache = LocalCache(
+                max_bytes=DB_API['LOCAL_CACHE']['MAX_BYTES'],
+                key_ttl=DB_API['LOCAL_CACHE']['KEY_TTL'],
+            )
+
+        tag_rules = None
+        if DB_API.get('TAG_RULES'):
+            # пути без правил размечаются как раньше, по URL_TAGS
+            tag_rules = TagRules(
+                DB_API['TAG_RULES'], fallback=CacheMetaDataValidator.url_tag_rules(),
+            )
+
+        cache_meta_data = None
+        if DB_API.get('SHARED_INVALIDATION'):
+            cache_meta_data = SharedCacheMetaDataValidator(
+                self.cache,
+                tag_rules=tag_rules,
+                max_age=DB_API['CACHE_KEY_TTL'] + max(
+                    DB_API.get('CACHE_STALE_TTL', 0),
+                    DB_API.get('CACHE_STALE_IF_ERROR', 0),
+                ),
+            )
+            tornado.ioloop.IOLoop.instance().add_future(
+                cache_meta_data.run(),
+                lambda future: future.result()
+            )
+
+        resolver = Resolver(
+            ttl=DNS_RECORD_TTL
+        )
+
+        pool = None
+        balancer = DB_API.get('BALANCER')
+        if balancer:
+            pool = BackendPool(
+                backends=[backend.rsplit(':', 1) for backend in balancer.get('BACKENDS', [])],
+                dns=(DB_API['HOST'], DB_API['PORT']) if balancer.get('DNS', True) else None,
+                resolver=resolver,
+                strategy=balancer.get('STRATEGY', 'ewma'),
+                decay=balancer.get('DECAY', 10),
+                breaker=balancer.get('CIRCUIT_BREAKER'),
+            )
+
+        refresh_ahead = None
+        if DB_API.get('REFRESH_AHEAD'):
+            refresh_ahead = RefreshAhead(
+                window=DB_API['REFRESH_AHEAD'].get('WINDOW', 1),
+                min_hits=DB_API['REFRESH_AHEAD'].get('MIN_HITS', 10),
+                concurrency=DB_API['REFRESH_AHEAD'].get('CONCURRENCY', 2),
+                qps=DB_API['REFRESH_AHEAD'].get('QPS', 5),
+                width=DB_API['REFRESH_AHEAD'].get('SKETCH_WIDTH', 4096),
+            )
+
+        Api = get_db_api(is_cached=DB_API.get('CACHED', True))
         self.db_api = Api(
             DB_API['HOST'], DB_API['PORT'],
             http_client=AsyncHTTPClient(),
-            resolver=Resolver(
-                ttl=DNS_RECORD_TTL
-            ),
+            resolver=resolver,
+            pool=pool,
             cache=self.cache,
+            local_cache=local_cache,
+            cache_meta_data=cache_meta_data,
+            tag_rules=tag_rules,
+            cache_active_invalidation=DB_API.get('ACTIVE_INVALIDATION', False),
+            refresh_ahead=refresh_ahead,
             cache_key_ttl=DB_API['CACHE_KEY_TTL'],
+            cache_stale_ttl=DB_API.get('CACHE_STALE_TTL', 0),
+            cache_stale_if_error=DB_API.get('CACHE_STALE_IF_ERROR', 0),
+            cache_xfetch_beta=DB_API.get('CACHE_XFETCH_BETA', 1.0),
             connect_timeout=CURL['CONNECT_TIMEOUT'],
             request_timeout=CURL['REQUEST_TIMEOUT'],
         )
 
+        # сжатые gzip варианты ответов с ETag, по ETag
+        self.gzip_cache = None
+        if GZIP:
+            self.gzip_cache = LocalCache(max_bytes=GZIP['CACHE_BYTES'], key_ttl=GZIP['KEY_TTL'])
+
+        self.register_metrics(resolver, local_cache, pool, refresh_ahead)
+
+        # /ready отвечает 200 только после прогрева кэша
+        self.ready = True
+        if DB_API.get('WARMUP') and DB_API.get('CACHED', True):
+            self.ready = False
+            tornado.ioloop.IOLoop.instance().add_future(
+                self.warm_up(DB_API['WARMUP']),
+                lambda future: future.result()
+            )
+
         self.jinja = Environment(
             loader=FileSystemLoader(
                 JINJA['TEMPLATE_ROOT']
@@ -69,7 +168,10 @@ class NightpartyApplication(tornado.web.Application):
         )
 
         handlers += [
+            (r'/db/_batch', DBApiBatchHandler),
             (r'/db/(?P<api_path>.*)', DBApiRequestHandler),
+            (r'/metrics', MetricsHandler),
+            (r'/ready', ReadyHandler),
         ]
 
         if DEBUG:
@@ -77,21 +179,148 @@ class NightpartyApplication(tornado.web.Application):
                 (r'/test/', TestView),
             ]
 
+        streaming = DB_API.get('STREAMING') or {}
+        batch = DB_API.get('BATCH') or {}
+
         config = dict(
             debug=DEBUG,
+            db_api_passthrough=DB_API.get('PASSTHROUGH', False),
+            db_api_streaming_routes=[re.compile(route) for route in streaming.get('ROUTES', [])],
+            db_api_streaming_min_size=streaming.get('MIN_SIZE'),
+            db_api_streaming_tee_limit=streaming.get('CACHE_MAX_SIZE', 0),
+            db_api_streaming_max_pending=streaming.get('MAX_PENDING'),
+            db_api_server_timing=DB_API.get('SERVER_TIMING', False),
+            db_api_slow_request_ms=DB_API.get('SLOW_REQUEST_MS'),
+            db_api_batch_max_items=batch.get('MAX_ITEMS', 50),
+            db_api_batch_concurrency=batch.get('CONCURRENCY', 10),
+            gzip_min_size=(GZIP or {}).get('MIN_SIZE', 0),
+            gzip_level=(GZIP or {}).get('LEVEL', 6),
         )
 
         tornado.web.Application.__init__(self, handlers, **config)
 
+    @tornado.gen.coroutine
+    def warm_up(self, warmup):
+        urls = list(warmup.get('URLS', []))
+        if warmup.get('ACCESS_LOG'):
+            try:
+                urls += urls_from_access_log(warmup['ACCESS_LOG'], top=warmup.get('TOP', 100))
+            except OSError as e:
+                logging.warning('cache warm-up: access log is not readable: %s', e)
+
+        # у каждого воркера своя часть списка
+        shard = (0, 1)
+        if tornado.process.task_id() is not None:
+            shard = (tornado.process.task_id(), PROCESSES['WORKERS'] or tornado.process.cpu_count())
+
+        try:
+            yield CacheWarmer(
+                self.db_api,
+                urls,
+                concurrency=warmup.get('CONCURRENCY', 5),
+                budget=warmup.get('BUDGET', 30),
+                shard=shard,
+            ).run()
+        finally:
+            self.ready = True
+
+    def register_metrics(self, resolver, local_cache, pool, refresh_ahead=None):
+        """
+            Готовая статистика компонентов, читается при выдаче /metrics
+        """
+        REGISTRY.stats(
+            'db_api_events_total', 'DB API cache events',
+            lambda: getattr(self.db_api, 'stats', None),
+        )
+        REGISTRY.stats('dns_cache_events_total', 'DNS cache events', lambda: resolver.stats)
+        REGISTRY.stats(
+            'redis_codec_events_total', 'Redis value compression', lambda: self.cache.codec.stats,
+        )
+        if local_cache is not None:
+            REGISTRY.stats('local_cache_events_total', 'L1 cache events', lambda: local_cache.stats)
+            REGISTRY.stats(
+                'local_cache_bytes', 'L1 cache size',
+                lambda: {'size': local_cache.size}, type='gauge',
+            )
+        if self.gzip_cache is not None:
+            REGISTRY.stats(
+                'gzip_cache_events_total', 'Pre-compressed gzip variants',
+                lambda: self.gzip_cache.stats,
+            )
+        if refresh_ahead is not None:
+            REGISTRY.stats(
+                'db_api_refresh_ahead_total', 'Refresh-ahead decisions',
+                lambda: refresh_ahead.stats,
+            )
+
+        if pool is not None:
+            def backend_stats(*fields):
+                return lambda: {
+                    (address, field): stats[field]
+                    for address, stats in pool.stats().items()
+                    for field in fields
+                    if field in stats
+                }
+            REGISTRY.stats(
+                'db_api_backend_events_total', 'DB API backend requests',
+                backend_stats('requests', 'errors', 'fail_fast'), label=('backend', 'event'),
+            )
+            REGISTRY.stats(
+                'db_api_backend_load', 'DB API backend in-flight requests and EWMA latency',
+                backend_stats('inflight', 'ewma'), label=('backend', 'value'), type='gauge',
+            )
+            REGISTRY.stats(
+                'db_api_circuit_transitions_total', 'Circuit breaker transitions by target state',
+                lambda: {
+                    (address, state): count
+                    for address, stats in pool.stats().items()
+                    for state, count in stats.get('transitions', {}).items()
+                },
+                label=('backend', 'state'),
+            )
+            REGISTRY.stats(
+                'db_api_circuit_open', 'Circuit breaker is not closed',
+                lambda: {
+                    address: int(stats['state'] != 'closed')
+                    for address, stats in pool.stats().items()
+                    if 'state' in stats
+                },
+                label='backend', type='gauge',
+            )
+
 
 def make_app(handlers=None):
     """ для тестов """
     return NightpartyApplication(handlers)
 
 
+def run_workers(port, workers=0, reuse_port=True, max_restarts=100):
+    """
+        Pre-fork: родитель форкает workers процессов (0 - по числу ядер)
+        и перезапускает умершие, сам запросы не обслуживает.
+
+        Приложение (redis, http клиент, resolver, IOLoop) создается
+        уже в воркере. С reuse_port каждый воркер открывает свои сокеты
+        с SO_REUSEPORT и соединения между ними раскладывает ядро, без
+        него воркеры делят сокеты, открытые до форка.
+    """
+    sockets = None
+    if not reuse_port:
+        sockets = tornado.netutil.bind_sockets(port)
+
+    tornado.process.fork_processes(workers, max_restarts=max_restarts)
+
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(port, reuse_port=True)
+    logging.info('worker %s started, pid %s', tornado.process.task_id(), os.getpid())
+
+    server = tornado.httpserver.HTTPServer(NightpartyApplication())
+    server.add_sockets(sockets)
+    tornado.ioloop.IOLoop.instance().start()
+
+
 if __name__ == "__main__":
     if DEBUG:
-        import os
         path = os.path.dirname(os.path.realpath(__file__))
         tornado.autoreload.start()
         for dir, _, files in os.walk(path + '/'):
@@ -101,7 +330,16 @@ if __name__ == "__main__":
     options.parse_command_line()
     logging.debug('Nightparty!')
 
-    application = NightpartyApplication()
-    application.listen(PORT)
+    # autoreload с форком не работает, в DEBUG всегда один процесс
+    if DEBUG or PROCESSES['WORKERS'] == 1:
+        application = NightpartyApplication()
+        application.listen(PORT)
 
-    tornado.ioloop.IOLoop.instance().start()
+        tornado.ioloop.IOLoop.instance().start()
+    else:
+        run_workers(
+            PORT,
+            workers=PROCESSES['WORKERS'],
+            reuse_port=PROCESSES.get('REUSE_PORT', True),
+            max_restarts=PROCESSES.get('MAX_RESTARTS', 100),
+        )
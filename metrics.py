@@ -0,0 +1,176 @@
+"""
+    Метрики процесса в текстовом формате Prometheus
+
+    Счетчики и гистограммы с фиксированными корзинами, значения
+    лежат в dict по кортежу значений меток, запись - поиск в dict
+    и bisect, без блокировок (у каждого воркера свой IOLoop и свой
+    REGISTRY).
+
+        REQUESTS = REGISTRY.counter('requests_total', 'Requests', ['route', 'outcome'])
+        REQUESTS.inc('/api/events/', 'hit')
+
+        LATENCY = REGISTRY.histogram('request_seconds', 'Latency', ['route'])
+        LATENCY.observe(0.012, '/api/events/')
+
+    Готовые dict со статистикой (db_api.stats, LocalCache.stats, ...)
+    подключаются через REGISTRY.stats и читаются только при выдаче.
+"""
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def render(self):
+        for labels, value in sorted(self.values.items()):
+            yield '%s%s %s' % (self.name, _format_labels(self.labels, labels), _format_value(value))
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram:
+    """
+        buckets - верхние границы корзин по возрастанию, +Inf добавляется сам
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам (последняя - +Inf), сумма]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def count(self, *labels):
+        data = self.values.get(labels)
+        return sum(data[0]) if data else 0
+
+    def render(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.labels, labels, ('le', _format_value(float(bound)))),
+                    cumulative,
+                )
+            yield '%s_sum%s %s' % (self.name, _format_labels(self.labels, labels), repr(total))
+            yield '%s_count%s %d' % (self.name, _format_labels(self.labels, labels), cumulative)
+
+
+class StatsCollector:
+    """
+        dict со счетчиками как одна метрика с меткой по ключу;
+        label - кортеж, если ключи dict - кортежи
+    """
+
+    def __init__(self, name, help, getter, label='event', labels=None, type='counter'):
+        self.name = name
+        self.help = help
+        self.getter = getter
+        self.label = label if isinstance(label, tuple) else (label, )
+        self.const_labels = labels or {}
+        self.TYPE = type
+
+    def render(self):
+        stats = self.getter() or {}
+        names = tuple(self.const_labels) + self.label
+        for key, value in sorted(stats.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                key = key if isinstance(key, tuple) else (key, )
+                values = tuple(self.const_labels.values()) + key
+                yield '%s%s %s' % (self.name, _format_labels(names, values), _format_value(value))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('metric %s is already registered' % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def stats(self, name, help, getter, label='event', labels=None, type='counter'):
+        """
+            getter() -> dict, читается при каждой выдаче /metrics;
+            повторная регистрация имени заменяет старый getter
+        """
+        self.metrics.pop(name, None)
+        return self._add(StatsCollector(name, help, getter, label, labels, type))
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            samples = list(metric.render())
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.TYPE))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
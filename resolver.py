@@ -1,29 +1,119 @@
+import heapq
 import socket
 from time import time
 import logging
 
 from tornado import gen
+from tornado.ioloop import IOLoop
 from tornado.platform.caresresolver import CaresResolver
 
 
 class Resolver(CaresResolver):
+    """
+        CaresResolver с кэшем ответов
+
+        ttl          - сколько секунд живет удачный ответ
+        negative_ttl - сколько секунд помним ошибку, чтобы не
+                       долбить DNS на каждый запрос
+        prefetch     - за сколько секунд до истечения записи
+                       обновить ее в фоне (по умолчанию ttl / 10)
+
+        Истекшие записи удаляются по куче сроков, одновременные
+        запросы одного имени ждут один общий запрос в c-ares.
+    """
     def initialize(self, *args, **kwargs):
         self._dns_record_ttl = kwargs.pop('ttl', 3600)
+        self._negative_ttl = kwargs.pop('negative_ttl', 1)
+        self._prefetch = kwargs.pop('prefetch', self._dns_record_ttl / 10)
+        # (host, port, family) -> {'addresses', 'error', 'expires'}
         self._dns_cache = {}
+        # (expires, key); запись удаляется, только если ее срок не продлен
+        self._expiry = []
+        # (host, port, family) -> future запроса в c-ares
+        self._inflight = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'prefetches': 0,
+            'negative_hits': 0,
+            'errors': 0,
+        }
         super().initialize(*args, **kwargs)
 
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            entry = self._dns_cache.get(key)
+            if entry is not None and entry['expires'] <= now:
+                del self._dns_cache[key]
+
+    def _store(self, key, addresses, error, expires):
+        self._dns_cache[key] = dict(
+            addresses=addresses,
+            error=error,
+            expires=expires,
+        )
+        heapq.heappush(self._expiry, (expires, key))
+
     @gen.coroutine
-    def resolve(self, host, port, family=socket.AF_INET):
-        now = time()
-        self._dns_cache = {k: v for k, v in self._dns_cache.items() if v['ttl'] > now}
-        if ((host, port) not in self._dns_cache):
+    def _query(self, host, port, family):
+        key = (host, port, family)
+        try:
             addresses = yield super().resolve(host, port, family=family)
-            self._dns_cache[(host, port)] = dict(
-                addresses=addresses,
-                ttl=now + self._dns_record_ttl,
-            )
-            logging.debug("Resolved hostname {}: {}".format(host, addresses))
-        else:
-            addresses = self._dns_cache[(host, port)]['addresses']
+        except Exception as e:
+            self.stats['errors'] += 1
+            now = time()
+            entry = self._dns_cache.get(key)
+            # при неудачном фоновом обновлении старый ответ еще годен
+            if entry is None or entry['error'] is not None or entry['expires'] <= now:
+                self._store(key, None, e, now + self._negative_ttl)
+            raise
 
+        self._store(key, addresses, None, time() + self._dns_record_ttl)
+        logging.debug("Resolved hostname {}: {}".format(host, addresses))
         return addresses  # noqa
+
+    def _lookup(self, key):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return future
+
+        future = self._query(*key)
+        if not future.done():
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._forget_inflight(key, f))
+        return future
+
+    def _forget_inflight(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    @staticmethod
+    def _prefetched(future):
+        if future.exception() is not None:
+            logging.warning('dns prefetch failed: %s', future.exception())
+
+    @gen.coroutine
+    def resolve(self, host, port, family=socket.AF_INET):
+        now = time()
+        self._expire(now)
+
+        key = (host, port, family)
+        entry = self._dns_cache.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            addresses = yield self._lookup(key)
+            return addresses  # noqa
+
+        if entry['error'] is not None:
+            self.stats['negative_hits'] += 1
+            raise entry['error'].with_traceback(None)
+
+        self.stats['hits'] += 1
+        if entry['expires'] - now <= self._prefetch and key not in self._inflight:
+            self.stats['prefetches'] += 1
+            IOLoop.current().add_future(self._lookup(key), self._prefetched)
+
+        return entry['addresses']  # noqa
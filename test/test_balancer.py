@@ -0,0 +1,201 @@
+from io import BytesIO
+from mock import Mock, patch
+from urllib.parse import urlsplit
+
+from tornado import gen
+from tornado.httpclient import HTTPResponse
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from db_api import BackendPool, CircuitBreaker, DBApiCached, DBApiDirect
+from test.test_db_api import TestCache, resolved
+
+
+class BackendPoolTest(AsyncTestCase):
+
+    @gen_test
+    def test_least_outstanding(self):
+        pool = BackendPool([('10.0.0.1', 80), ('10.0.0.2', 80)], strategy='least_outstanding')
+        busy, idle = pool.backends[('10.0.0.1', 80)], pool.backends[('10.0.0.2', 80)]
+        busy.start()
+        busy.start()
+        idle.start()
+
+        for _ in range(5):
+            backend = yield pool.choose()
+            self.assertIs(backend, idle)
+
+    @gen_test
+    def test_ewma_avoids_slow_backend(self):
+        pool = BackendPool([('10.0.0.1', 80), ('10.0.0.2', 80)], strategy='ewma')
+        slow, fast = pool.backends[('10.0.0.1', 80)], pool.backends[('10.0.0.2', 80)]
+        for backend, latency in [(slow, 0.5), (fast, 0.01)]:
+            backend.start()
+            backend.finish(latency)
+
+        # в быстрый уже летят запросы, но он все равно лучше
+        fast.start()
+        fast.start()
+        backend = yield pool.choose()
+        self.assertIs(backend, fast)
+
+        # если быстрый адрес затормозил, это видно сразу
+        fast.start()
+        fast.finish(1.0)
+        backend = yield pool.choose()
+        self.assertIs(backend, slow)
+
+    @gen_test
+    def test_ewma_hung_backend_without_samples(self):
+        pool = BackendPool([('10.0.0.1', 80), ('10.0.0.2', 80)], strategy='ewma')
+        hung, alive = pool.backends[('10.0.0.1', 80)], pool.backends[('10.0.0.2', 80)]
+        # ни одного ответа: ewma не измерена, но запросы в полете видны
+        for _ in range(50):
+            hung.start()
+
+        for _ in range(20):
+            backend = yield pool.choose()
+            self.assertIs(backend, alive)
+
+        alive.start()
+        alive.finish(0.01)
+        for _ in range(20):
+            backend = yield pool.choose()
+            self.assertIs(backend, alive)
+        self.assertFalse(hung.measured)
+
+        # новый адрес без запросов получает нагрузку, когда известный занят
+        fresh = pool._backend('10.0.0.3', 80)
+        pool._active.append(fresh)
+        alive.start()
+        backend = yield pool.choose()
+        self.assertIs(backend, fresh)
+
+    @gen_test
+    def test_dns_backends(self):
+        resolver = Mock()
+        resolver.resolve.return_value = resolved([(2, ('10.0.0.1', 8000)), (2, ('10.0.0.2', 8000))])
+        pool = BackendPool(backends=[('10.0.0.9', 8000)], dns=('db', 8000), resolver=resolver)
+
+        chosen = set()
+        for _ in range(30):
+            backend = yield pool.choose()
+            chosen.add(backend.address)
+        self.assertEqual(chosen, {('10.0.0.1', 8000), ('10.0.0.2', 8000), ('10.0.0.9', 8000)})
+
+        resolver.resolve.return_value = resolved([(2, ('10.0.0.2', 8000))])
+        yield pool.choose()
+        self.assertEqual(set(pool.backends), {('10.0.0.2', 8000), ('10.0.0.9', 8000)})
+
+    @gen_test
+    def test_db_api_tracks_backend(self):
+        pool = BackendPool([('10.0.0.1', 8000)])
+        db_api = DBApiDirect('db', 8000, pool=pool, resolver=Mock(), http_client=Mock())
+        backend = pool.backends[('10.0.0.1', 8000)]
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            self.assertTrue(request.url.startswith('http://10.0.0.1:8000/'))
+            self.assertEqual(backend.inflight, 1)
+            return HTTPResponse(request, 502, None, BytesIO(b'{}'))
+        db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        is_ok, res = yield db_api.request('GET', path='/api/events/')
+        self.assertTrue(is_ok)
+        self.assertEqual(res['code'], 502)
+        self.assertEqual(backend.inflight, 0)
+        self.assertEqual(backend.stats, {'requests': 1, 'errors': 1, 'fail_fast': 0})
+
+    @gen_test
+    def test_concurrent_misses_spread_across_backends(self):
+        pool = BackendPool([('10.0.0.1', 8000), ('10.0.0.2', 8000)])
+        db_api = DBApiCached(
+            'db', 8000, pool=pool, resolver=Mock(), http_client=Mock(), cache=TestCache(),
+        )
+        hosts = []
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            hosts.append(urlsplit(request.url).hostname)
+            yield gen.sleep(0.01)
+            return HTTPResponse(request, 200, None, BytesIO(b'{}'))
+        db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        yield [db_api.request('GET', path='/api/events/%d/' % i) for i in range(4)]
+        self.assertEqual(sorted(hosts), ['10.0.0.1'] * 2 + ['10.0.0.2'] * 2)
+
+        # попадание в кэш адрес не выбирает
+        with patch.object(pool, 'pick', Mock(wraps=pool.pick)) as pick:
+            yield db_api.request('GET', path='/api/events/1/')
+        self.assertFalse(pick.called)
+        self.assertEqual(len(hosts), 4)
+
+
+class CircuitBreakerTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100.0
+        self.io_loop.time = lambda: self.now
+
+    def test_consecutive_timeouts(self):
+        breaker = CircuitBreaker(max_failures=3, open_timeout=5)
+        breaker.record(error=True, timeout=True)
+        breaker.record(error=True, timeout=True)
+        breaker.record()
+        breaker.record(error=True, timeout=True)
+        breaker.record(error=True, timeout=True)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+        breaker.record(error=True, timeout=True)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        # один пробный запрос после open_timeout
+        self.now += 5
+        self.assertTrue(breaker.available)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertFalse(breaker.available)
+        self.assertFalse(breaker.allow())
+
+        breaker.record(error=True, timeout=True)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        self.now += 5
+        self.assertTrue(breaker.allow())
+        breaker.record()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.transitions, {'closed': 1, 'open': 2, 'half_open': 2})
+
+    def test_error_rate(self):
+        breaker = CircuitBreaker(error_rate=0.5, window=10, min_requests=4)
+        for error in [True, False, True]:
+            breaker.record(error=error)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record(error=False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    @gen_test
+    def test_open_backend_is_skipped_and_fails_fast(self):
+        pool = BackendPool(
+            [('10.0.0.1', 8000), ('10.0.0.2', 8000)],
+            breaker={'max_failures': 1},
+        )
+        dead, alive = pool.backends[('10.0.0.1', 8000)], pool.backends[('10.0.0.2', 8000)]
+        dead.start()
+        dead.finish(5.0, error=True, timeout=True)
+
+        for _ in range(5):
+            backend = yield pool.choose()
+            self.assertIs(backend, alive)
+
+        alive.start()
+        alive.finish(5.0, error=True, timeout=True)
+        self.assertEqual(pool.stats()['10.0.0.2:8000']['state'], 'open')
+
+        db_api = DBApiDirect('db', 8000, pool=pool, resolver=Mock(), http_client=Mock())
+        is_ok, res = yield db_api.request('GET', path='/api/events/')
+        self.assertEqual(res['code'], 599)
+        self.assertFalse(db_api._http_client.fetch.called)
+        self.assertEqual(dead.stats['fail_fast'] + alive.stats['fail_fast'], 1)
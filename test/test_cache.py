@@ -0,0 +1,197 @@
+from pprint import pprint as pp  # noqa
+from io import BytesIO
+from mock import Mock, patch
+from time import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPResponse
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from async_redis import RedisConnection, RedisConnectionError
+from bench.fake_redis import FakeRedisServer
+from cache import RedisCache, LocalCache
+from db_api import DBApiCached
+from test.test_db_api import resolved
+
+
+class RedisCacheTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = FakeRedisServer()
+        port = self.server.listen_random_port()
+
+        self.cache = RedisCache(host='127.0.0.1', port=port)
+        self.cache.initialize(key_ttl=10)
+
+    def tearDown(self):
+        self.cache.redis_connection.disconnect()
+        self.server.stop()
+        super().tearDown()
+
+    @gen.coroutine
+    def connect(self):
+        yield self.cache.redis_connection.connect()
+        self.cache.state = self.cache.state_map[self.cache.CONNECTED]
+
+    @gen_test
+    def test_disconnected_state_is_a_miss(self):
+        yield self.cache.set('key', b'value')
+        exists = yield self.cache.exists('key')
+        value = yield self.cache.get('key')
+
+        self.assertFalse(exists)
+        self.assertIsNone(value)
+        self.assertEqual(self.server.data, {})
+
+    @gen_test
+    def test_connected_roundtrip(self):
+        yield self.connect()
+
+        yield self.cache.set('key', b'value')
+        exists = yield self.cache.exists('key')
+        value = yield self.cache.get('key')
+        self.assertTrue(exists)
+        self.assertEqual(value, b'value')
+        self.assertIn(b'key', self.server.expires)
+
+        yield self.cache.delete('key')
+        value = yield self.cache.get('key')
+        self.assertIsNone(value)
+
+    @gen_test
+    def test_bulk_operations(self):
+        self.assertEqual((yield self.cache.get_many(['a', 'b'])), [None, None])
+
+        yield self.connect()
+        self.server.commands_processed = 0
+        yield self.cache.set_many({'a': b'A', 'b': b'B'}, key_ttl=5)
+        yield self.cache.set_many([('c', b'C')])
+        self.assertEqual(self.server.commands_processed, 3)
+        self.assertEqual(set(self.server.expires), {b'a', b'b', b'c'})
+
+        values = yield self.cache.get_many(['a', 'missing', 'c'])
+        self.assertEqual(values, [b'A', None, b'C'])
+        self.assertEqual(self.server.commands_processed, 4)
+
+        yield self.cache.delete_many(['a', 'b'])
+        self.assertEqual((yield self.cache.get_many(['a', 'b', 'c'])), [None, None, b'C'])
+        self.assertEqual((yield self.cache.get_many([])), [])
+
+    @gen_test
+    def test_single_key_ops_are_one_command(self):
+        yield self.connect()
+        self.server.commands_processed = 0
+        yield self.cache.set('key', b'value')
+        value = yield self.cache.get('key')
+        self.assertEqual(value, b'value')
+        self.assertEqual(self.server.commands_processed, 2)
+
+    @gen_test
+    def test_compression(self):
+        yield self.connect()
+        self.cache.initialize(key_ttl=10, compress_min_size=100)
+
+        page = b'<tr><td>event</td></tr>' * 100
+        yield self.cache.set('page', page)
+        yield self.cache.set('small', b'small')
+        yield self.cache.set('zero', b'\x00zero')
+
+        self.assertTrue(self.server.data[b'page'].startswith(b'\x00Z'))
+        self.assertLess(len(self.server.data[b'page']), len(page) / 10)
+        self.assertEqual(self.server.data[b'small'], b'small')
+        self.assertEqual(self.server.data[b'zero'], b'\x00\x00\x00zero')
+
+        values = yield [self.cache.get(key) for key in ['page', 'small', 'zero']]
+        self.assertEqual(values, [page, b'small', b'\x00zero'])
+        self.assertEqual(self.cache.codec.stats['compressed'], 1)
+        self.assertLess(self.cache.codec.compression_ratio, 0.1)
+
+    @gen_test
+    def test_concurrent_requests_share_connection(self):
+        yield self.connect()
+
+        yield [self.cache.set('key-%d' % i, str(i)) for i in range(20)]
+        values = yield [self.cache.get('key-%d' % i) for i in range(20)]
+        self.assertEqual(values, [str(i).encode() for i in range(20)])
+
+    @gen_test
+    def test_stalled_redis_falls_back_to_upstream(self):
+        self.assertEqual(self.cache.redis_connection.socket_timeout, RedisCache.SOCKET_TIMEOUT)
+        self.cache.redis_connection.socket_timeout = 0.05
+        yield self.connect()
+        # redis принимает команды, но не отвечает
+        self.server.delay = 10
+
+        db_api = DBApiCached(
+            'localhost', 8000, http_client=Mock(), resolver=Mock(), cache=self.cache,
+        )
+        db_api._http_client.fetch.side_effect = lambda request, **kwargs: resolved(
+            HTTPResponse(request, 200, None, BytesIO(b'{"version": 1}'))
+        )
+        started = time()
+        res = yield db_api._request('localhost', 8000, 'GET', '/api/events/')
+        self.assertEqual(res['data'], {'version': 1})
+        self.assertLess(time() - started, 1)
+        self.assertIs(self.cache.state, self.cache.state_map[self.cache.DISCONNECTED])
+
+    @gen_test
+    def test_connect_timeout(self):
+        connection = RedisConnection('127.0.0.1', 6379, connect_timeout=0.05)
+        with patch('async_redis.TCPClient') as tcp_client:
+            tcp_client.return_value.connect.return_value = Future()
+            with self.assertRaises(RedisConnectionError):
+                yield connection.connect()
+        self.assertFalse(connection.is_connected)
+
+    @gen_test
+    def test_fallback_when_redis_goes_away(self):
+        yield self.connect()
+        self.server.stop()
+        self.server.disconnect_clients()
+        yield gen.sleep(0.01)
+
+        value = yield self.cache.get('key')
+        self.assertIsNone(value)
+        self.assertEqual(self.cache.state, self.cache.state_map[self.cache.DISCONNECTED])
+
+
+class LocalCacheTest(AsyncTestCase):
+
+    def test_lru_eviction_by_size(self):
+        cache = LocalCache(max_bytes=10, key_ttl=60)
+        cache.set('a', 'A', 4)
+        cache.set('b', 'B', 4)
+        self.assertEqual(cache.get('a'), 'A')
+
+        cache.set('c', 'C', 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+        cache.set('huge', 'H', 11)
+        self.assertIsNone(cache.get('huge'))
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl_is_capped(self):
+        cache = LocalCache(max_bytes=10, key_ttl=5)
+        with patch('cache.time', Mock(return_value=100.0)):
+            cache.set('a', 'A', 1, key_ttl=60)
+            cache.set('b', 'B', 1, key_ttl=2)
+            cache.set('gone', 'G', 1, key_ttl=-1)
+
+        with patch('cache.time', Mock(return_value=103.0)):
+            self.assertEqual(cache.get('a'), 'A')
+            self.assertIsNone(cache.get('b'))
+            self.assertIsNone(cache.get('gone'))
+
+        with patch('cache.time', Mock(return_value=106.0)):
+            self.assertIsNone(cache.get('a'))
+
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['expired'], 2)
+        self.assertEqual(cache.size, 0)
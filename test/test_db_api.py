@@ -1,41 +1,93 @@
 # import tornado
+from unittest import TestCase
 from urllib.parse import urlencode
 from pprint import pprint as pp  # noqa
 from mock import Mock, patch
 from io import BytesIO
 from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from time import time
 
+import gzip
 import json
+import re
 
 from tornado.httpclient import HTTPResponse, HTTPRequest
+from tornado.concurrent import Future
 from tornado import gen
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase
 from tornado.testing import gen_test
 from tornado.web import RequestHandler
 from tornado.httputil import HTTPHeaders
+from tornado.iostream import StreamClosedError
 
 
+from handlers.handlers import DBApiRequestHandler
 from handlers.tools import (
     JinjaTemplateMixin,
     CacheMixin,
+    accepts_gzip,
+    write_variant,
 )
 
 
+from bench.fake_redis import FakeRedisServer
+from cache import LocalCache, RedisCache, ValueCodec
+from db_api import (
+    BackendPool,
+    CacheFormatError,
+    CacheWarmer,
+    CountMinSketch,
+    DBApiCached,
+    CacheMetaDataValidator,
+    SharedCacheMetaDataValidator,
+    RefreshAhead,
+    TagRules,
+    urls_from_access_log,
+)
+from db_api.cache_format import content_etag, pack_entry, unpack_entry
+
 import main
 
 
+def resolved(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+@gen.coroutine
+def wait_for(condition, timeout=1):
+    deadline = time() + timeout
+    while not condition() and time() < deadline:
+        yield gen.sleep(0.01)
+    return condition()  # noqa
+
+
 class TestCache(dict):
+    @gen.coroutine
     def get(self, key):
-        return super().get(key).encode()
+        return super().get(key)  # noqa
 
+    @gen.coroutine
     def set(self, key, value, key_ttl):
         self[key] = value
 
+    @gen.coroutine
     def delete(self, key):
         del self[key]
 
+    @gen.coroutine
     def exists(self, key):
-        return key in self
+        return key in self  # noqa
+
+    @gen.coroutine
+    def pipeline(self, commands):
+        return None
+
+    @gen.coroutine
+    def get_many(self, keys):
+        return [super(TestCache, self).get(key) for key in keys]  # noqa
 
 
 class CacheDBApiTest(AsyncHTTPTestCase):
@@ -75,8 +127,7 @@ class CacheDBApiTest(AsyncHTTPTestCase):
             options={
             },
             **{
-                'exists.return_value': True,
-                'get.return_value': 'cached response',
+                'get.return_value': resolved('cached response'),
             }
         )
         response = yield self.http_client.fetch(url, method='GET')
@@ -97,9 +148,8 @@ class CacheDBApiTest(AsyncHTTPTestCase):
             options={
             },
             **{
-                'exists.return_value': False,
-                'get.return_value': 'cached response',
-                'set.return_value': True,
+                'get.return_value': resolved(None),
+                'set.return_value': resolved(True),
             }
         )
 
@@ -107,6 +157,100 @@ class CacheDBApiTest(AsyncHTTPTestCase):
         self.assertEqual(response.body, b'chunk-1*chunk-2*chunk-3')
         self.assertEqual(self.application.cache.set.called, True)
 
+    @gen_test
+    def test_cache_mixin_if_none_match(self):
+        self.application.cache = TestCache()
+        self.application.cache.options = {}
+        url = self.get_url('/testme/?city=moscow')
+
+        response = yield self.http_client.fetch(url)
+        etag = response.headers['Etag']
+        self.assertEqual(etag, content_etag(b'chunk-1*chunk-2*chunk-3'))
+        # кодек redis пишет запись как есть, без экранирования \x00
+        value, = self.application.cache.values()
+        self.assertEqual(ValueCodec(min_size=None).encode(value), value)
+
+        response = yield self.http_client.fetch(
+            url, headers={'If-None-Match': etag}, raise_error=False,
+        )
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+
+        response = yield self.http_client.fetch(url, headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.body, b'chunk-1*chunk-2*chunk-3')
+        self.assertEqual(response.headers['Etag'], etag)
+
+    @gen_test
+    def test_db_api_if_none_match(self):
+        self.application.db_api.cache = TestCache()
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            return HTTPResponse(request, 200, None, BytesIO(b'{"id": 42}'))
+        self.application.db_api._http_client = Mock()
+        self.application.db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        url = self.get_url('/db/api/events/42/')
+        response = yield self.http_client.fetch(url)
+        etag = response.headers['Etag']
+        self.assertEqual(etag, content_etag(b'{"id": 42}'))
+
+        response = yield self.http_client.fetch(
+            url, headers={'If-None-Match': 'W/%s' % etag}, raise_error=False,
+        )
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.headers['Etag'], etag)
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 1)
+
+    @gen_test
+    def test_gzip_variant(self):
+        self.application.db_api.cache = TestCache()
+        self.application.gzip_cache = LocalCache(max_bytes=1024 * 1024, key_ttl=60)
+        body = json.dumps({'events': [{'id': i, 'title': 'event'} for i in range(100)]}).encode()
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            return HTTPResponse(request, 200, None, BytesIO(body))
+        self.application.db_api._http_client = Mock()
+        self.application.db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        url = self.get_url('/db/api/events/')
+        plain = yield self.http_client.fetch(
+            url, headers={'Accept-Encoding': 'identity'}, decompress_response=False,
+        )
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+
+        with patch('handlers.tools.gzip.compress', Mock(wraps=gzip.compress)) as compress:
+            for _ in range(2):
+                response = yield self.http_client.fetch(
+                    url, headers={'Accept-Encoding': 'br;q=1.0, gzip;q=0.8'},
+                    decompress_response=False,
+                )
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(response.headers['Etag'], 'W/' + plain.headers['Etag'])
+                self.assertEqual(gzip.decompress(response.body), plain.body)
+            self.assertEqual(compress.call_count, 1)
+
+            response = yield self.http_client.fetch(
+                url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['Etag']},
+                raise_error=False,
+            )
+            self.assertEqual(response.code, 304)
+
+        # страница CacheMixin из кэша
+        self.application.cache = TestCache()
+        self.application.cache.options = {}
+        self.application.settings['gzip_min_size'] = 0
+        yield self.http_client.fetch(self.get_url('/testme/'))
+        response = yield self.http_client.fetch(
+            self.get_url('/testme/'), headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.body), b'chunk-1*chunk-2*chunk-3')
+
     @gen_test
     def test_db_api_not_cached_ok(self):
         url = self.get_url('/db/api/places/')
@@ -118,7 +262,9 @@ class CacheDBApiTest(AsyncHTTPTestCase):
         )
 
         self.application.db_api.cache = Mock()
-        self.application.db_api.cache.exists.return_value = False
+        self.application.db_api.cache.get.return_value = resolved(None)
+        self.application.db_api.cache.set.return_value = resolved(True)
+        self.application.db_api.cache.pipeline.return_value = resolved(None)
 
         @gen.coroutine
         def mock_fetch(request, *args, **kwargs):
@@ -141,6 +287,255 @@ class CacheDBApiTest(AsyncHTTPTestCase):
         self.assertEqual(json.loads(response.body.decode())['data'], {"not_cached": "test"})
         self.assertEqual(self.application.db_api.cache.set.called, True)
 
+    @gen_test
+    def test_db_api_passthrough_keeps_body_bytes(self):
+        self.application.db_api.cache = TestCache()
+        body = b'{"results":[1,2,3],  "next" :null}'
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            headers = HTTPHeaders({'Content-Length': str(len(body)), 'X-Total': '3'})
+            return HTTPResponse(request, 200, headers, BytesIO(body))
+        self.application.db_api._http_client = Mock()
+        self.application.db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        for _ in range(2):
+            response = yield self.http_client.fetch(self.get_url('/db/api/events/'))
+            self.assertEqual(response.body, b'{"status": "ok", "data": ' + body + b'}')
+            self.assertEqual(response.headers['X-Total'], '3')
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 1)
+
+    def mock_stream_fetch(self, chunks, code=200, length=None, delay=0):
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            yield gen.sleep(delay)
+            request.header_callback('HTTP/1.1 200 OK\r\n')
+            if length is not None:
+                request.header_callback('Content-Length: %d\r\n' % length)
+            request.header_callback('X-Total: 3\r\n')
+            request.header_callback('\r\n')
+            for chunk in chunks:
+                request.streaming_callback(chunk)
+                yield gen.moment
+            return HTTPResponse(request, code, None, BytesIO())
+        self.application.db_api._http_client = Mock()
+        self.application.db_api._http_client.fetch.side_effect = mock_db_fetch
+
+    @gen_test
+    def test_db_api_streaming(self):
+        self.application.db_api.cache = TestCache()
+        self.application.settings['db_api_streaming_routes'] = [re.compile('^/api/export/')]
+        self.application.settings['db_api_streaming_tee_limit'] = 64
+        self.mock_stream_fetch([b'[1, ', b'2, ', b'3]'])
+
+        for _ in range(2):
+            response = yield self.http_client.fetch(self.get_url('/db/api/export/'))
+            self.assertEqual(response.body, b'{"status": "ok", "data": [1, 2, 3]}')
+            self.assertEqual(response.headers['X-Total'], '3')
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 1)
+
+        # больше tee_limit - не кэшируется
+        self.mock_stream_fetch([b'[', b'1, ' * 30, b'1]'])
+        response = yield self.http_client.fetch(self.get_url('/db/api/export/big/'))
+        self.assertEqual(response.body, b'{"status": "ok", "data": [' + b'1, ' * 30 + b'1]}')
+        self.assertNotIn('/api/export/big/||', self.application.db_api.cache)
+
+    @gen_test
+    def test_db_api_streaming_by_size(self):
+        self.application.db_api.cache = TestCache()
+        self.application.settings['db_api_streaming_min_size'] = 10
+        started = []
+        original = self.application.db_api.stream
+
+        def stream(*args, **kwargs):
+            started.append(kwargs['min_size'])
+            return original(*args, **kwargs)
+        self.application.db_api.stream = stream
+
+        self.mock_stream_fetch([b'[1]'], length=3)
+        response = yield self.http_client.fetch(self.get_url('/db/api/events/'))
+        self.assertEqual(response.body, b'{"status": "ok", "data": [1]}')
+        self.assertEqual(started, [10])
+        self.assertIn('/api/events/||', self.application.db_api.cache)
+
+    @gen_test
+    def test_db_api_streaming_by_size_is_coalesced(self):
+        # настройки стриминга как в config.yaml: каждый GET идет через stream()
+        self.application.db_api.cache = TestCache()
+        self.assertEqual(self.application.settings['db_api_streaming_min_size'], 1048576)
+        self.mock_stream_fetch([b'[1]'], length=3, delay=0.05)
+
+        url = self.get_url('/db/api/events/')
+        responses = yield [self.http_client.fetch(url) for _ in range(5)]
+        self.assertEqual({r.body for r in responses}, {b'{"status": "ok", "data": [1]}'})
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 1)
+        self.assertEqual(self.application.db_api.stats['coalesced'], 4)
+        self.assertEqual(self.application.db_api.refresh_ahead.sketch.estimate('/api/events/||'), 5)
+
+    @gen_test
+    def test_db_api_streamed_body_is_shared(self):
+        self.application.db_api.cache = TestCache()
+        size = self.application.settings['db_api_streaming_min_size']
+        body = b'[' + b'1, ' * (size // 3) + b'1]'
+        chunks = [body[i:i + 65536] for i in range(0, len(body), 65536)]
+        self.mock_stream_fetch(chunks, length=len(body), delay=0.05)
+
+        # тело влезло в tee_limit: ждущие получают его без своего запроса в базу
+        url = self.get_url('/db/api/export/')
+        responses = yield [self.http_client.fetch(url) for _ in range(3)]
+        self.assertEqual({r.body for r in responses}, {b'{"status": "ok", "data": ' + body + b'}'})
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 1)
+
+        # не влезло: ждущие идут в базу сами, каждый получает все тело
+        self.application.settings['db_api_streaming_tee_limit'] = 64
+        self.mock_stream_fetch(chunks, length=len(body), delay=0.05)
+        url = self.get_url('/db/api/events/')
+        responses = yield [self.http_client.fetch(url) for _ in range(3)]
+        self.assertEqual({r.body for r in responses}, {b'{"status": "ok", "data": ' + body + b'}'})
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 3)
+        self.assertEqual(self.application.db_api._inflight, {})
+
+    @gen_test
+    def test_db_api_streaming_broken(self):
+        self.application.db_api.cache = TestCache()
+        self.application.settings['db_api_streaming_routes'] = [re.compile('^/api/export/')]
+        self.mock_stream_fetch([b'[1, ', b'2, '], code=599)
+
+        # клиент должен увидеть оборванный ответ, а не валидный json
+        with self.assertRaises(Exception):
+            yield self.http_client.fetch(self.get_url('/db/api/export/'))
+        self.assertEqual(self.application.db_api.cache, {})
+
+    @gen_test
+    def test_db_api_streaming_slow_client(self):
+        self.application.db_api.cache = TestCache()
+        chunks = [b'[1, ', b'2, ', b'3]']
+
+        closed = Future()
+        closed.set_exception(StreamClosedError())
+        # клиент ничего не забирает (flush не завершается) или уже ушел:
+        # стрим обрывается на первом куске сверх лимита или после ухода
+        for flushed, max_pending, sent in [(Future(), 16, 1), (closed, None, 2)]:
+            self.application.settings['db_api_streaming_max_pending'] = max_pending
+            self.mock_stream_fetch(chunks)
+            with patch.object(DBApiRequestHandler, 'flush', Mock(return_value=flushed)):
+                with self.assertRaises(Exception):
+                    yield self.http_client.fetch(self.get_url('/db/api/export/'))
+
+            request = self.application.db_api._http_client.fetch.call_args[0][0]
+            stream = request.streaming_callback.__self__
+            self.assertTrue(stream.aborted)
+            self.assertEqual(stream.streamed_bytes, len(b''.join(chunks[:sent])))
+            self.assertEqual(self.application.db_api.cache, {})
+
+    def test_tag_rules_keep_url_tags(self):
+        # пути без своего правила в config.yaml размечаются как раньше
+        rules = self.application.db_api.cache_meta_data.tag_rules
+        for path, tags in [
+            ('/api/events/5/comments/', ['events']),
+            ('/api/events/5/places/7/photos/', ['events', 'places']),
+            ('/api/places/3/events/', ['events', 'places']),
+            ('/api/events/5/tag/', ['events', 'tag']),
+        ]:
+            self.assertEqual(rules.match(path), (tags, []))
+        self.assertEqual(rules.match('/api/events/5/'), (['events:5'], ['events']))
+
+    @gen_test
+    def test_metrics(self):
+        self.application.db_api.cache = TestCache()
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            return HTTPResponse(request, 200, None, BytesIO(b'{"id": 42}'))
+        self.application.db_api._http_client = Mock()
+        self.application.db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        for _ in range(2):
+            yield self.http_client.fetch(self.get_url('/db/api/events/42/'))
+
+        response = yield self.http_client.fetch(self.get_url('/metrics'))
+        body = response.body.decode()
+        for sample in [
+            'db_api_cache_requests_total{route="/api/events/{id}/",outcome="hit"}',
+            'db_api_cache_requests_total{route="/api/events/{id}/",outcome="miss"}',
+            'http_request_seconds_count{route="/api/events/{id}/",code="200"}',
+            'db_api_upstream_seconds_count{method="GET",status="2xx"}',
+            'db_api_events_total{event="upstream_fetches"} 1',
+        ]:
+            self.assertIn(sample, body)
+
+    @gen_test
+    def test_db_api_batch(self):
+        self.application.db_api.cache = TestCache()
+        self.application.db_api.local_cache = None
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            if '/boom/' in request.url:
+                raise IOError('connection reset')
+            if '/404/' in request.url:
+                return HTTPResponse(request, 404, None, BytesIO(b'{"detail": "not found"}'))
+            body = b'{"url": "%s"}' % request.url.encode()
+            return HTTPResponse(request, 200, None, BytesIO(body))
+        self.application.db_api._http_client = Mock()
+        self.application.db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        yield self.http_client.fetch(self.get_url('/db/api/events/1/'))
+        self.application.db_api.cache.get_many = Mock(wraps=self.application.db_api.cache.get_many)
+
+        body = json.dumps({
+            'requests': [
+                {'path': '/api/events/1/'},
+                {'path': 'api/events/2/', 'params': {'city': 'moscow'}},
+                {'path': '/api/events/404/'},
+                {'path': '/api/boom/'},
+            ],
+        })
+        response = yield self.http_client.fetch(
+            self.get_url('/db/_batch'), method='POST', body=body,
+        )
+        items = json.loads(response.body.decode())['data']
+
+        self.assertEqual([item['status'] for item in items], ['ok', 'ok', 'fail', 'fail'])
+        self.assertEqual([item['code'] for item in items], [200, 200, 404, 502])
+        self.assertTrue(items[1]['data']['url'].endswith('/api/events/2/?city=moscow'))
+        self.assertEqual(items[2]['data'], {'detail': 'not found'})
+        # первый из кэша, остальные три - в базу
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 4)
+        self.assertEqual(self.application.db_api.cache.get_many.call_count, 1)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/db/_batch'), method='POST', body='{"requests": [1]}', raise_error=False,
+        )
+        self.assertEqual(response.code, 400)
+
+    @gen_test
+    def test_server_timing_and_slow_log(self):
+        self.application.db_api.cache = TestCache()
+        self.application.db_api.local_cache = LocalCache(max_bytes=1024, key_ttl=5)
+        self.application.settings['db_api_server_timing'] = True
+        self.application.settings['db_api_slow_request_ms'] = 0.001
+
+        @gen.coroutine
+        def mock_db_fetch(request, *args, **kwargs):
+            return HTTPResponse(request, 200, None, BytesIO(b'{"id": 42}'))
+        self.application.db_api._http_client = Mock()
+        self.application.db_api._http_client.fetch.side_effect = mock_db_fetch
+
+        with self.assertLogs(level='WARNING') as logs:
+            response = yield self.http_client.fetch(self.get_url('/db/api/events/42/'))
+        spans = [item.split(';')[0] for item in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(spans, ['resolve', 'l1', 'redis', 'upstream', 'format', 'encode', 'total'])
+
+        slow = json.loads(logs.records[-1].getMessage().split(' ', 2)[2])
+        self.assertEqual(slow['route'], '/api/events/{id}/')
+        self.assertEqual(list(slow['spans_ms']), spans[:-1])
+
+        self.application.db_api.local_cache = None
+        response = yield self.http_client.fetch(self.get_url('/db/api/events/42/'))
+        self.assertIn('deserialize;dur=', response.headers['Server-Timing'])
+        self.assertNotIn('upstream', response.headers['Server-Timing'])
+
     @gen_test
     def test_db_api_cached_ok(self):
         url = self.get_url('/db/api/places/')
@@ -172,16 +567,22 @@ class CacheDBApiTest(AsyncHTTPTestCase):
             response = yield self.http_client.fetch(request, raise_error=False)
 
         cached_request = self.application.db_api.cache['/api/places/||city=moscow&ordeding=-slug']
-        cached_request = json.loads(cached_request)
+        cached_request = unpack_entry(cached_request)
+        self.assertEqual(
+            cached_request['__meta__'].pop('etag'), content_etag(bytes(cached_request['body'])),
+        )
         self.assertDictEqual(
             cached_request['__meta__'],
-            {'created': 111.0, 'tags': ['places']},
+            {'created': 111.0, 'tags': ['places'], 'delta': 0},
         )
         self.assertDictEqual(json.loads(response.body.decode())['data'], {"not_cached": "test"})
 
-        request = HTTPRequest(url, method='GET')
-        response = yield self.http_client.fetch(request, raise_error=False)
+        mock_time.return_value = 112.0
+        with patch('db_api.cached_api.time', mock_time):
+            request = HTTPRequest(url, method='GET')
+            response = yield self.http_client.fetch(request, raise_error=False)
         self.assertDictEqual(json.loads(response.body.decode())['data'], {"not_cached": "test"})
+        self.assertEqual(self.application.db_api._http_client.fetch.call_count, 1)
 
         mock_time = Mock()
         mock_time.return_value = 222
@@ -281,3 +682,717 @@ class CacheDBApiTest(AsyncHTTPTestCase):
                 "name": ["This field is required."]
             }
         )
+
+
+class CoalescingDBApiTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db_api = DBApiCached(
+            'localhost', 8000,
+            http_client=Mock(),
+            resolver=Mock(),
+            cache=TestCache(),
+        )
+
+    @gen_test
+    def test_concurrent_misses_share_one_fetch(self):
+        @gen.coroutine
+        def slow_db_fetch(request, *args, **kwargs):
+            yield gen.sleep(0.01)
+            return HTTPResponse(request, 200, None, BytesIO(b'{"events": []}'))
+        self.db_api._http_client.fetch.side_effect = slow_db_fetch
+
+        params = {'city': 'moscow'}
+        results = yield [
+            self.db_api._request('localhost', 8000, 'GET', '/api/events/', params=params)
+            for _ in range(5)
+        ]
+
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 1)
+        self.assertEqual(self.db_api.stats['coalesced'], 4)
+        self.assertEqual(self.db_api._inflight, {})
+        for result in results:
+            self.assertEqual(result['data'], {'events': []})
+
+        yield self.db_api._request('localhost', 8000, 'GET', '/api/events/', params=params)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 1)
+
+    @gen_test
+    def test_different_keys_are_not_coalesced(self):
+        @gen.coroutine
+        def slow_db_fetch(request, *args, **kwargs):
+            yield gen.sleep(0.01)
+            return HTTPResponse(request, 200, None, BytesIO(b'{}'))
+        self.db_api._http_client.fetch.side_effect = slow_db_fetch
+
+        yield [
+            self.db_api._request('localhost', 8000, 'GET', '/api/events/', params={'city': city})
+            for city in ['moscow', 'spb']
+        ]
+
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 2)
+        self.assertEqual(self.db_api.stats['coalesced'], 0)
+
+
+class CacheWarmerTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db_api = DBApiCached(
+            'localhost', 8000,
+            http_client=Mock(),
+            resolver=Mock(),
+            cache=TestCache(),
+        )
+        self.db_api._resolver.resolve.return_value = resolved([(2, ('127.0.0.1', 8000))])
+        self.fetched = []
+
+        @gen.coroutine
+        def db_fetch(request, *args, **kwargs):
+            self.fetched.append(request.url)
+            yield gen.sleep(0.01)
+            return HTTPResponse(request, 200, None, BytesIO(b'{"events": []}'))
+        self.db_api._http_client.fetch.side_effect = db_fetch
+
+    @gen_test
+    def test_warm_up_fills_cache(self):
+        urls = [
+            '/api/events/?city=moscow',
+            {'path': '/api/places/', 'params': {'city': 'spb'}},
+            '/api/users/',
+        ]
+        stats = yield CacheWarmer(self.db_api, urls, concurrency=2).run()
+
+        self.assertEqual(stats, {'ok': 3, 'error': 0})
+        self.assertEqual(len(self.fetched), 3)
+        self.assertIn('http://127.0.0.1:8000/api/places/?city=spb', self.fetched)
+
+        is_ok, res = yield self.db_api.get('/api/events/', params={'city': 'moscow'})
+        self.assertEqual(res['data'], {'events': []})
+        self.assertEqual(len(self.fetched), 3)
+
+    @gen_test
+    def test_shard_and_budget(self):
+        urls = ['/api/events/%d/' % i for i in range(10)]
+        warmer = CacheWarmer(self.db_api, urls, concurrency=1, budget=0.025, shard=(1, 2))
+        self.assertEqual(
+            [path for path, _ in warmer.urls], ['/api/events/%d/' % i for i in range(1, 10, 2)],
+        )
+
+        stats = yield warmer.run()
+        self.assertTrue(warmer.finished)
+        self.assertLess(stats['ok'], 5)
+
+    def test_urls_from_access_log(self):
+        with NamedTemporaryFile('w') as f:
+            f.write(
+                '[I 161018 12:00:00 web:1946] 200 GET /db/api/events/?city=moscow '
+                '(127.0.0.1) 3.21ms\n'
+                '[I 161018 12:00:01 web:1946] 200 GET /db/api/places/ (127.0.0.1) 1.00ms\n'
+                '[I 161018 12:00:02 web:1946] 200 GET /db/api/events/?city=moscow '
+                '(127.0.0.1) 2.00ms\n'
+                '[W 161018 12:00:03 web:1946] 404 GET /db/api/nothing/ (127.0.0.1) 1.00ms\n'
+                '[I 161018 12:00:04 web:1946] 200 GET /test/ (127.0.0.1) 1.00ms\n'
+            )
+            f.flush()
+            self.assertEqual(
+                urls_from_access_log(f.name), ['/api/events/?city=moscow', '/api/places/'],
+            )
+            self.assertEqual(urls_from_access_log(f.name, top=1), ['/api/events/?city=moscow'])
+
+
+class AcceptsGzipTest(TestCase):
+
+    def test_accepts_gzip(self):
+        for header, expected in [
+            ('gzip, deflate, br', True),
+            ('deflate;q=1, GZIP;q=0.5', True),
+            ('*', True),
+            ('gzip;q=0', False),
+            ('x-gzip, identity', False),
+            ('', False),
+            (None, False),
+        ]:
+            self.assertEqual(accepts_gzip(header), expected, header)
+
+
+class WriteVariantTest(TestCase):
+
+    def handler(self, cls, gzip_cache):
+        handler = type(cls, (Mock, ), {})()
+        handler.application.gzip_cache = gzip_cache
+        handler.request.headers = HTTPHeaders({'Accept-Encoding': 'gzip'})
+        handler.settings = {}
+        return handler
+
+    def test_variants_are_per_handler(self):
+        gzip_cache = LocalCache(max_bytes=1024 * 1024, key_ttl=60)
+        api = self.handler('DBApiRequestHandler', gzip_cache)
+        page = self.handler('TestView', gzip_cache)
+
+        # один ETag, но тела разные: api оборачивает тело базы
+        write_variant(api, '"x"', lambda: b'{"status": "ok", "data": [1]}')
+        write_variant(page, '"x"', lambda: b'[1]')
+        self.assertEqual(
+            gzip.decompress(api.write.call_args[0][0]), b'{"status": "ok", "data": [1]}',
+        )
+        self.assertEqual(gzip.decompress(page.write.call_args[0][0]), b'[1]')
+
+        write_variant(page, '"x"', Mock(side_effect=AssertionError('compressed twice')))
+        self.assertEqual(gzip.decompress(page.write.call_args[0][0]), b'[1]')
+
+
+class RefreshAheadTest(AsyncTestCase):
+
+    def test_sketch_counts_and_decays(self):
+        sketch = CountMinSketch(width=64, depth=4, sample_size=100)
+        for _ in range(40):
+            sketch.add('hot')
+        sketch.add('cold')
+        self.assertGreaterEqual(sketch.estimate('hot'), 40)
+        self.assertLess(sketch.estimate('cold'), 40)
+
+        for i in range(59):
+            sketch.add('other%d' % i)
+        self.assertLessEqual(sketch.estimate('hot'), 40)
+        self.assertGreaterEqual(sketch.estimate('hot'), 20)
+
+    def test_budget(self):
+        refresh = RefreshAhead(window=1, min_hits=2, concurrency=2, qps=2)
+        self.assertFalse(refresh.allow(hits=1, ttl_left=0.5))
+        self.assertFalse(refresh.allow(hits=5, ttl_left=3))
+
+        self.assertTrue(refresh.allow(hits=5, ttl_left=0.5))
+        self.assertTrue(refresh.allow(hits=5, ttl_left=0.5))
+        self.assertFalse(refresh.allow(hits=5, ttl_left=0.5))
+        self.assertEqual(refresh.stats['throttled_qps'], 1)
+
+        refresh.start()
+        refresh.start()
+        self.assertFalse(refresh.allow(hits=5, ttl_left=0.5))
+        self.assertEqual(refresh.stats['throttled_concurrency'], 1)
+
+
+class StaleCacheDBApiTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db_api = DBApiCached(
+            'localhost', 8000,
+            http_client=Mock(),
+            resolver=Mock(),
+            cache=TestCache(),
+            cache_key_ttl=10,
+            cache_stale_ttl=30,
+            cache_stale_if_error=300,
+        )
+        self.body = b'{"version": 1}'
+
+        @gen.coroutine
+        def db_fetch(request, *args, **kwargs):
+            yield gen.sleep(0.01)
+            return HTTPResponse(request, 200, None, BytesIO(self.body))
+        self.db_api._http_client.fetch.side_effect = db_fetch
+
+    @gen.coroutine
+    def get_at(self, now):
+        with patch('db_api.cached_api.time', Mock(return_value=now)):
+            res = yield self.db_api._request('localhost', 8000, 'GET', '/api/events/')
+        return res  # noqa
+
+    @gen_test
+    def test_stale_while_revalidate(self):
+        yield self.get_at(100.0)
+        self.body = b'{"version": 2}'
+
+        results = yield [self.get_at(115.0), self.get_at(115.0)]
+        self.assertEqual([r['data'] for r in results], [{'version': 1}] * 2)
+        self.assertEqual(self.db_api.stats['stale_served'], 2)
+        self.assertEqual(self.db_api.stats['background_refreshes'], 1)
+
+        yield gen.sleep(0.02)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 2)
+        res = yield self.get_at(116.0)
+        self.assertEqual(res['data'], {'version': 2})
+
+    @gen_test
+    def test_stale_stream_is_not_written_by_refresh(self):
+        self.db_api._resolver.resolve.return_value = resolved([(2, ('127.0.0.1', 8000))])
+
+        @gen.coroutine
+        def db_fetch(request, *args, **kwargs):
+            yield gen.sleep(0.01)
+            if request.streaming_callback is None:
+                return HTTPResponse(request, 200, None, BytesIO(self.body))
+            request.header_callback('HTTP/1.1 200 OK\r\n')
+            request.header_callback('\r\n')
+            request.streaming_callback(self.body)
+            return HTTPResponse(request, 200, None, BytesIO())
+        self.db_api._http_client.fetch.side_effect = db_fetch
+
+        @gen.coroutine
+        def stream_at(now):
+            chunks = []
+            with patch('db_api.cached_api.time', Mock(return_value=now)):
+                is_ok, res = yield self.db_api.stream(
+                    'GET', '/api/export/',
+                    on_start=lambda code, headers: None, on_chunk=chunks.append, tee_limit=1024,
+                )
+            return res, chunks  # noqa
+
+        res, chunks = yield stream_at(100.0)
+        self.assertTrue(res['streamed'])
+        self.assertEqual(b''.join(chunks), b'{"version": 1}')
+        self.body = b'{"version": 2}'
+
+        # stale: ответ из кэша, обновление в фоне ничего не пишет клиенту
+        res, chunks = yield stream_at(115.0)
+        self.assertEqual(res['data'], {'version': 1})
+        yield gen.sleep(0.02)
+        self.assertEqual(chunks, [])
+        self.assertEqual(self.db_api.stats['background_refreshes'], 1)
+        self.assertEqual(self.db_api._http_client.fetch.call_args[0][0].streaming_callback, None)
+
+        res, chunks = yield stream_at(116.0)
+        self.assertEqual(res['data'], {'version': 2})
+
+    @gen_test
+    def test_serve_stale_on_error(self):
+        yield self.get_at(100.0)
+
+        @gen.coroutine
+        def broken_db_fetch(request, *args, **kwargs):
+            return HTTPResponse(request, 599, None, BytesIO(b''))
+        self.db_api._http_client.fetch.side_effect = broken_db_fetch
+
+        res = yield self.get_at(200.0)
+        self.assertEqual(res['code'], 200)
+        self.assertEqual(res['data'], {'version': 1})
+        self.assertEqual(self.db_api.stats['stale_on_error'], 1)
+
+        res = yield self.get_at(500.0)
+        self.assertEqual(res['code'], 599)
+
+    @gen_test
+    def test_serve_stale_on_error_to_coalesced(self):
+        yield self.get_at(100.0)
+
+        @gen.coroutine
+        def broken_db_fetch(request, *args, **kwargs):
+            yield gen.sleep(0.01)
+            return HTTPResponse(request, 503, None, BytesIO(b''))
+        self.db_api._http_client.fetch.side_effect = broken_db_fetch
+
+        with patch('db_api.cached_api.time', Mock(return_value=200.0)):
+            results = yield [
+                self.db_api._request('localhost', 8000, 'GET', '/api/events/')
+                for _ in range(3)
+            ]
+        self.assertEqual([r['code'] for r in results], [200] * 3)
+        self.assertEqual([r['data'] for r in results], [{'version': 1}] * 3)
+        self.assertEqual(self.db_api.stats['coalesced'], 2)
+        self.assertEqual(self.db_api.stats['stale_on_error'], 3)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 2)
+        self.assertEqual(self.db_api._inflight_cached, {})
+
+    @gen_test
+    def test_broken_stream_is_not_replaced_by_stale(self):
+        yield self.get_at(100.0)
+
+        @gen.coroutine
+        def broken_db_fetch(request, *args, **kwargs):
+            request.header_callback('HTTP/1.1 200 OK\r\n')
+            request.header_callback('\r\n')
+            request.streaming_callback(b'{"vers')
+            return HTTPResponse(request, 599, None, BytesIO())
+        self.db_api._resolver.resolve.return_value = resolved([(2, ('127.0.0.1', 8000))])
+        self.db_api._http_client.fetch.side_effect = broken_db_fetch
+
+        # stale еще можно отдать, но часть тела уже ушла клиенту
+        chunks = []
+        with patch('db_api.cached_api.time', Mock(return_value=200.0)):
+            is_ok, res = yield self.db_api.stream(
+                'GET', '/api/events/',
+                on_start=lambda code, headers: None, on_chunk=chunks.append, tee_limit=1024,
+            )
+        self.assertEqual(chunks, [b'{"vers'])
+        self.assertTrue(res['streamed'])
+        self.assertFalse(res['complete'])
+        self.assertEqual(self.db_api.stats['stale_on_error'], 0)
+
+    @gen_test
+    def test_serve_stale_when_circuit_is_open(self):
+        yield self.get_at(100.0)
+
+        self.db_api._pool = BackendPool([('localhost', 8000)], breaker={'max_failures': 1})
+        backend = self.db_api._pool.backends[('localhost', 8000)]
+        backend.start()
+        backend.finish(5.0, error=True, timeout=True)
+
+        res = yield self.get_at(200.0)
+        self.assertEqual(res['data'], {'version': 1})
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 1)
+        self.assertEqual(backend.stats['fail_fast'], 1)
+
+    @gen_test
+    def test_conditional_revalidation(self):
+        headers = HTTPHeaders({'Etag': '"v1"', 'Last-Modified': 'Tue, 18 Oct 2016 12:00:00 GMT'})
+
+        not_modified = HTTPHeaders({
+            'Etag': '"v1"',
+            'Last-Modified': 'Wed, 19 Oct 2016 12:00:00 GMT',
+            'Cache-Control': 'max-age=60',
+            'Content-Length': '0',
+        })
+
+        @gen.coroutine
+        def db_fetch(request, *args, **kwargs):
+            if request.headers.get('If-None-Match') == '"v1"':
+                return HTTPResponse(request, 304, not_modified, BytesIO(b''))
+            return HTTPResponse(request, 200, headers, BytesIO(self.body))
+        self.db_api._http_client.fetch.side_effect = db_fetch
+
+        yield self.get_at(100.0)
+        res = yield self.get_at(150.0)
+        self.assertEqual(res['data'], {'version': 1})
+        self.assertEqual(self.db_api.stats['revalidated'], 1)
+        request = self.db_api._http_client.fetch.call_args[0][0]
+        self.assertEqual(request.headers['If-Modified-Since'], 'Tue, 18 Oct 2016 12:00:00 GMT')
+
+        # запись продлена: снова свежая без похода в базу
+        entry = unpack_entry(self.db_api.cache['/api/events/||'])
+        self.assertEqual(entry['__meta__']['created'], 150.0)
+        self.assertEqual(entry['__meta__']['etag'], content_etag(self.body))
+        self.assertEqual(sorted(entry['headers']), [
+            ['Cache-Control', 'max-age=60'],
+            ['Etag', '"v1"'],
+            ['Last-Modified', 'Wed, 19 Oct 2016 12:00:00 GMT'],
+        ])
+        yield self.get_at(155.0)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 2)
+
+        # следующий условный запрос - с заголовками из 304
+        yield self.get_at(200.0)
+        request = self.db_api._http_client.fetch.call_args[0][0]
+        self.assertEqual(request.headers['If-Modified-Since'], 'Wed, 19 Oct 2016 12:00:00 GMT')
+
+    @gen_test
+    def test_early_expiration(self):
+        @gen.coroutine
+        def db_fetch(request, *args, **kwargs):
+            yield gen.sleep(0.01)
+            return HTTPResponse(request, 200, None, BytesIO(self.body), request_time=0.5)
+        self.db_api._http_client.fetch.side_effect = db_fetch
+
+        yield self.get_at(100.0)
+        meta = unpack_entry(self.db_api.cache['/api/events/||'])['__meta__']
+        self.assertEqual(meta['delta'], 0.5)
+        self.body = b'{"version": 2}'
+
+        # 108 - 0.5 * log(0.5) ~ 108.35 < 110: еще свежая
+        with patch('db_api.cached_api.random', Mock(return_value=0.5)):
+            yield self.get_at(108.0)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 1)
+
+        # 108 - 0.5 * log(0.01) ~ 110.3: истекла раньше, но отдаем старую
+        with patch('db_api.cached_api.random', Mock(return_value=0.99)):
+            res = yield self.get_at(108.0)
+        self.assertEqual(res['data'], {'version': 1})
+        self.assertEqual(self.db_api.stats['early_refreshes'], 1)
+        yield gen.sleep(0.02)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 2)
+
+        self.db_api.cache_xfetch_beta = 0
+        with patch('db_api.cached_api.random', Mock(return_value=0.99)):
+            res = yield self.get_at(109.9)
+        self.assertEqual(res['data'], {'version': 2})
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 2)
+
+    @gen_test
+    def test_refresh_ahead_of_hot_key(self):
+        self.db_api.refresh_ahead = RefreshAhead(window=2, min_hits=3, concurrency=1, qps=100)
+        for now in [100.0, 101.0, 102.0]:
+            yield self.get_at(now)
+        self.body = b'{"version": 2}'
+
+        # до конца cache_key_ttl еще далеко
+        yield self.get_at(105.0)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 1)
+
+        res = yield self.get_at(109.0)
+        self.assertEqual(res['data'], {'version': 1})
+        self.assertEqual(self.db_api.refresh_ahead.stats['scheduled'], 1)
+        yield gen.sleep(0.02)
+        self.assertEqual(self.db_api._http_client.fetch.call_count, 2)
+        self.assertEqual(self.db_api.refresh_ahead.inflight, 0)
+
+        res = yield self.get_at(109.5)
+        self.assertEqual(res['data'], {'version': 2})
+        self.assertEqual(self.db_api.stats['stale_served'], 0)
+
+    def test_deserialize_checks_meta_before_body(self):
+        meta = {'created': 100.0, 'tags': ['events']}
+        value = pack_entry(meta, 'http://localhost/api/events/', 200, [], self.body)
+        with patch('db_api.cached_api.time', Mock(return_value=115.0)):
+            response = self.db_api._deserialize_from_cache(value)
+        self.assertIs(response.body.obj, value)
+        self.assertEqual(bytes(response.body), self.body)
+
+        # тэг забыт: запись годится только на случай ошибки базы
+        self.db_api.cache_meta_data.forget_everything_before['events'] = 101.0
+        with patch('db_api.cached_api.time', Mock(return_value=300.0)):
+            self.assertIsNotNone(self.db_api._deserialize_from_cache(value))
+        self.db_api.cache_stale_if_error = 0
+        with patch('db_api.cached_api.time', Mock(return_value=120.0)):
+            self.assertIsNone(self.db_api._deserialize_from_cache(value))
+        with patch('db_api.cached_api.time', Mock(return_value=105.0)):
+            self.assertIsNotNone(self.db_api._deserialize_from_cache(value))
+
+        # пережила свой ttl в redis
+        self.db_api.cache_meta_data.forget_everything_before.clear()
+        with patch('db_api.cached_api.time', Mock(return_value=100.0 + self.db_api._redis_key_ttl)):
+            self.assertIsNone(self.db_api._deserialize_from_cache(value))
+
+    @gen_test
+    def test_local_cache_hit_skips_redis(self):
+        self.db_api.local_cache = LocalCache(max_bytes=1024, key_ttl=5)
+        yield self.get_at(100.0)
+
+        self.db_api.cache = Mock()
+        res = yield self.get_at(101.0)
+        self.assertEqual(res['data'], {'version': 1})
+        self.assertFalse(self.db_api.cache.get.called)
+        self.assertEqual(self.db_api.local_cache.stats['hits'], 1)
+
+        # в L1 нет запроса клиента с его колбэками и timing
+        entry = self.db_api.local_cache.get('/api/events/||')
+        self.assertIsNot(entry.request, self.db_api._http_client.fetch.call_args[0][0])
+        self.assertEqual(entry.request.url, 'http://localhost:8000/api/events/')
+        self.assertIsNone(getattr(entry.request, 'timing', None))
+
+        self.db_api.cache_meta_data.forget_it(['events'])
+        self.db_api.cache = TestCache()
+        self.body = b'{"version": 2}'
+        res = yield self.get_at(102.0)
+        self.assertEqual(res['data'], {'version': 2})
+
+
+class SharedInvalidationTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = FakeRedisServer()
+        port = self.server.listen_random_port()
+        self.validators = []
+        for _ in range(2):
+            cache = RedisCache(host='127.0.0.1', port=port)
+            validator = SharedCacheMetaDataValidator(cache, poll_interval=0.01)
+            cache.run()
+            validator.run()
+            self.validators.append(validator)
+
+    def tearDown(self):
+        for validator in self.validators:
+            validator.stop()
+            validator.cache.stop()
+            validator.cache.redis_connection.disconnect()
+        self.server.stop()
+        super().tearDown()
+
+    @gen_test
+    def test_forget_is_broadcast(self):
+        worker_a, worker_b = self.validators
+        ready = yield wait_for(lambda: all(v._synced for v in self.validators))
+        self.assertTrue(ready)
+
+        worker_a.forget_it(['events'])
+        created = worker_a.forget_everything_before['events']
+
+        updated = yield wait_for(lambda: 'events' in worker_b.forget_everything_before)
+        self.assertTrue(updated)
+        self.assertEqual(worker_b.forget_everything_before['events'], created)
+        self.assertFalse(worker_b.is_valid_meta({'created': created - 1, 'tags': ['events']}))
+
+    @gen_test
+    def test_new_worker_syncs_from_redis(self):
+        worker_a, _ = self.validators
+        yield wait_for(lambda: worker_a._synced)
+        worker_a.forget_it(['places'])
+        yield wait_for(lambda: not worker_a._unpublished)
+
+        cache = worker_a.cache
+        late_worker = SharedCacheMetaDataValidator(cache, poll_interval=0.01)
+        late_worker.run()
+        self.validators.append(late_worker)
+
+        synced = yield wait_for(lambda: 'places' in late_worker.forget_everything_before)
+        self.assertTrue(synced)
+
+
+class ActiveInvalidationTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = FakeRedisServer()
+        self.cache = RedisCache(host='127.0.0.1', port=self.server.listen_random_port())
+        self.db_api = DBApiCached(
+            'localhost', 8000,
+            http_client=Mock(),
+            resolver=Mock(),
+            cache=self.cache,
+            cache_key_ttl=10,
+            cache_active_invalidation=True,
+        )
+
+        @gen.coroutine
+        def db_fetch(request, *args, **kwargs):
+            return HTTPResponse(request, 200, None, BytesIO(b'{}'))
+        self.db_api._http_client.fetch.side_effect = db_fetch
+
+    def tearDown(self):
+        self.cache.redis_connection.disconnect()
+        self.server.stop()
+        super().tearDown()
+
+    @gen_test
+    def test_write_deletes_tagged_keys(self):
+        yield self.cache.redis_connection.connect()
+        self.cache.state = self.cache.state_map[self.cache.CONNECTED]
+
+        yield self.db_api._request('localhost', 8000, 'GET', '/api/events/')
+        yield self.db_api._request('localhost', 8000, 'GET', '/api/places/')
+        self.assertIn(b'/api/events/||', self.server.data)
+        yield wait_for(lambda: b'cache:tag:events' in self.server.data)
+        self.assertIn(b'cache:tag:events', self.server.data)
+
+        yield self.db_api._request('localhost', 8000, 'POST', '/api/events/', data={'a': 1})
+        yield wait_for(lambda: self.db_api.stats['purged_keys'])
+
+        self.assertNotIn(b'/api/events/||', self.server.data)
+        self.assertNotIn(b'cache:tag:events', self.server.data)
+        self.assertIn(b'/api/places/||', self.server.data)
+        self.assertEqual(self.db_api.stats['purged_keys'], 1)
+
+    @gen_test
+    def test_index_is_written_in_background(self):
+        self.db_api.cache = TestCache()
+        self.db_api.cache.pipeline = Mock(return_value=Future())
+
+        res = yield self.db_api._request('localhost', 8000, 'GET', '/api/events/')
+        self.assertEqual(res['code'], 200)
+        self.assertTrue(self.db_api.cache.pipeline.called)
+
+
+class TagRulesTest(TestCase):
+
+    def setUp(self):
+        self.rules = TagRules([
+            {'pattern': '/api/events/', 'tags': ['events']},
+            {'pattern': '/api/events/{id}/', 'tags': ['events:{id}'], 'invalidates': ['events']},
+            {
+                'pattern': '/api/events/{id}/places/{pid}',
+                'tags': ['events', 'events:{id}', 'places:{pid}'],
+            },
+            {'pattern': '/api/*/export/**', 'tags': ['export']},
+            {'pattern': '/**/tag/**', 'tags': ['tag']},
+        ])
+
+    def test_match(self):
+        self.assertEqual(self.rules.match('/api/events/'), (['events'], []))
+        self.assertEqual(self.rules.match('/api/events/42'), (['events:42'], ['events']))
+        self.assertEqual(
+            self.rules.match('/api/events/42/places/7/'),
+            (['events', 'events:42', 'places:7'], []),
+        )
+        self.assertEqual(self.rules.match('/api/places/export/2016/csv'), (['export'], []))
+        self.assertEqual(self.rules.match('/api/events/42/tag/'), (['tag'], []))
+        self.assertEqual(self.rules.match('/api/cities/'), ([], []))
+
+    def test_route(self):
+        self.assertEqual(self.rules.route('/api/events/42/'), '/api/events/{id}/')
+        self.assertEqual(
+            self.rules.route('/api/events/42/places/7/'), '/api/events/{id}/places/{pid}',
+        )
+        self.assertEqual(self.rules.route('/api/places/export/2016/csv'), 'other')
+
+    def test_entity_write_keeps_other_entities(self):
+        validator = CacheMetaDataValidator(tag_rules=self.rules)
+        cached = {
+            'list': {'created': time() - 1, 'tags': ['events']},
+            'event-1': {'created': time() - 1, 'tags': ['events:1']},
+            'event-2': {'created': time() - 1, 'tags': ['events:2']},
+        }
+
+        validator.process_request(HTTPRequest('http://localhost/api/events/2/', method='PUT'))
+
+        self.assertFalse(validator.is_valid_meta(cached['list']))
+        self.assertTrue(validator.is_valid_meta(cached['event-1']))
+        self.assertFalse(validator.is_valid_meta(cached['event-2']))
+
+    def test_default_rules_match_url_tags(self):
+        validator = CacheMetaDataValidator()
+        request = HTTPRequest('http://localhost/api/events/fkfk/places/dkd', method='POST')
+        self.assertEqual(validator.process_request(request), ['events', 'places'])
+
+    def test_unknown_placeholder(self):
+        with self.assertRaises(ValueError):
+            TagRules([{'pattern': '/api/events/{id}/', 'tags': ['events:{pk}']}])
+
+
+class PassthroughOutputTest(TestCase):
+
+    def test_checked_body_is_not_parsed(self):
+        response = HTTPResponse(HTTPRequest('http://localhost/'), 200, None, BytesIO(b'not json'))
+        response.json_checked = True
+        result = DBApiCached._format_output(response, passthrough=True)
+        self.assertIs(result['body'], response.body)
+
+    def test_invalid_json_falls_back_to_error(self):
+        response = HTTPResponse(HTTPRequest('http://localhost/'), 200, None, BytesIO(b'not json'))
+        result = DBApiCached._format_output(response, passthrough=True)
+        self.assertEqual(result['code'], 400)
+        self.assertNotIn('body', result)
+
+    def test_empty_body(self):
+        response = HTTPResponse(HTTPRequest('http://localhost/'), 201, None, BytesIO(b''))
+        result = DBApiCached._format_output(response, passthrough=True)
+        self.assertEqual(result['body'], b'{}')
+
+
+class CacheFormatTest(TestCase):
+
+    def test_roundtrip(self):
+        meta = {'created': 111.0, 'tags': ['events']}
+        body = b'{"results": ["\\u043f\\u0440\\u0438\\u0432\\u0435\\u0442"]}'
+        value = pack_entry(meta, 'http://localhost/api/events/', 200, [['X-Total', '1']], body)
+
+        entry = unpack_entry(value)
+        self.assertEqual(entry['__meta__'], meta)
+        self.assertEqual(entry['code'], 200)
+        self.assertEqual(entry['headers'], [['X-Total', '1']])
+        self.assertIsInstance(entry['body'], memoryview)
+        self.assertEqual(entry['body'].obj, value)
+        self.assertEqual(bytes(entry['body']), body)
+
+        seen = []
+        self.assertIsNone(unpack_entry(value, accept=lambda meta: seen.append(meta)))
+        self.assertEqual(seen, [meta])
+        self.assertEqual(unpack_entry(value, accept=lambda meta: True)['code'], 200)
+
+    def test_legacy_json_entry(self):
+        value = json.dumps({
+            '__meta__': {'created': 111.0, 'tags': []},
+            'url': 'http://localhost/api/events/',
+            'code': 200,
+            'headers': [],
+            'body': '{"a": 1}',
+        }).encode()
+
+        entry = unpack_entry(value)
+        self.assertEqual(bytes(entry['body']), b'{"a": 1}')
+        self.assertIsNone(unpack_entry(value, accept=lambda meta: meta['created'] > 200))
+
+    def test_unknown_format(self):
+        with self.assertRaises(CacheFormatError):
+            unpack_entry(b'\xcbX\x09garbage-garbage')
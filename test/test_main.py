@@ -0,0 +1,54 @@
+import socket
+from unittest import TestCase
+from mock import Mock, patch
+
+import tornado.netutil
+
+import main
+
+
+class RunWorkersTest(TestCase):
+
+    def run_worker(self, port, reuse_port):
+        """
+            run_workers без форка и IOLoop: возвращает сокеты,
+            которые воркер отдал HTTPServer, и порядок вызовов
+        """
+        calls = Mock()
+        calls.attach_mock(Mock(wraps=tornado.netutil.bind_sockets), 'bind_sockets')
+        calls.attach_mock(Mock(), 'fork_processes')
+        server = Mock()
+
+        with patch('tornado.netutil.bind_sockets', calls.bind_sockets), \
+                patch('tornado.process.fork_processes', calls.fork_processes), \
+                patch('tornado.process.task_id', Mock(return_value=0)), \
+                patch('tornado.httpserver.HTTPServer', Mock(return_value=server)), \
+                patch('tornado.ioloop.IOLoop.instance', Mock()), \
+                patch('main.NightpartyApplication', Mock()):
+            main.run_workers(port, workers=2, reuse_port=reuse_port)
+
+        sockets = server.add_sockets.call_args[0][0]
+        self.addCleanup(lambda: [sock.close() for sock in sockets])
+        return sockets, [name for name, _, _ in calls.mock_calls]
+
+    def test_reuse_port(self):
+        first, order = self.run_worker(0, reuse_port=True)
+        self.assertEqual(order, ['fork_processes', 'bind_sockets'])
+        port = first[0].getsockname()[1]
+
+        # второй воркер слушает тот же порт
+        second, _ = self.run_worker(port, reuse_port=True)
+        for sock in first + second:
+            self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT), 1)
+            self.assertEqual(sock.getsockname()[1], port)
+
+        # все семейства адресов, как у application.listen, а не только IPv4
+        listen = tornado.netutil.bind_sockets(0)
+        self.addCleanup(lambda: [sock.close() for sock in listen])
+        self.assertEqual({sock.family for sock in first}, {sock.family for sock in listen})
+
+    def test_shared_sockets(self):
+        sockets, order = self.run_worker(0, reuse_port=False)
+        self.assertEqual(order, ['bind_sockets', 'fork_processes'])
+        for sock in sockets:
+            self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT), 0)
@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+from metrics import Registry
+from timing import Timing, span
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_render(self):
+        requests = self.registry.counter('requests_total', 'Requests', ['route', 'outcome'])
+        latency = self.registry.histogram(
+            'request_seconds', 'Latency', ['route'], buckets=(0.01, 0.1),
+        )
+        stats = {'hits': 3, 'misses': 1}
+        self.registry.stats('cache_events_total', 'Cache', lambda: stats)
+
+        requests.inc('/api/events/', 'hit')
+        requests.inc('/api/events/', 'hit')
+        requests.inc('/api/"x"/', 'miss')
+        for value in [0.005, 0.05, 0.5]:
+            latency.observe(value, '/api/events/')
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP cache_events_total Cache',
+            '# TYPE cache_events_total counter',
+            'cache_events_total{event="hits"} 3',
+            'cache_events_total{event="misses"} 1',
+            '# HELP request_seconds Latency',
+            '# TYPE request_seconds histogram',
+            'request_seconds_bucket{route="/api/events/",le="0.01"} 1',
+            'request_seconds_bucket{route="/api/events/",le="0.1"} 2',
+            'request_seconds_bucket{route="/api/events/",le="+Inf"} 3',
+            'request_seconds_sum{route="/api/events/"} 0.555',
+            'request_seconds_count{route="/api/events/"} 3',
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{route="/api/\\"x\\"/",outcome="miss"} 1',
+            'requests_total{route="/api/events/",outcome="hit"} 2',
+        ]) + '\n')
+
+    def test_recording(self):
+        requests = self.registry.counter('requests_total', 'Requests', ['route', 'outcome'])
+        latency = self.registry.histogram('request_seconds', 'Latency', ['route'])
+
+        n = 1000
+        for i in range(n):
+            requests.inc('/api/events/{id}/', 'hit')
+            latency.observe(0.003, '/api/events/{id}/')
+
+        self.assertEqual(requests.get('/api/events/{id}/', 'hit'), n)
+        self.assertEqual(latency.count('/api/events/{id}/'), n)
+        self.assertEqual(latency.count('/api/places/'), 0)
+
+
+class TimingTest(TestCase):
+
+    def test_header(self):
+        timing = Timing()
+        timing.add('redis', 0.001)
+        timing.add('upstream', 0.0125)
+        timing.add('redis', 0.0005)
+        self.assertEqual(
+            timing.header(total=0.02), 'redis;dur=1.50, upstream;dur=12.50, total;dur=20.00',
+        )
+
+    def test_span(self):
+        timing = Timing()
+        for i in range(3):
+            with span(timing, 'redis'):
+                pass
+        self.assertEqual(list(timing.spans), ['redis'])
+        self.assertGreaterEqual(timing.spans['redis'], 0)
+
+        with span(None, 'redis'):
+            pass
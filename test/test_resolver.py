@@ -0,0 +1,94 @@
+from mock import Mock, patch
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from resolver import Resolver
+
+
+ADDRESSES = [(2, ('10.0.0.1', 8000))]
+
+
+class ResolverTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resolver = Resolver(ttl=10, negative_ttl=1, prefetch=2)
+        self.now = 100.0
+        self.time = patch('resolver.time', lambda: self.now)
+        self.time.start()
+
+        self.answers = []
+        self.upstream = Mock(side_effect=self.answer)
+        self.cares = patch('tornado.platform.caresresolver.CaresResolver.resolve', self.upstream)
+        self.cares.start()
+
+    def tearDown(self):
+        self.cares.stop()
+        self.time.stop()
+        super().tearDown()
+
+    def answer(self, host, port, family):
+        future = Future()
+        self.answers.append(future)
+        return future
+
+    @gen_test
+    def test_concurrent_lookups_share_one_query(self):
+        results = [self.resolver.resolve('db', 8000) for _ in range(5)]
+        self.assertEqual(self.upstream.call_count, 1)
+        self.answers[0].set_result(ADDRESSES)
+
+        results = yield results
+        self.assertEqual(results, [ADDRESSES] * 5)
+        self.assertEqual(self.resolver.stats['coalesced'], 4)
+
+        result = yield self.resolver.resolve('db', 8000)
+        self.assertEqual(result, ADDRESSES)
+        self.assertEqual(self.upstream.call_count, 1)
+
+    @gen_test
+    def test_expiry_and_prefetch(self):
+        future = self.resolver.resolve('db', 8000)
+        self.answers[0].set_result(ADDRESSES)
+        yield future
+
+        # за prefetch секунд до истечения - старый ответ и обновление в фоне
+        self.now += 8.5
+        result = yield self.resolver.resolve('db', 8000)
+        self.assertEqual(result, ADDRESSES)
+        self.assertEqual(self.upstream.call_count, 2)
+        yield self.resolver.resolve('db', 8000)
+        self.assertEqual(self.upstream.call_count, 2)
+
+        fresh = [(2, ('10.0.0.2', 8000))]
+        self.answers[1].set_result(fresh)
+        yield gen.sleep(0.01)
+        self.now += 5
+        result = yield self.resolver.resolve('db', 8000)
+        self.assertEqual(result, fresh)
+        self.assertEqual(self.resolver.stats['prefetches'], 1)
+
+        # запись истекла - удалена из кэша по куче сроков
+        self.now += 20
+        self.resolver.resolve('db', 8000)
+        self.assertEqual(self.upstream.call_count, 3)
+        self.assertEqual(len(self.resolver._dns_cache), 0)
+
+    @gen_test
+    def test_negative_caching(self):
+        future = self.resolver.resolve('nowhere', 8000)
+        self.answers[0].set_exception(IOError('no such host'))
+        with self.assertRaises(IOError):
+            yield future
+
+        with self.assertRaises(IOError):
+            yield self.resolver.resolve('nowhere', 8000)
+        self.assertEqual(self.upstream.call_count, 1)
+        self.assertEqual(self.resolver.stats['negative_hits'], 1)
+
+        self.now += 1
+        self.resolver.resolve('nowhere', 8000)
+        self.assertEqual(self.upstream.call_count, 2)
@@ -0,0 +1,70 @@
+"""
+    Разбивка времени одного запроса по этапам
+
+        timing = Timing()
+        with span(timing, 'redis'):
+            value = yield cache.get(key)
+
+        timing.header()  # 'redis;dur=0.41' для заголовка Server-Timing
+
+    span(None, ...) ничего не меряет, так что код с замерами
+    не меняется, когда разбивка не нужна. Повторные замеры
+    одного этапа складываются.
+"""
+from collections import OrderedDict
+from time import perf_counter
+
+
+class _Span:
+    __slots__ = ('timing', 'name', 'started')
+
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timing.add(self.name, perf_counter() - self.started)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(timing, name):
+    if timing is None:
+        return NULL_SPAN
+    return _Span(timing, name)
+
+
+class Timing:
+    def __init__(self):
+        # этап -> секунды
+        self.spans = OrderedDict()
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0) + seconds
+
+    def header(self, total=None):
+        """
+            Значение Server-Timing, длительности в миллисекундах
+        """
+        items = list(self.spans.items())
+        if total is not None:
+            items.append(('total', total))
+        return ', '.join('%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in items)
+
+    def as_dict(self):
+        return OrderedDict((name, round(seconds * 1000, 2)) for name, seconds in self.spans.items())